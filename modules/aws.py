@@ -142,8 +142,12 @@ def create_glacier_client(aws_config):
         return None, str(e)
 
 
-def create_s3_client(aws_config):
-    """Create a boto3 S3 client.  Returns (client, None) or (None, error_msg)."""
+def create_s3_client(aws_config, max_pool_connections=None):
+    """Create a boto3 S3 client.  Returns (client, None) or (None, error_msg).
+
+    ``max_pool_connections`` raises the connection pool limit of the client,
+    needed when it is shared by more upload threads than botocore's default.
+    """
     region = aws_config.get("region")
     endpoint_url = aws_config.get("endpoint_url")
 
@@ -156,6 +160,9 @@ def create_s3_client(aws_config):
         kwargs = {"service_name": "s3", "region_name": region}
         if endpoint_url:
             kwargs["endpoint_url"] = endpoint_url
+        if max_pool_connections:
+            from botocore.config import Config
+            kwargs["config"] = Config(max_pool_connections=max_pool_connections)
         return session.client(**kwargs), None
     except (NoRegionError, NoCredentialsError, ClientError) as e:
         return None, str(e)
@@ -163,6 +170,17 @@ def create_s3_client(aws_config):
         return None, str(e)
 
 
+def create_s3_transfer_config(part_size, part_threads):
+    """Create the boto3 TransferConfig used for (multipart) S3 uploads."""
+    from boto3.s3.transfer import TransferConfig
+    return TransferConfig(
+        multipart_threshold=part_size,
+        multipart_chunksize=part_size,
+        max_concurrency=part_threads,
+        use_threads=part_threads > 1,
+    )
+
+
 # ---------------------------------------------------------------------------
 # Glacier tree-hash helpers (pure Python, no AWS CLI)
 # ---------------------------------------------------------------------------
@@ -1,9 +1,13 @@
+import collections
 import configparser
 import sys
 import os.path
 import logging
 import os
 
+from . import fileutils
+from . import helper
+
 setting = {
   "encrypt": None,
   "encrypt-pw": None,
@@ -21,6 +25,11 @@ setting = {
   "persuasive": True,
   "compress": True,
   "compress-force": False,
+  "compressor": "bzip2",
+  "compress-level": None,
+  "compress-detection": "extension",
+  "compress-threshold": 1048576,
+  "split-archives": False,
   "ignore-overlimit": False,
   "extra-ext" : None,
   "donedir": "backup/done/",
@@ -41,6 +50,14 @@ setting = {
   "custom-post" : None,
   "key-file" : None,
   "loop-slices": True,
+  "pipeline-slices": False,
+  "stat-cache": False,
+  "stat-cache-verify": 0.0,
+  "hash-workers": 1,
+  "hash-buffer": 268435456,
+  "stream-hash": False,
+  "state-database": "json",
+  "journal-size": 67108864,
 }
 
 CONFIG_SECTION_DEFAULTS = {
@@ -56,6 +73,11 @@ CONFIG_SECTION_DEFAULTS = {
     "max size": "0",
     "delta manifest": "yes",
     "compress": "yes",
+    "compressor": "bzip2",
+    "compress level": "",
+    "compress detection": "extension",
+    "compress threshold": "1M",
+    "split archives": "no",
     "incompressible": "",
     "persuasive": "no",
     "detect move": "no",
@@ -71,6 +93,14 @@ CONFIG_SECTION_DEFAULTS = {
     "create filelist": "yes",
     "check update": "no",
     "loop slices": "yes",
+    "pipeline slices": "no",
+    "stat cache": "no",
+    "stat cache verify": "0",
+    "hash workers": "1",
+    "hash buffer": "256M",
+    "stream hash": "no",
+    "state database": "json",
+    "journal size": "64M",
     # Historically documented and still accepted by the parser.
     "prefix": ""
   },
@@ -148,31 +178,30 @@ def getVersion():
 
 
 def _parse_size_option(config, section, option, label):
-  value = config.get(section, option).strip()
-  if value == "":
-    return 0
-  if value.isdigit():
-    return int(value)
-
-  unit = value.lower()[-1:]
-  number = value[:-1]
-  if not number.isdigit():
+  parsed = helper.parseSize(config.get(section, option))
+  if parsed is None:
     logging.error("%s has to be a number and may contain a unit suffix", label)
-    return None
+  return parsed
 
-  parsed = int(number, 10)
-  if unit == 'k':
-    parsed *= 1024
-  elif unit == 'm':
-    parsed *= 1048576
-  elif unit == 'g':
-    parsed *= 1073741824
-  elif unit == 't':
-    parsed *= 1099511627776
-  else:
-    logging.error("%s has to be a number and may contain a unit suffix", label)
+def _parse_verify_option(value):
+  """
+  Returns the fraction of cached files to re-hash per run, given either
+  a number of runs ("30" = every 30 runs on average) or a percentage ("5%").
+  Zero (or blank) disables re-verification.
+  """
+  value = value.strip()
+  if value == "":
+    return 0.0
+  if value.endswith("%"):
+    number = value[:-1].strip()
+    if not number.isdigit() or int(number) > 100:
+      return None
+    return int(number) / 100.0
+  if not value.isdigit():
     return None
-  return parsed
+  if int(value) == 0:
+    return 0.0
+  return 1.0 / int(value)
 
 def isCompatible(version):
   """
@@ -273,6 +302,36 @@ def parse(filename, onlysecurity=False):
   elif config.get("options", "compress").lower() == "force":
     setting["compress-force"] = True
 
+  compressor = config.get("options", "compressor").lower()
+  if compressor not in fileutils.COMPRESSORS:
+    logging.error("compressor has to be one of %s", "/".join(fileutils.COMPRESSORS))
+    return None
+  setting["compressor"] = compressor
+
+  level = config.get("options", "compress level")
+  if level != "":
+    low, high = fileutils.COMPRESSORS[compressor]["levels"]
+    if not level.isdigit() or int(level) < low or int(level) > high:
+      logging.error("compress level for %s has to be a number from %d to %d", compressor, low, high)
+      return None
+    setting["compress-level"] = int(level)
+
+  if config.get("options", "compress detection").lower() not in ["extension", "sample"]:
+    logging.error("compress detection has to be extension/sample")
+    return None
+  setting["compress-detection"] = config.get("options", "compress detection").lower()
+
+  threshold = _parse_size_option(config, "options", "compress threshold", "Compress threshold")
+  if threshold is None:
+    return None
+  setting["compress-threshold"] = threshold
+
+  if config.get("options", "split archives").lower() not in ["yes", "no"]:
+    logging.error("split archives has to be yes/no")
+    return None
+  elif config.get("options", "split archives").lower() == "yes":
+    setting["split-archives"] = True
+
   if config.get("options", "skip empty").lower() not in ["yes", "no"]:
     logging.error("skip empty has to be yes/no")
     return None
@@ -354,6 +413,52 @@ def parse(filename, onlysecurity=False):
   elif config.get("options", "loop slices").lower() == "no":
     setting["loop-slices"] = False
 
+  if config.get("options", "pipeline slices").lower() not in ["yes", "no"]:
+    logging.error("pipeline slices has to be yes/no")
+    return None
+  elif config.get("options", "pipeline slices").lower() == "yes":
+    setting["pipeline-slices"] = True
+
+  if config.get("options", "stat cache").lower() not in ["yes", "no"]:
+    logging.error("stat cache has to be yes/no")
+    return None
+  elif config.get("options", "stat cache").lower() == "yes":
+    setting["stat-cache"] = True
+
+  verify = _parse_verify_option(config.get("options", "stat cache verify", raw=True))
+  if verify is None:
+    logging.error("stat cache verify has to be a number of runs or a percentage (such as 5%)")
+    return None
+  setting["stat-cache-verify"] = verify
+  if verify > 0 and not setting["stat-cache"]:
+    logging.warning("stat cache verify has no effect unless stat cache is also enabled")
+
+  if not config.get("options", "hash workers").isdigit() or config.getint("options", "hash workers") < 1:
+    logging.error("hash workers has to be a number, 1 or more")
+    return None
+  setting["hash-workers"] = config.getint("options", "hash workers")
+
+  hashbuffer = _parse_size_option(config, "options", "hash buffer", "Hash buffer")
+  if hashbuffer is None:
+    return None
+  setting["hash-buffer"] = hashbuffer
+
+  if config.get("options", "stream hash").lower() not in ["yes", "no"]:
+    logging.error("stream hash has to be yes/no")
+    return None
+  elif config.get("options", "stream hash").lower() == "yes":
+    setting["stream-hash"] = True
+
+  if config.get("options", "state database").lower() not in ["json", "sqlite", "journal"]:
+    logging.error("state database has to be json/sqlite/journal")
+    return None
+  setting["state-database"] = config.get("options", "state database").lower()
+
+  journalsize = _parse_size_option(config, "options", "journal size", "Journal size")
+  if journalsize is None:
+    return None
+  setting["journal-size"] = journalsize
+
   if not config.get("security", "add parity").isdigit() or config.getint("security", "add parity") > 100 or config.getint("security", "add parity") < 0:
     logging.error("Parity ranges from 0 to 100, " + config.get("security", "add parity") + " is invalid")
     return None
@@ -476,8 +581,14 @@ def parse(filename, onlysecurity=False):
   if len(setting["exclude"]) == 0:
     setting["exclude"] = None
 
+  try:
+    compileExcludeRules()
+  except ValueError as e:
+    logging.error("%s", e)
+    return None
+
   # Lastly, check that required software is installed and available on the path
-  if which("tar") is None:
+  if not setting["stream-hash"] and which("tar") is None:
     logging.error("To create backups, you must have tar installed")
     return None
   if setting["parity"] > 0 and which("par2") is None:
@@ -567,10 +678,8 @@ def _parseExcludeRule(v):
       value = ""
     else:
       if compare == "<":
-        logging.error("\"Less than\" exclude rule can only have digits")
-      else:
-        logging.error("\"More than\" exclude rule can only have digits")
-      sys.exit(2)
+        raise ValueError("\"Less than\" exclude rule can only have digits")
+      raise ValueError("\"More than\" exclude rule can only have digits")
   else:
     if _rule_has_unescaped_trailing_star(value):
       if fromend or contain:
@@ -590,43 +699,286 @@ def _parseExcludeRule(v):
     "value": _rule_unescape(value),
   }
 
-def isExcluded(f):
-  if setting["exclude"] is None:
-    return False
+class _ContainsAutomaton:
+  """
+  Aho-Corasick automaton over the values of the contains rules, finds the
+  lowest rule index contained in a string with a single pass over it.
+  """
 
-  for v in setting["exclude"]:
-    ov = v
-    match = False
-    rule = _parseExcludeRule(v)
-
-    if rule["morethan"] is not None or rule["lessthan"] is not None:
-      # Expensive, we need to stat
-      i = os.stat(f)
-      if rule["morethan"] is not None and i.st_size > rule["morethan"]:
-        match = True
-      elif rule["lessthan"] is not None and i.st_size < rule["lessthan"]:
-        match = True
+  def __init__(self):
+    self.goto = [{}]
+    self.fail = [0]
+    self.first = [None]
+
+  def add(self, value, index):
+    state = 0
+    for ch in value:
+      nxt = self.goto[state].get(ch)
+      if nxt is None:
+        nxt = len(self.goto)
+        self.goto.append({})
+        self.fail.append(0)
+        self.first.append(None)
+        self.goto[state][ch] = nxt
+      state = nxt
+    if self.first[state] is None or index < self.first[state]:
+      self.first[state] = index
+
+  def build(self):
+    queue = collections.deque(self.goto[0].values())
+    while len(queue):
+      state = queue.popleft()
+      for ch, nxt in self.goto[state].items():
+        queue.append(nxt)
+        f = self.fail[state]
+        while f and ch not in self.goto[f]:
+          f = self.fail[f]
+        self.fail[nxt] = self.goto[f].get(ch, 0)
+        inherited = self.first[self.fail[nxt]]
+        if inherited is not None and (self.first[nxt] is None or inherited < self.first[nxt]):
+          self.first[nxt] = inherited
+
+  def search(self, text):
+    goto = self.goto
+    fail = self.fail
+    first = self.first
+    state = 0
+    result = first[0]
+    for ch in text:
+      while state and ch not in goto[state]:
+        state = fail[state]
+      state = goto[state].get(ch, 0)
+      found = first[state]
+      if found is not None and (result is None or found < result):
+        result = found
+    return result
+
+class _RuleIndex:
+  """
+  Exact, prefix, suffix and contains rules of one case mode, indexed so a
+  lookup doesn't need to try every rule. Prefix and suffix rules are
+  bucketed by length, so each distinct length costs one dict lookup.
+  """
+
+  def __init__(self):
+    self.exact = {}
+    self.prefix = {}
+    self.suffix = {}
+    self.contains = None
+    self.lowest = None
+
+  def _store(self, table, key, index):
+    if key not in table or index < table[key]:
+      table[key] = index
+    if self.lowest is None or index < self.lowest:
+      self.lowest = index
+
+  def add(self, rule, index):
+    value = rule["value"]
+    if rule["ignorecase"]:
+      value = value.casefold()
+
+    if rule["contain"]:
+      if self.contains is None:
+        self.contains = _ContainsAutomaton()
+      self.contains.add(value, index)
+      if self.lowest is None or index < self.lowest:
+        self.lowest = index
+    elif rule["fromend"]:
+      self._store(self.suffix.setdefault(len(value), {}), value, index)
+    elif rule["fromstart"]:
+      self._store(self.prefix.setdefault(len(value), {}), value, index)
     else:
-      fv = f
-      rv = rule["value"]
-      if rule["ignorecase"]:
-        fv = fv.casefold()
-        rv = rv.casefold()
-
-      if rule["contain"]:
-        match = rv in fv
-      elif rule["fromend"]:
-        match = fv.endswith(rv)
-      elif rule["fromstart"]:
-        match = fv.startswith(rv)
+      self._store(self.exact, value, index)
+
+  def build(self):
+    self.prefix = sorted(self.prefix.items())
+    self.suffix = sorted(self.suffix.items())
+    if self.contains is not None:
+      self.contains.build()
+
+  def lookup(self, text, best):
+    """Returns the lowest index of a rule matching text, if lower than best"""
+    if self.lowest is None or (best is not None and best < self.lowest):
+      return best
+
+    found = self.exact.get(text)
+    if found is not None and (best is None or found < best):
+      best = found
+
+    length = len(text)
+    for size, table in self.suffix:
+      if size > length:
+        break
+      found = table.get(text[length - size:])
+      if found is not None and (best is None or found < best):
+        best = found
+
+    return self.lookupCovering(text, best)
+
+  def lookupCovering(self, text, best):
+    """
+    Like lookup() but only with prefix and contains rules, which (when they
+    match text) also match anything starting with text.
+    """
+    if self.lowest is None or (best is not None and best < self.lowest):
+      return best
+
+    length = len(text)
+    for size, table in self.prefix:
+      if size > length:
+        break
+      found = table.get(text[:size])
+      if found is not None and (best is None or found < best):
+        best = found
+
+    if self.contains is not None:
+      found = self.contains.search(text)
+      if found is not None and (best is None or found < best):
+        best = found
+    return best
+
+class ExcludeMatcher:
+  """
+  The exclude rules parsed and indexed once. first() gives the index of the
+  first rule (in the order they were defined) that matches a file, same as
+  trying each rule in turn.
+  """
+
+  def __init__(self, rules):
+    self.source = rules
+    self.rules = list(rules)
+    self.parsed = [_parseExcludeRule(v) for v in self.rules]
+    self.plain = _RuleIndex()
+    self.folded = _RuleIndex()
+    self.sizes = []
+    # Invert rules which may match something in any directory, and the
+    # ones which only match paths starting with their value
+    self.openInvert = None
+    self.anchoredInvert = []
+
+    for index, rule in enumerate(self.parsed):
+      if rule["invert"]:
+        if rule["contain"] or rule["fromend"] or rule["morethan"] is not None or rule["lessthan"] is not None:
+          if self.openInvert is None:
+            self.openInvert = index
+        else:
+          value = rule["value"].casefold() if rule["ignorecase"] else rule["value"]
+          self.anchoredInvert.append((index, rule["ignorecase"], rule["fromstart"], value))
+
+      if rule["morethan"] is not None or rule["lessthan"] is not None:
+        self.sizes.append((index, rule["lessthan"], rule["morethan"]))
+      elif rule["ignorecase"]:
+        self.folded.add(rule, index)
       else:
-        match = fv == rv
-
-    if match:
-      if rule["invert"]: # Special case, it matches, so stop processing, but DON'T EXCLUDE IT
-        logging.debug("Rule \"%s\" matched \"%s\", not excluded", ov, f)
-        return False
-      else: # Normal case, matched, so should be excluded
-        logging.debug("Rule \"%s\" matched \"%s\", excluded", ov, f)
+        self.plain.add(rule, index)
+    self.plain.build()
+    self.folded.build()
+
+  def first(self, f, info=None):
+    best = self.plain.lookup(f, None)
+    if self.folded.lowest is not None:
+      best = self.folded.lookup(f.casefold(), best)
+
+    for index, lessthan, morethan in self.sizes:
+      if best is not None and best < index:
+        break
+      # Expensive, we need to stat (unless the caller already did)
+      if info is None:
+        info = os.stat(f)
+      elif isinstance(info, os.DirEntry):
+        info = info.stat()
+      if morethan is not None and info.st_size > morethan:
+        return index
+      if lessthan is not None and info.st_size < lessthan:
+        return index
+    return best
+
+  def canInclude(self, directory):
+    """
+    Returns False if every file below directory is certain to be excluded,
+    ie, a prefix or contains rule covers the directory itself and no earlier
+    ! rule could match anything below it.
+    """
+    below = directory if directory.endswith(os.sep) else directory + os.sep
+    folded = None
+    covering = self.plain.lookupCovering(below, None)
+    if self.folded.lowest is not None:
+      folded = below.casefold()
+      covering = self.folded.lookupCovering(folded, covering)
+
+    if covering is None or self.parsed[covering]["invert"]:
+      return True
+    if self.openInvert is not None and self.openInvert < covering:
+      return True
+
+    for index, ignorecase, fromstart, value in self.anchoredInvert:
+      if index > covering:
+        break
+      text = below
+      if ignorecase:
+        if folded is None:
+          folded = below.casefold()
+        text = folded
+      if value.startswith(text) and len(value) > len(text):
         return True
+      if fromstart and text.startswith(value):
+        return True
+    return False
+
+_excludeMatcher = None
+
+def compileExcludeRules():
+  """
+  Builds the matcher for the current exclude rules. Raises ValueError if
+  a rule is invalid.
+  """
+  global _excludeMatcher
+
+  _excludeMatcher = None
+  if setting["exclude"] is not None:
+    _excludeMatcher = ExcludeMatcher(setting["exclude"])
+  return _excludeMatcher
+
+def _currentExcludeMatcher():
+  # The rules may be replaced (or added to) after parse(), recompile if so
+  rules = setting["exclude"]
+  if _excludeMatcher is None or _excludeMatcher.source is not rules or len(_excludeMatcher.rules) != len(rules):
+    try:
+      return compileExcludeRules()
+    except ValueError as e:
+      logging.error("%s", e)
+      sys.exit(2)
+  return _excludeMatcher
+
+def canInclude(directory):
+  """
+  Tells if anything below directory may pass the exclude rules, when it
+  doesn't there's no need to look inside the directory at all.
+  """
+  if setting["exclude"] is None:
+    return True
+  if _currentExcludeMatcher().canInclude(directory):
+    return True
+  logging.debug("Exclude rules match everything in \"%s\", skipping it", directory)
   return False
+
+def isExcluded(f, info=None):
+  """
+  Checks f against the exclude rules. info can be the os.stat() result or
+  the os.DirEntry of f, size rules then use it instead of calling stat again.
+  """
+  if setting["exclude"] is None:
+    return False
+
+  matcher = _currentExcludeMatcher()
+  index = matcher.first(f, info)
+  if index is None:
+    return False
+
+  if matcher.parsed[index]["invert"]: # Special case, it matches, so stop processing, but DON'T EXCLUDE IT
+    logging.debug("Rule \"%s\" matched \"%s\", not excluded", matcher.rules[index], f)
+    return False
+  # Normal case, matched, so should be excluded
+  logging.debug("Rule \"%s\" matched \"%s\", excluded", matcher.rules[index], f)
+  return True
@@ -0,0 +1,223 @@
+"""
+Compact in-memory form of the "dataset" entries of the state (see
+DATABASE.md). With millions of files the plain JSON dicts, checksum strings
+and lists of backup names cost hundreds of bytes each, a FileRecord keeps
+the same information in a fraction of that while still behaving like the
+dict it replaces.
+"""
+import re
+import array
+import struct
+import collections.abc
+
+# Backup names are interned, records refer to them by their index here
+_names = []
+_ids = {}
+
+def _intern(name):
+  i = _ids.get(name)
+  if i is None:
+    i = _ids[name] = len(_names)
+    _names.append(name)
+  return i
+
+# Checksums ("<hex>:<algorithm>") are kept as a tag byte for the algorithm
+# followed by the raw digest, tag 0 holds anything else as it was
+ALGORITHMS = ("sha1", "sha256", "sha512", "md5", "sha224", "sha384")
+_TAGS = {name: bytes((i + 1,)) for i, name in enumerate(ALGORITHMS)}
+_HEX = re.compile(r"[0-9a-f]+")
+
+def packChecksum(value):
+  digest, _, name = value.rpartition(":")
+  tag = _TAGS.get(name)
+  if tag is not None and len(digest) % 2 == 0 and _HEX.fullmatch(digest):
+    return tag + bytes.fromhex(digest)
+  return b"\x00" + value.encode("utf-8")
+
+def unpackChecksum(value):
+  if value[0] == 0:
+    return value[1:].decode("utf-8")
+  return value[1:].hex() + ":" + ALGORITHMS[value[0] - 1]
+
+# The stat signature of fileutils.statSignature()
+_STAT = struct.Struct("<qqqQQ")
+
+def _packStat(value):
+  try:
+    return _STAT.pack(*value)
+  except struct.error:
+    return list(value)
+
+def _unpackStat(value):
+  if isinstance(value, bytes):
+    return list(_STAT.unpack(value))
+  return list(value)
+
+# Shared by all records without any backups in a list, replaced on change
+_EMPTY = ()
+
+def _packNames(names):
+  if not names:
+    return _EMPTY
+  return array.array("I", [_intern(n) for n in names])
+
+class BackupList(collections.abc.MutableSequence):
+  """The "memberof" or "deleted" list of a record, changes go to the record."""
+  __slots__ = ("_record", "_slot")
+
+  def __init__(self, record, slot):
+    self._record = record
+    self._slot = slot
+
+  def _get(self):
+    return getattr(self._record, self._slot)
+
+  def _mutable(self):
+    ids = self._get()
+    if ids is _EMPTY:
+      ids = array.array("I")
+      setattr(self._record, self._slot, ids)
+    return ids
+
+  def __len__(self):
+    return len(self._get())
+
+  def __iter__(self):
+    for i in self._get():
+      yield _names[i]
+
+  def __getitem__(self, index):
+    if isinstance(index, slice):
+      return [_names[i] for i in self._get()[index]]
+    return _names[self._get()[index]]
+
+  def __setitem__(self, index, value):
+    if isinstance(index, slice):
+      self._mutable()[index] = array.array("I", [_intern(n) for n in value])
+    else:
+      self._mutable()[index] = _intern(value)
+
+  def __delitem__(self, index):
+    del self._mutable()[index]
+
+  def insert(self, index, value):
+    self._mutable().insert(index, _intern(value))
+
+  def sort(self, key=None, reverse=False):
+    names = sorted(self, key=key, reverse=reverse)
+    setattr(self._record, self._slot, _packNames(names))
+
+  def __eq__(self, other):
+    if isinstance(other, (list, tuple, BackupList)):
+      return list(self) == list(other)
+    return NotImplemented
+
+  def __repr__(self):
+    return repr(list(self))
+
+# Keys every record knows how to store compactly
+FIELDS = ("checksum", "memberof", "deleted", "stat")
+
+class FileRecord(collections.abc.MutableMapping):
+  """A dataset entry, behaves like {"checksum", "memberof", "deleted", "stat"}."""
+  __slots__ = ("_checksum", "_memberof", "_deleted", "_stat", "_extra")
+
+  def __init__(self, item):
+    self._checksum = packChecksum(item.get("checksum", ""))
+    self._memberof = _packNames(item.get("memberof"))
+    self._deleted = _packNames(item["deleted"]) if "deleted" in item else None
+    self._stat = _packStat(item["stat"]) if "stat" in item else None
+    self._extra = None
+    if len(item) > 2 + (self._deleted is not None) + (self._stat is not None):
+      for key, value in item.items():
+        if key not in FIELDS:
+          self[key] = value
+
+  def plain(self):
+    item = {
+      "checksum": unpackChecksum(self._checksum),
+      "memberof": [_names[i] for i in self._memberof],
+    }
+    if self._deleted is not None:
+      item["deleted"] = [_names[i] for i in self._deleted]
+    if self._stat is not None:
+      item["stat"] = _unpackStat(self._stat)
+    if self._extra is not None:
+      item.update(self._extra)
+    return item
+
+  def __getitem__(self, key):
+    if key == "checksum":
+      return unpackChecksum(self._checksum)
+    if key == "memberof":
+      return BackupList(self, "_memberof")
+    if key == "deleted" and self._deleted is not None:
+      return BackupList(self, "_deleted")
+    if key == "stat" and self._stat is not None:
+      return _unpackStat(self._stat)
+    if self._extra is not None and key in self._extra:
+      return self._extra[key]
+    raise KeyError(key)
+
+  def __setitem__(self, key, value):
+    if key == "checksum":
+      self._checksum = packChecksum(value)
+    elif key == "memberof":
+      self._memberof = _packNames(value)
+    elif key == "deleted":
+      self._deleted = _packNames(value)
+    elif key == "stat":
+      self._stat = _packStat(value)
+    else:
+      if self._extra is None:
+        self._extra = {}
+      self._extra[key] = value
+
+  def __delitem__(self, key):
+    if key == "deleted" and self._deleted is not None:
+      self._deleted = None
+    elif key == "stat" and self._stat is not None:
+      self._stat = None
+    elif self._extra is not None and key in self._extra:
+      del self._extra[key]
+    else:
+      raise KeyError(key)
+
+  def __iter__(self):
+    yield "checksum"
+    yield "memberof"
+    if self._deleted is not None:
+      yield "deleted"
+    if self._stat is not None:
+      yield "stat"
+    if self._extra is not None:
+      yield from self._extra
+
+  def __len__(self):
+    return sum(1 for _ in self)
+
+  def __repr__(self):
+    return repr(self.plain())
+
+def compact(item):
+  """Returns item as a FileRecord."""
+  if isinstance(item, FileRecord):
+    return item
+  return FileRecord(item)
+
+def plain(obj):
+  """
+  Turns a FileRecord (or one of its lists) back into what JSON holds, meant
+  as the default= of json.dumps().
+  """
+  if isinstance(obj, FileRecord):
+    return obj.plain()
+  if isinstance(obj, BackupList):
+    return list(obj)
+  raise TypeError("Object of type %s is not JSON serializable" % type(obj).__name__)
+
+def objectHook(obj):
+  """For json.load(), turns dataset entries into FileRecords as they're read."""
+  if "memberof" in obj and "checksum" in obj:
+    return FileRecord(obj)
+  return obj
@@ -0,0 +1,237 @@
+"""
+Digests of prepared artifacts. Every digest needed (sha1 for the filelist,
+sha256, Glacier style SHA-256 tree hashes) is computed in a single pass,
+either while the artifact is written or the first time one is asked for,
+and kept in a sidecar so the file isn't read again for the next one.
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+
+# Size of the leaves of the tree, fixed by Glacier
+LEAF_SIZE = 1048576
+
+def _combine(digests):
+  """Reduces a list of digests to the digest at the top of their tree."""
+  while len(digests) > 1:
+    paired = [hashlib.sha256(a + b).digest() for a, b in zip(digests[::2], digests[1::2])]
+    if len(digests) % 2:
+      paired.append(digests[-1])
+    digests = paired
+  return digests[0]
+
+class TreeHash:
+  """
+  Accumulates data, keeping the digest of every 1 MiB leaf so the tree hash
+  of the whole as well as of any power of two multiple of 1 MiB sized parts
+  can be produced afterwards.
+  """
+
+  def __init__(self):
+    self.leaves = []
+    self.size = 0
+    self.pending = bytearray()
+    self.finished = False
+
+  def update(self, data):
+    view = memoryview(data)
+    self.size += len(view)
+    if self.pending:
+      take = min(LEAF_SIZE - len(self.pending), len(view))
+      self.pending += view[:take]
+      view = view[take:]
+      if len(self.pending) < LEAF_SIZE:
+        return
+      self.leaves.append(hashlib.sha256(self.pending).digest())
+      self.pending = bytearray()
+
+    while len(view) >= LEAF_SIZE:
+      self.leaves.append(hashlib.sha256(view[:LEAF_SIZE]).digest())
+      view = view[LEAF_SIZE:]
+    if len(view):
+      self.pending += view
+
+  def finish(self):
+    """Hashes the last (partial) leaf, no more data may be added after this."""
+    if self.finished:
+      return
+    if self.pending or not self.leaves:
+      self.leaves.append(hashlib.sha256(self.pending).digest())
+      self.pending = bytearray()
+    self.finished = True
+
+  def part_hashes(self, part_size):
+    """Returns the hex tree hash of each part, part_size being a power of two multiple of LEAF_SIZE."""
+    self.finish()
+    count = part_size // LEAF_SIZE
+    return [_combine(self.leaves[i:i + count]).hex() for i in range(0, len(self.leaves), count)]
+
+  def final(self):
+    """Returns the hex tree hash of all data."""
+    self.finish()
+    return _combine(self.leaves).hex()
+
+  def serialize(self):
+    self.finish()
+    return b"".join(self.leaves).hex()
+
+  @classmethod
+  def deserialize(cls, size, value):
+    tree = cls()
+    raw = bytes.fromhex(value)
+    tree.leaves = [raw[i:i + 32] for i in range(0, len(raw), 32)]
+    tree.size = size
+    tree.finished = True
+    return tree
+
+# Digests which can be asked for, "tree" being a TreeHash, the others hex
+KINDS = ("sha1", "sha256", "tree")
+
+class Digester:
+  """Feeds data to every requested kind of digest at once."""
+
+  def __init__(self, kinds):
+    self.hashes = {k: hashlib.new(k) for k in kinds if k != "tree"}
+    self.tree = TreeHash() if "tree" in kinds else None
+    self.size = 0
+
+  def update(self, data):
+    for h in self.hashes.values():
+      h.update(data)
+    if self.tree is not None:
+      self.tree.update(data)
+    self.size += len(data)
+
+  def result(self):
+    digests = {k: h.hexdigest() for k, h in self.hashes.items()}
+    if self.tree is not None:
+      self.tree.finish()
+      digests["tree"] = self.tree
+    return digests
+
+# Kinds of digest computed whenever a file is hashed
+_required = set()
+# Digests by absolute path, {"size", "mtime", "digests"}
+_cache = {}
+_cache_file = None
+# Whether _cache holds digests the sidecar doesn't
+_dirty = False
+# A lock per path, so a file is only read by one thread at a time
+_guards = {}
+_lock = threading.Lock()
+
+def require(*kinds):
+  """Asks for these kinds of digest to be computed for every artifact."""
+  for kind in kinds:
+    if kind not in KINDS:
+      raise ValueError("Unknown digest %s" % kind)
+    _required.add(kind)
+
+def required():
+  return set(_required)
+
+def configure(filename):
+  """
+  Sets the sidecar where digests are kept between runs (None to only keep
+  them in memory), loading what it holds for files which still exist.
+  """
+  global _cache_file, _dirty
+  with _lock:
+    _cache.clear()
+    _guards.clear()
+    _cache_file = filename
+    _dirty = False
+    if filename is None or not os.path.exists(filename):
+      return
+    try:
+      with open(filename, "r", encoding="utf-8") as fp:
+        saved = json.load(fp)
+    except (OSError, ValueError):
+      logging.warning("Ignoring unreadable digest cache %s", filename)
+      return
+    for path, entry in saved.items():
+      if not os.path.exists(path):
+        continue
+      if "tree" in entry["digests"]:
+        entry["digests"]["tree"] = TreeHash.deserialize(entry["size"], entry["digests"]["tree"])
+      _cache[path] = entry
+
+def _save():
+  """Must be called with _lock held."""
+  if _cache_file is None:
+    return
+  saved = {}
+  for path, entry in list(_cache.items()):
+    if not os.path.exists(path):
+      del _cache[path]
+      continue
+    digests = dict(entry["digests"])
+    if "tree" in digests:
+      digests["tree"] = digests["tree"].serialize()
+    saved[path] = {"size": entry["size"], "mtime": entry["mtime"], "digests": digests}
+  with open(_cache_file + "_tmp", "w", encoding="utf-8") as fp:
+    json.dump(saved, fp)
+  os.replace(_cache_file + "_tmp", _cache_file)
+
+def save():
+  """
+  Writes the digests computed since the last call to the sidecar. Called
+  once a slice has been uploaded, rather than for every digest, since all
+  of them are written each time.
+  """
+  global _dirty
+  with _lock:
+    if _dirty:
+      _save()
+      _dirty = False
+
+def _store(path, info, digests):
+  global _dirty
+  key = os.path.abspath(path)
+  with _lock:
+    entry = _cache.get(key)
+    if entry is None or (entry["size"], entry["mtime"]) != (info.st_size, info.st_mtime_ns):
+      entry = {"size": info.st_size, "mtime": info.st_mtime_ns, "digests": {}}
+      _cache[key] = entry
+    entry["digests"].update(digests)
+    _dirty = True
+
+def _guard(key):
+  with _lock:
+    return _guards.setdefault(key, threading.Lock())
+
+def record(path, digester):
+  """Stores the digests of a file which was fed to digester while written."""
+  _store(path, os.stat(path), digester.result())
+
+def get(path, kind):
+  """
+  Returns the digest of path, reading the file (once, computing all the
+  required kinds of digest missing) only if it isn't known yet.
+  """
+  key = os.path.abspath(path)
+  info = os.stat(path)
+  # Another thread asking for the same file waits for this one's digests
+  with _guard(key):
+    with _lock:
+      entry = _cache.get(key)
+    known = {}
+    if entry is not None and (entry["size"], entry["mtime"]) == (info.st_size, info.st_mtime_ns):
+      known = entry["digests"]
+    if kind in known:
+      return known[kind]
+
+    digester = Digester((_required | {kind}) - set(known))
+    with open(path, "rb") as fp:
+      while True:
+        data = fp.read(LEAF_SIZE)
+        if not data:
+          break
+        digester.update(data)
+    digests = digester.result()
+    after = os.stat(path)
+    if (after.st_size, after.st_mtime_ns) == (info.st_size, info.st_mtime_ns):
+      _store(path, info, digests)
+  return digests[kind]
@@ -1,10 +1,15 @@
 import os.path
 import os
+import collections
 import hashlib
+import tarfile
+import zlib
 import shutil
 import logging
 from subprocess import Popen, PIPE
 
+from . import digest
+
 def copy(src, dst):
   try:
     shutil.copy(src, dst)
@@ -24,6 +29,43 @@ def deleteTree(tree, include_self=False):
   if include_self:
     os.rmdir(tree)
 
+def walkTree(top):
+  """
+  Works like os.walk() (top-down, symlinked directories are listed but not
+  followed and unreadable directories are skipped) except that files are
+  yielded as os.DirEntry objects, so the stat they cache can be reused.
+  Just like os.walk(), dirs can be pruned in place to skip directories.
+  """
+  stack = [top]
+  while len(stack):
+    root = stack.pop()
+    dirs = []
+    files = []
+    links = set()
+    try:
+      with os.scandir(root) as it:
+        for entry in it:
+          try:
+            isdir = entry.is_dir()
+          except OSError:
+            isdir = False
+          if not isdir:
+            files.append(entry)
+            continue
+          dirs.append(entry.name)
+          try:
+            if entry.is_symlink():
+              links.add(entry.name)
+          except OSError:
+            pass
+    except OSError:
+      continue
+
+    yield root, dirs, files
+    for name in reversed(dirs):
+      if name not in links:
+        stack.append(os.path.join(root, name))
+
 def generateParity(filename, level):
   if level == 0:
     return False
@@ -54,16 +96,21 @@ def repairParity(filename):
       os.unlink(filename + '.1')
   return p.returncode == 0
 
-def hashFile(file, shatype, includeType=False, progress_callback=None):
-  """Hash file with optional progress_callback(bytes_done_this_file, total_this_file)."""
+def hashFile(file, shatype, includeType=False, progress_callback=None, chunk_size=32768, sampler=None):
+  """
+  Hash file with optional progress_callback(bytes_done_this_file, total_this_file).
+  If given, sampler is fed the data as it's read (see CompressionSampler).
+  """
   sha = hashlib.new(shatype)
   total = os.path.getsize(file) if progress_callback is not None else None
   if progress_callback is not None and total is not None:
     progress_callback(0, total)
   bytes_read = 0
   with open(file, 'rb') as fp:
-    for chunk in iter(lambda: fp.read(32768), b''):
+    for chunk in iter(lambda: fp.read(chunk_size), b''):
       sha.update(chunk)
+      if sampler is not None:
+        sampler.feed(chunk)
       bytes_read += len(chunk)
       if progress_callback is not None and total is not None:
         progress_callback(bytes_read, total)
@@ -71,6 +118,137 @@ def hashFile(file, shatype, includeType=False, progress_callback=None):
     return sha.hexdigest() + ":" + shatype
   return sha.hexdigest()
 
+# Compressibility is estimated from up to SAMPLE_BLOCKS blocks of
+# SAMPLE_BLOCK_SIZE bytes, spread evenly across the file.
+SAMPLE_BLOCKS = 8
+SAMPLE_BLOCK_SIZE = 65536
+
+class CompressionSampler:
+  """
+  Estimates how well a file compresses by running zlib (level 1) over a few
+  sampled blocks. Either feed() it the whole file in order (as hashFile()
+  does) and it picks out the blocks itself, or add() blocks directly.
+  """
+
+  def __init__(self, size):
+    self.blocks = min(SAMPLE_BLOCKS, size // SAMPLE_BLOCK_SIZE)
+    if self.blocks <= 1:
+      self.offsets = collections.deque([0])
+    else:
+      self.offsets = collections.deque(
+        (size - SAMPLE_BLOCK_SIZE) * i // (self.blocks - 1) for i in range(self.blocks))
+    self.position = 0
+    self.pending = None
+    self.sampled = 0
+    self.compressed = 0
+
+  def add(self, block):
+    if len(block):
+      self.sampled += len(block)
+      self.compressed += len(zlib.compress(block, 1))
+
+  def feed(self, data):
+    offset = 0
+    while offset < len(data):
+      if self.pending is None:
+        if not self.offsets or self.offsets[0] >= self.position + len(data):
+          break
+        offset = max(offset, self.offsets.popleft() - self.position)
+        self.pending = b""
+      block = data[offset:offset + SAMPLE_BLOCK_SIZE - len(self.pending)]
+      self.pending += block
+      offset += len(block)
+      if len(self.pending) == SAMPLE_BLOCK_SIZE:
+        self.add(self.pending)
+        self.pending = None
+    self.position += len(data)
+
+  def ratio(self):
+    """Estimated compressed size as a fraction of the original, None if nothing was sampled."""
+    if self.pending is not None:
+      self.add(self.pending)
+      self.pending = None
+    if self.sampled == 0:
+      return None
+    return min(1.0, self.compressed / self.sampled)
+
+def sampleFile(filename, size):
+  """Estimates the compression ratio of a file by reading just the sampled blocks."""
+  sampler = CompressionSampler(size)
+  with open(filename, 'rb') as fp:
+    for offset in sampler.offsets:
+      fp.seek(offset)
+      sampler.add(fp.read(SAMPLE_BLOCK_SIZE))
+  sampler.offsets.clear()
+  return sampler.ratio()
+
+class _HashingReader:
+  """
+  Hands tarfile the first size bytes of a file while hashing them. If the
+  file turns out to be shorter (or fails to read), the rest is padded with
+  zeros like GNU tar does, missing tells how much was made up.
+  """
+
+  def __init__(self, fp, shatype, size):
+    self.fp = fp
+    self.sha = hashlib.new(shatype)
+    self.remaining = size
+    self.missing = 0
+    self.error = None
+
+  def read(self, size):
+    size = min(size, self.remaining)
+    data = b""
+    if self.missing == 0:
+      try:
+        data = self.fp.read(size)
+      except OSError as e:
+        self.error = e
+    self.sha.update(data)
+    if len(data) < size:
+      self.missing += size - len(data)
+      data += bytes(size - len(data))
+    self.remaining -= size
+    return data
+
+def writeTarStream(out, filenames, shatype, chunk_size=1048576):
+  """
+  Writes the files to out as a tar stream (following symlinks, like tar
+  --dereference) and hashes each file with the same bytes that went into
+  the archive. Returns the checksums (including type) and a list of files
+  which couldn't be read or changed size while being archived, as dicts
+  with path and reason. Errors writing to out are raised as OSError.
+  """
+  checksums = {}
+  unavailable = []
+  tar = tarfile.open(fileobj=out, mode="w|", format=tarfile.GNU_FORMAT, bufsize=chunk_size)
+  tar.copybufsize = chunk_size
+  for filename in filenames:
+    try:
+      fp = open(filename, "rb")
+    except OSError as e:
+      unavailable.append({"path": os.path.normpath(filename), "reason": e.strerror or str(e)})
+      continue
+    with fp:
+      try:
+        info = tar.gettarinfo(arcname=filename, fileobj=fp)
+      except OSError as e:
+        unavailable.append({"path": os.path.normpath(filename), "reason": e.strerror or str(e)})
+        continue
+      reader = _HashingReader(fp, shatype, info.size)
+      tar.addfile(info, reader)
+    checksums[filename] = reader.sha.hexdigest() + ":" + shatype
+    if reader.error is not None:
+      unavailable.append({"path": os.path.normpath(filename), "reason": reader.error.strerror or str(reader.error)})
+    elif reader.missing:
+      unavailable.append({"path": os.path.normpath(filename), "reason": "File shrank by %d bytes" % reader.missing})
+  tar.close()
+  return checksums, unavailable
+
+def statSignature(info):
+  """Return the metadata tuple used to detect unchanged files without hashing them."""
+  return [info.st_size, info.st_mtime_ns, info.st_ctime_ns, info.st_ino, info.st_dev]
+
 def hashChanged(filename, oldChecksum, newChecksum):
   (hashNew, typeNew) = newChecksum.split(':', 2)
 
@@ -112,7 +290,71 @@ def generateFilelist(path, output):
   files = sorted(os.listdir(path))
   with open(output, 'w', encoding="utf-8") as lst:
     for f in files:
-      lst.write('{}  {}\n'.format(hashFile(os.path.join(path, f), 'sha1'), f))
+      lst.write('{}  {}\n'.format(digest.get(os.path.join(path, f), 'sha1'), f))
+
+
+# Compressors usable for the archive stream. Candidates are tried in order,
+# each with the arguments needed to use all cores, levels is the range
+# accepted by the tool and decompress is None when tarfile reads the format
+# on its own. Speed is a rough figure of bytes compressed per CPU-second at
+# the default level.
+COMPRESSORS = {
+  "bzip2": {
+    "suffix": ".bz2",
+    "candidates": (("lbzip2", []), ("pbzip2", []), ("bzip2", [])),
+    "levels": (1, 9),
+    "speed": 15728640,
+    "decompress": None,
+  },
+  "zstd": {
+    "suffix": ".zst",
+    "candidates": (("zstd", ["-T0", "-q"]),),
+    "levels": (1, 19),
+    "speed": 209715200,
+    "decompress": ["zstd", "-d", "-c", "-q"],
+  },
+  "xz": {
+    "suffix": ".xz",
+    "candidates": (("xz", ["-T0"]),),
+    "levels": (0, 9),
+    "speed": 3145728,
+    "decompress": None,
+  },
+  "lz4": {
+    "suffix": ".lz4",
+    "candidates": (("lz4", ["-q"]),),
+    "levels": (1, 12),
+    "speed": 524288000,
+    "decompress": ["lz4", "-d", "-c", "-q"],
+  },
+}
+
+
+def select_compressor(name, level=None, which_func=None):
+  """
+  Return the command (as a list) compressing stdin to stdout using the
+  first available tool of the named compressor, or None if none is found.
+  """
+  if which_func is None:
+    which_func = shutil.which
+
+  for candidate, args in COMPRESSORS[name]["candidates"]:
+    resolved = which_func(candidate)
+    if resolved:
+      cmd = [resolved] + args
+      if level is not None:
+        cmd.append("-%d" % level)
+      return cmd + ["-c"]
+
+  return None
+
+
+def compressorForArchive(filename):
+  """Return the name of the compressor used for filename, None if uncompressed."""
+  for name, details in COMPRESSORS.items():
+    if filename.endswith(".tar" + details["suffix"]):
+      return name
+  return None
 
 
 def select_bzip2_compressor(which_func=None):
@@ -0,0 +1,79 @@
+import collections
+import concurrent.futures
+
+from . import fileutils
+
+# Reads done by the workers, larger than hashFile()'s default since each
+# worker keeps at most one chunk around at a time.
+CHUNK_SIZE = 1048576
+
+# Upper limit of queued entries per worker, keeps the queue short when
+# scanning lots of tiny (or cached) files.
+PENDING_PER_WORKER = 256
+
+class HashPool:
+  """
+  Hashes files on a pool of worker threads while handing the results back
+  in the order they were submitted, so the caller sees exactly what a serial
+  scan would. The bytes of files queued but not yet handed back are capped by
+  budget, once reached results() blocks on the oldest entry.
+
+  With one worker nothing is hashed ahead of time, the checksum is computed
+  when the caller asks for it (ie, same as calling hashFile() directly).
+  """
+
+  def __init__(self, shatype, workers=1, budget=0):
+    self.shatype = shatype
+    self.workers = max(1, workers)
+    self.budget = budget
+    self.inflight = 0
+    self.pending = collections.deque()
+    self.executor = None
+    if self.workers > 1:
+      self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="iceshelf-hash")
+
+  def submit(self, context, filename=None, size=0, checksum=None, sampler=None):
+    """
+    Queue an entry. Without a filename the entry carries the given checksum
+    (or None) and is handed back as is, keeping its place in the order.
+    A sampler is fed the file data while it is hashed.
+    """
+    if filename is None:
+      self.pending.append((context, None, lambda: checksum, 0))
+    elif self.executor is None:
+      self.pending.append((context, None, lambda: fileutils.hashFile(filename, self.shatype, True, sampler=sampler), 0))
+    else:
+      future = self.executor.submit(fileutils.hashFile, filename, self.shatype, True, None, CHUNK_SIZE, sampler)
+      self.pending.append((context, future, future.result, size))
+      self.inflight += size
+
+  def _full(self):
+    if len(self.pending) >= self.workers * PENDING_PER_WORKER:
+      return True
+    return self.budget > 0 and self.inflight > self.budget
+
+  def results(self, wait=False):
+    """
+    Yields (context, checksum) for finished entries in submission order,
+    where checksum is a callable returning the checksum (re-raising any
+    error from hashing). Stops at the first unfinished entry unless told
+    to wait or the queue is over budget.
+    """
+    while len(self.pending):
+      context, future, checksum, size = self.pending[0]
+      if future is not None and not future.done() and not wait and not self._full():
+        return
+      self.pending.popleft()
+      self.inflight -= size
+      yield context, checksum
+
+  def close(self):
+    """Drops anything still queued and stops the workers."""
+    for _context, future, _checksum, _size in self.pending:
+      if future is not None:
+        future.cancel()
+    self.pending.clear()
+    self.inflight = 0
+    if self.executor is not None:
+      self.executor.shutdown(wait=True)
+      self.executor = None
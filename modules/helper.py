@@ -19,6 +19,30 @@ def formatSize(size):
 def formatSpeed(bps):
   return formatNumber(bps, [" bytes/s", "K/s", "M/s", "G/s", "T/s"])
 
+SIZE_UNITS = {
+  'k': 1024,
+  'm': 1048576,
+  'g': 1073741824,
+  't': 1099511627776,
+}
+
+def parseSize(value):
+  """
+  Parses a size which may be suffixed with K, M, G or T (powers of 1024).
+  Blank means zero, None is returned if the value can't be parsed.
+  """
+  value = value.strip()
+  if value == "":
+    return 0
+  if value.isdigit():
+    return int(value)
+
+  unit = value.lower()[-1:]
+  number = value[:-1]
+  if not number.isdigit() or unit not in SIZE_UNITS:
+    return None
+  return int(number, 10) * SIZE_UNITS[unit]
+
 def formatNumber(number, units):
   i = 0
   while number >= 1024 and i < len(units):
@@ -0,0 +1,162 @@
+"""
+Reads a JSON object a piece at a time instead of all at once. The state and
+the manifests are one big object whose few large members ("dataset",
+"backups", ...) are objects themselves, those can be walked one entry at a
+time so neither the text of the file nor (unless kept) the entries already
+seen are ever held in memory at once.
+"""
+import re
+import json
+import codecs
+
+# Characters read from the file at a time
+CHUNK = 1 << 20
+
+_SPACE = re.compile(r"[ \t\n\r]*")
+_COLON = re.compile(r"[ \t\n\r]*:[ \t\n\r]*")
+_NEXT = re.compile(r"[ \t\n\r]*([,}])[ \t\n\r]*")
+
+class _Reader:
+  def __init__(self, fp, object_hook, chunk):
+    self.fp = fp
+    self.chunk = chunk
+    self.buf = ""
+    self.pos = 0
+    self.eof = False
+    self.utf8 = codecs.getincrementaldecoder("utf-8-sig")()
+    self.decoder = json.JSONDecoder(object_hook=object_hook)
+
+  def fill(self, size):
+    """Reads at least size more characters, drops what's already parsed."""
+    data = self.fp.read(max(size, self.chunk))
+    if isinstance(data, bytes):
+      data = self.utf8.decode(data, not data)
+    if not data:
+      self.eof = True
+    self.buf = self.buf[self.pos:] + data
+    self.pos = 0
+
+  def peek(self):
+    """The next character which isn't whitespace, empty at the end of the file."""
+    while True:
+      self.pos = _SPACE.match(self.buf, self.pos).end()
+      if self.pos < len(self.buf) or self.eof:
+        return self.buf[self.pos:self.pos + 1]
+      self.fill(self.chunk)
+
+  def expect(self, chars):
+    c = self.peek()
+    if not c or c not in chars:
+      raise json.JSONDecodeError("Expecting one of %r" % chars, self.buf, self.pos)
+    self.pos += 1
+    return c
+
+  def value(self):
+    """Decodes the next value, reading as much of the file as it takes."""
+    self.peek()
+    while True:
+      try:
+        value, end = self.decoder.raw_decode(self.buf, self.pos)
+        # A number cut off by the end of the buffer may go on
+        if end < len(self.buf) or self.eof:
+          self.pos = end
+          return value
+      except json.JSONDecodeError:
+        if self.eof:
+          raise
+      # Grow geometrically so a large value isn't decoded over and over
+      self.fill(len(self.buf) - self.pos)
+
+  def members(self):
+    """Yields the keys of the object just opened, the caller reads each value."""
+    if self.peek() == "}":
+      self.pos += 1
+      return
+    while True:
+      if self.peek() != '"':
+        raise json.JSONDecodeError("Expecting property name enclosed in double quotes", self.buf, self.pos)
+      key = self.value()
+      self.expect(":")
+      yield key
+      if self.expect(",}") == "}":
+        return
+
+  def entry(self):
+    """Reads a member and the "," or "}" after it, as far into the file as it takes."""
+    if self.peek() != '"':
+      raise json.JSONDecodeError("Expecting property name enclosed in double quotes", self.buf, self.pos)
+    key = self.value()
+    self.expect(":")
+    value = self.value()
+    return key, value, self.expect(",}")
+
+  def entries(self):
+    """
+    Yields the (key, value) members of the object just opened. Those which
+    are whole in the buffer are decoded in one go, the few cut off by its
+    end go through entry().
+    """
+    if self.peek() == "}":
+      self.pos += 1
+      return
+    scan = self.decoder.scan_once
+    while True:
+      buf = self.buf
+      try:
+        if buf[self.pos] != '"':
+          raise IndexError
+        key, end = json.decoder.scanstring(buf, self.pos + 1)
+        value, end = scan(buf, _COLON.match(buf, end).end())
+        m = _NEXT.match(buf, end)
+      except (IndexError, AttributeError, StopIteration, json.JSONDecodeError):
+        m = None
+      if m is None:
+        key, value, end = self.entry()
+        self.peek()
+      else:
+        self.pos = m.end()
+        end = m.group(1)
+      yield key, value
+      if end == "}":
+        return
+
+def iterate(fp, streamed=(), object_hook=None, chunk=CHUNK):
+  """
+  Walks the JSON object in fp (opened as text or binary), yielding
+  (key, None, value) for each of its members. A member named in streamed
+  is yielded as (key, None, {}) followed by (key, name, value) for each of
+  its own members instead. object_hook is used like json.load() does, but
+  not on the top level object or the streamed ones.
+  """
+  reader = _Reader(fp, object_hook, chunk)
+  reader.expect("{")
+  for key in reader.members():
+    if key in streamed and reader.peek() == "{":
+      reader.pos += 1
+      yield key, None, {}
+      for name, value in reader.entries():
+        yield key, name, value
+    else:
+      yield key, None, reader.value()
+  if reader.peek():
+    raise json.JSONDecodeError("Extra data", reader.buf, reader.pos)
+
+def load(fp, streamed=(), object_hook=None, chunk=CHUNK):
+  """
+  Same as json.load() for a file holding an object, except that it's read
+  a member (or a member of the streamed ones) at a time.
+  """
+  data = {}
+  containers = []
+  for key, name, value in iterate(fp, streamed, object_hook, chunk):
+    if name is None:
+      data[key] = value
+      if key in streamed and value == {}:
+        containers.append(key)
+    else:
+      data[key][name] = value
+  if object_hook is not None:
+    for key in containers:
+      data[key] = object_hook(data[key])
+    data = object_hook(data)
+  return data
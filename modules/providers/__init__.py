@@ -1,12 +1,21 @@
+import os
+import json
 import shutil
 import logging
+import threading
 
 class BackupProvider:
     """Base class for backup providers."""
 
     name = 'provider'
 
-    def __init__(self, **options):
+    # Kinds of digest (see modules.digest) the provider needs of the files
+    # it uploads, computed once while (or after) they are created
+    digests = ()
+
+    def __init__(self, state_dir=None, **options):
+        # Directory where a provider may keep state between runs
+        self.state_dir = state_dir
         self.options = options
 
     def verify(self):
@@ -29,6 +38,53 @@ class BackupProvider:
         raise NotImplementedError
 
 
+class UploadState:
+    """
+    JSON sidecar in the state dir tracking multipart uploads, so a later
+    run can resume them. Entries are keyed by file name and saved when an
+    upload starts or ends, the parts uploaded are asked of the service
+    instead. It's safe to use from several upload threads.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = {}
+        if not os.path.exists(path):
+            return
+        try:
+            with open(path, 'r', encoding='utf-8') as fp:
+                self.entries = json.load(fp)
+        except (OSError, ValueError):
+            logging.warning('Ignoring unreadable upload state %s', path)
+
+    def get(self, key):
+        return self.entries.get(key)
+
+    def keys(self):
+        return list(self.entries)
+
+    def start(self, key, entry):
+        with self.lock:
+            self.entries[key] = entry
+            self._save()
+
+    def pop(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            self._save()
+        return entry
+
+    def _save(self):
+        if not self.entries:
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            return
+        with open(self.path + '_tmp', 'w', encoding='utf-8') as fp:
+            json.dump(self.entries, fp)
+        os.replace(self.path + '_tmp', self.path)
+
+
 def _which(program):
     return shutil.which(program)
 
@@ -42,7 +98,7 @@ PROVIDERS = {
     'glacier': glacier.GlacierProvider,
 }
 
-def get_provider(cfg):
+def get_provider(cfg, state_dir=None):
     if not cfg or 'type' not in cfg:
         raise ValueError('Provider configuration missing type')
     t = cfg['type'].lower()
@@ -51,7 +107,7 @@ def get_provider(cfg):
         raise ValueError('Unknown provider: %s' % t)
     opts = dict(cfg)
     opts.pop('type', None)
-    provider = cls(**opts)
+    provider = cls(state_dir=state_dir, **opts)
     if not provider.verify():
         logging.error('Provider verification failed for %s', t)
         return None
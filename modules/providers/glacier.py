@@ -4,127 +4,206 @@ import sys
 import logging
 import time
 import threading
-from queue import Queue, Empty
+from queue import Queue
 from botocore.exceptions import ClientError
 
-from . import BackupProvider
+from . import BackupProvider, UploadState
 from modules import aws
+from modules import digest
 from modules import helper
 
 
-class _UploadCoordinator:
-    """Thread-pool that uploads multipart chunks to Glacier via boto3."""
+class _PartBody(io.RawIOBase):
+    """
+    A part held in one of the engine's buffers, handed to boto3 as a file so
+    it's streamed (and rewound on retries) straight from the buffer.
+    """
 
-    def __init__(self, threads=4):
-        self.threads = threads
-        self.sent = 0
-        self.began = round(time.time())
-        self.exit = False
-        self.queue = Queue()
+    def __init__(self, view):
+        super().__init__()
+        self.view = view
+        self.pos = 0
 
-    def process(self):
-        self.began = round(time.time())
-        for _ in range(self.threads):
-            t = threading.Thread(target=self._worker)
-            t.daemon = True
-            t.start()
+    def __len__(self):
+        return len(self.view)
 
-    def _worker(self):
-        run = True
-        while run and not self.exit:
-            try:
-                entry = self.queue.get(False)
-            except Empty:
-                break
-            except Exception:
-                logging.exception('Failed to read from queue')
-                break
-            sent = entry.work()
-            if sent == -1:
-                logging.error("Upload chunk failed")
-                run = False
-                self.exit = True
-            else:
-                self.sent += sent
-            self.queue.task_done()
-        self.threads -= 1
-
-    def add(self, job):
-        if self.exit:
-            return False
-        self.queue.put(job)
+    def readable(self):
         return True
 
-    def get_time(self):
-        t = round(time.time()) - self.began
-        return max(t, 1)
-
-    def get_sent(self):
-        return self.sent
-
-    def is_done(self):
-        return self.threads == 0 or self.exit
-
-    def finish(self):
-        self.queue.join()
-        return not self.exit
-
-
-class _UploadJob:
-    """Uploads a single multipart chunk using boto3."""
+    def seekable(self):
+        return True
 
-    def __init__(self, client, vault, filepath, offset, size, checksum, upload_id):
+    def readinto(self, b):
+        n = min(len(b), len(self.view) - self.pos)
+        b[:n] = self.view[self.pos:self.pos + n]
+        self.pos += n
+        return n
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.pos
+        elif whence == io.SEEK_END:
+            offset += len(self.view)
+        self.pos = max(0, offset)
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+
+class _UploadEngine:
+    """
+    Uploads the parts of one file to Glacier using a fixed set of worker
+    threads. A producer reads each part once from a shared descriptor into a
+    buffer which is reused once its part is uploaded, and never keeps more
+    than `budget` bytes of parts around (but always at least one part, and
+    with a budget of 0 only as many as there are threads to take them).
+    Workers signal when they are done, so nothing is polled.
+    """
+
+    def __init__(self, client, vault, upload_id, fd, threads=4, budget=0):
         self.client = client
         self.vault = vault
-        self.filepath = filepath
-        self.offset = offset
-        self.size = size
-        self.checksum = checksum
         self.upload_id = upload_id
+        self.fd = fd
+        self.threads = max(1, threads)
+        self.budget = budget
         self.retries = 10
+        self.queue = Queue(maxsize=self.threads)
+        self.cond = threading.Condition()
+        self.done = threading.Event()
+        self.inflight = 0
+        # Buffers of uploaded parts, ready for the next ones
+        self.spare = []
+        self.running = 0
+        self.sent = 0
+        self.failed = False
+        self.began = time.time()
+        self.workers = []
+
+    def start(self, parts):
+        """Starts uploading parts, an iterable of (offset, size, tree hash)."""
+        self.began = time.time()
+        self.running = self.threads
+        self.workers = [threading.Thread(target=self._worker, daemon=True)
+                        for _ in range(self.threads)]
+        self.workers.append(threading.Thread(target=self._produce, args=(parts,), daemon=True))
+        for t in self.workers:
+            t.start()
+
+    def _produce(self, parts):
+        for offset, size, checksum in parts:
+            with self.cond:
+                while not self.failed and self.inflight > 0 and 0 < self.budget < self.inflight + size:
+                    self.cond.wait()
+                if self.failed:
+                    break
+                self.inflight += size
+                buf = self.spare.pop() if self.spare else None
+            if buf is None or len(buf) < size:
+                buf = bytearray(size)
+            view = memoryview(buf)[:size]
+            try:
+                if self._read(view, offset) != size:
+                    raise OSError('%s is shorter than expected' % helper.formatSize(offset + size))
+            except OSError:
+                logging.exception('Unable to read %s at offset %d', helper.formatSize(size), offset)
+                with self.cond:
+                    self.inflight -= size
+                    self.failed = True
+                break
+            self.queue.put((offset, buf, _PartBody(view), checksum))
+        for _ in range(self.threads):
+            self.queue.put(None)
+
+    def _read(self, view, offset):
+        if hasattr(os, 'preadv'):
+            return os.preadv(self.fd, [view], offset)
+        data = os.pread(self.fd, len(view), offset)
+        view[:len(data)] = data
+        return len(data)
 
-    def work(self):
-        data_range = 'bytes %d-%d/*' % (self.offset, self.offset + self.size - 1)
+    def _worker(self):
+        while True:
+            entry = self.queue.get()
+            if entry is None:
+                break
+            offset, buf, data, checksum = entry
+            ok = not self.failed and self._upload(offset, data, checksum)
+            with self.cond:
+                self.inflight -= len(data)
+                self.spare.append(buf)
+                if ok:
+                    self.sent += len(data)
+                elif not self.failed:
+                    logging.error("Upload chunk failed")
+                    self.failed = True
+                self.cond.notify_all()
+        with self.cond:
+            self.running -= 1
+            if self.running == 0:
+                self.done.set()
+
+    def _upload(self, offset, data, checksum):
+        data_range = 'bytes %d-%d/*' % (offset, offset + len(data) - 1)
         retry = self.retries
         while retry > 0:
+            data.seek(0)
             try:
-                with io.open(self.filepath, 'rb') as f:
-                    f.seek(self.offset)
-                    body = f.read(self.size)
                 resp = self.client.upload_multipart_part(
                     vaultName=self.vault,
                     uploadId=self.upload_id,
-                    body=body,
+                    body=data,
                     range=data_range,
-                    checksum=self.checksum,
+                    checksum=checksum,
                 )
                 got = resp.get('checksum', '')
-                if got and got != self.checksum:
-                    logging.error('Hash mismatch, expected %s got %s', self.checksum, got)
+                if got and got != checksum:
+                    logging.error('Hash mismatch, expected %s got %s', checksum, got)
                 else:
-                    return self.size
+                    return True
             except Exception as e:
                 logging.debug('Upload part error: %s', e)
 
             retry -= 1
             wait = (self.retries - retry) * 30
             logging.warning('%s @ %d failed, retrying in %ds. %d tries left',
-                            helper.formatSize(self.size), self.offset, wait, retry)
+                            helper.formatSize(len(data)), offset, wait, retry)
             time.sleep(wait)
 
         logging.error('Unable to upload %s at offset %d',
-                      helper.formatSize(self.size), self.offset)
-        return -1
+                      helper.formatSize(len(data)), offset)
+        return False
+
+    def get_time(self):
+        return max(time.time() - self.began, 1)
+
+    def get_sent(self):
+        return self.sent
+
+    def wait(self, timeout=None):
+        """Returns True once all workers are done, waiting at most timeout."""
+        return self.done.wait(timeout)
+
+    def finish(self):
+        for t in self.workers:
+            t.join()
+        return not self.failed
 
 
 class GlacierProvider(BackupProvider):
     """Upload archives to AWS Glacier using boto3."""
     name = 'glacier'
-    allowed_options = {'type', 'vault', 'threads', 'create'} | set(aws.PROVIDER_CONFIG_KEYS)
+    digests = ('tree',)
+    allowed_options = {'type', 'vault', 'threads', 'buffer size', 'create'} | set(aws.PROVIDER_CONFIG_KEYS)
 
     def verify(self):
         self.vault = self.options.get('vault')
         self.threads = int(self.options.get('threads', 4))
+        self.buffer_size = helper.parseSize(self.options.get('buffer size', '256M'))
+        if self.buffer_size is None:
+            logging.error('glacier provider: buffer size has to be a number and may contain a unit suffix, or 0 for no limit')
+            return False
         create = self.options.get('create', 'no').strip().lower()
         if not self.vault:
             logging.error('glacier provider requires "vault"')
@@ -155,6 +234,14 @@ class GlacierProvider(BackupProvider):
         logging.info("Uploading %d files (%s) to glacier",
                      len(files), helper.formatSize(total))
 
+        self._resume = None
+        if self.state_dir:
+            self._resume = UploadState(
+                os.path.join(self.state_dir, 'glacier-uploads-%s.json' % self.vault))
+            keep = {os.path.basename(f) for f in files}
+            for name in [k for k in self._resume.keys() if k not in keep]:
+                self._forget_upload(name, True)
+
         done = 0
         for idx, filepath in enumerate(files, 1):
             prefix = "(%d of %d) " % (idx, len(files))
@@ -169,44 +256,97 @@ class GlacierProvider(BackupProvider):
         size = os.path.getsize(filepath)
         chunk_size = aws.compute_chunk_size(size)
 
-        hashes = aws.hashFile(filepath, chunk_size)
-        if hashes is None:
+        part_hashes, final_hash = self._tree_hashes(filepath, chunk_size)
+        if part_hashes is None:
             logging.error('Unable to hash file %s', filepath)
             return False
 
+        upload_id, uploaded = self._resume_upload(name, size, chunk_size)
+        if upload_id is None:
+            try:
+                resp = self.client.initiate_multipart_upload(
+                    vaultName=self.vault,
+                    archiveDescription=name,
+                    partSize=str(chunk_size),
+                )
+            except Exception:
+                logging.exception('Unable to initiate upload for %s', name)
+                return False
+            upload_id = resp['uploadId']
+            if self._resume is not None:
+                self._resume.start(name, {
+                    'upload id': upload_id,
+                    'size': size,
+                    'part size': chunk_size,
+                })
+
+        parts = []
+        skipped = 0
+        for block, offset in enumerate(range(0, size, chunk_size)):
+            chunk = min(size - offset, chunk_size)
+            checksum = part_hashes[block]
+            if uploaded.get(offset) == checksum:
+                skipped += chunk
+            else:
+                parts.append((offset, chunk, checksum))
+
+        try:
+            fd = os.open(filepath, os.O_RDONLY)
+        except OSError:
+            logging.exception('Unable to open %s', filepath)
+            return False
+        try:
+            engine = _UploadEngine(self.client, self.vault, upload_id, fd,
+                                   self.threads, self.buffer_size)
+            engine.start(parts)
+            ok = self._wait_for_engine(engine, prefix, name, size, skipped,
+                                       bytes_done, bytes_total)
+        finally:
+            os.close(fd)
+
+        if not ok:
+            if self._resume is not None:
+                logging.error('Failed to upload %s, it will be resumed next time', name)
+                return False
+            logging.error('Failed to upload %s, aborting', name)
+            try:
+                self.client.abort_multipart_upload(
+                    vaultName=self.vault, uploadId=upload_id)
+            except Exception:
+                pass
+            return False
+
         try:
-            resp = self.client.initiate_multipart_upload(
+            self.client.complete_multipart_upload(
                 vaultName=self.vault,
-                archiveDescription=name,
-                partSize=str(chunk_size),
+                uploadId=upload_id,
+                archiveSize=str(size),
+                checksum=final_hash,
             )
         except Exception:
-            logging.exception('Unable to initiate upload for %s', name)
+            logging.exception('Unable to complete upload of %s', name)
             return False
-        upload_id = resp['uploadId']
-
-        coord = _UploadCoordinator(self.threads)
-        offset = 0
-        block = 0
-        remain = size
-        while remain > 0:
-            chunk = min(remain, chunk_size)
-            job = _UploadJob(self.client, self.vault, filepath,
-                             offset, chunk,
-                             hashes['blocks'][block].hexdigest(),
-                             upload_id)
-            coord.add(job)
-            block += 1
-            remain -= chunk
-            offset += chunk
-
-        coord.process()
-        while not coord.is_done():
-            time.sleep(1)
-            if sys.stdout.isatty() and coord.get_sent() > 0:
-                sent = coord.get_sent()
-                elapsed = coord.get_time()
-                speed = sent / elapsed
+        if self._resume is not None:
+            self._resume.pop(name)
+        return True
+
+    @staticmethod
+    def _tree_hashes(filepath, chunk_size):
+        """Returns the hex tree hash of every part and of the whole file."""
+        try:
+            tree = digest.get(filepath, 'tree')
+        except OSError:
+            return None, None
+        return tree.part_hashes(chunk_size), tree.final()
+
+    @staticmethod
+    def _wait_for_engine(engine, prefix, name, size, skipped, bytes_done, bytes_total):
+        """Shows the progress (on a terminal) until the engine is done."""
+        shown = False
+        while not engine.wait(1):
+            if sys.stdout.isatty() and engine.get_sent() > 0:
+                speed = engine.get_sent() / engine.get_time()
+                sent = skipped + engine.get_sent()
                 total_sent = bytes_done + sent
                 timerem = ""
                 if speed > 0 and bytes_total > total_sent:
@@ -220,30 +360,60 @@ class GlacierProvider(BackupProvider):
                         total_sent / bytes_total * 100.0,
                         timerem))
                 sys.stdout.flush()
-        if sys.stdout.isatty():
+                shown = True
+        if shown:
             sys.stdout.write('\n')
             sys.stdout.flush()
-
-        if not coord.finish():
-            logging.error('Failed to upload %s, aborting', name)
-            try:
-                self.client.abort_multipart_upload(
-                    vaultName=self.vault, uploadId=upload_id)
-            except Exception:
-                pass
-            return False
-
+        return engine.finish()
+
+    # Resumable multipart uploads
+    #
+    # The upload id and the tree hash of every finished part are kept in a
+    # sidecar in the data dir. When the same file is uploaded again (ie, a
+    # slice which failed to upload before) the parts Glacier already has
+    # with a matching tree hash are skipped.
+
+    def _resume_upload(self, name, size, chunk_size):
+        """Returns (upload id, {offset: tree hash}) to resume, or (None, {})."""
+        if self._resume is None:
+            return None, {}
+        entry = self._resume.get(name)
+        if entry is None:
+            return None, {}
+        if (entry['size'], entry['part size']) != (size, chunk_size):
+            self._forget_upload(name, True)
+            return None, {}
+
+        uploaded = {}
+        kwargs = {'vaultName': self.vault, 'uploadId': entry['upload id']}
         try:
-            self.client.complete_multipart_upload(
-                vaultName=self.vault,
-                uploadId=upload_id,
-                archiveSize=str(size),
-                checksum=hashes['final'].hexdigest(),
-            )
+            while True:
+                resp = self.client.list_parts(**kwargs)
+                for part in resp.get('Parts', []):
+                    offset = int(part['RangeInBytes'].split('-')[0])
+                    uploaded[offset] = part['SHA256TreeHash']
+                if not resp.get('Marker'):
+                    break
+                kwargs['marker'] = resp['Marker']
+        except Exception as exc:
+            if self._error_code(exc) != 'ResourceNotFoundException':
+                logging.exception('Unable to list parts of %s, starting over', name)
+            self._forget_upload(name, False)
+            return None, {}
+
+        logging.info('Resuming upload of %s, glacier has %d part(s)', name, len(uploaded))
+        return entry['upload id'], uploaded
+
+    def _forget_upload(self, name, abort):
+        entry = self._resume.pop(name)
+        if entry is None or not abort:
+            return
+        try:
+            self.client.abort_multipart_upload(
+                vaultName=self.vault, uploadId=entry['upload id'])
+            logging.info('Aborted stale multipart upload of %s', name)
         except Exception:
-            logging.exception('Unable to complete upload of %s', name)
-            return False
-        return True
+            logging.exception('Failed to abort multipart upload of %s', name)
 
     @staticmethod
     def _error_code(exc):
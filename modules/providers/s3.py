@@ -1,13 +1,75 @@
 import os
+import sys
+import json
+import time
+import base64
+import hashlib
 import logging
+import threading
+import concurrent.futures
 from botocore.exceptions import ClientError
-from . import BackupProvider
+from . import BackupProvider, UploadState
 from modules import aws
+from modules import helper
+
+# S3 refuses multipart parts smaller than this (except for the last one)
+MIN_PART_SIZE = 5 * 1024 * 1024
+
+# Nor does it take more parts than this in one upload
+MAX_PARTS = 10000
+
+# Parts in flight at once over all files, whatever threads x part threads is
+MAX_PART_WORKERS = 64
+
+
+class _UploadProgress:
+    """Keeps track of the bytes sent by all upload threads of one batch."""
+
+    def __init__(self, files):
+        self.count = len(files)
+        self.total = sum(os.path.getsize(f) for f in files)
+        self.sent = 0
+        self.completed = 0
+        self.shown = False
+        self.lock = threading.Lock()
+        self.start = time.time()
+
+    def add(self, amount):
+        with self.lock:
+            self.sent += amount
+
+    def file_done(self):
+        with self.lock:
+            self.completed += 1
+
+    def show(self):
+        if not sys.stdout.isatty() or self.sent == 0:
+            return
+        speed = self.sent / max(time.time() - self.start, 0.001)
+        timerem = ""
+        if speed > 0 and self.total > self.sent:
+            timerem = ", %s remaining" % helper.formatTime(
+                (self.total - self.sent) / speed)
+        sys.stdout.write(
+            '(%d of %d) %s @ %s, %.2f%% done%s          \r' % (
+                self.completed, self.count,
+                helper.formatSize(self.sent),
+                helper.formatSpeed(speed),
+                self.sent / max(self.total, 1) * 100.0,
+                timerem))
+        sys.stdout.flush()
+        self.shown = True
+
+    def finish(self):
+        if self.shown:
+            sys.stdout.write('\n')
+            sys.stdout.flush()
 
 
 class S3Provider(BackupProvider):
     name = 's3'
-    allowed_options = {'type', 'bucket', 'storage class', 'create'} | set(aws.PROVIDER_CONFIG_KEYS)
+    allowed_options = {'type', 'bucket', 'storage class', 'create',
+                       'part size', 'part threads', 'threads'} | set(aws.PROVIDER_CONFIG_KEYS)
     _SUPPORTED_STORAGE_CLASSES = {
         'STANDARD',
         'REDUCED_REDUNDANCY',
@@ -88,8 +150,22 @@ class S3Provider(BackupProvider):
         if create not in ('yes', 'no'):
             logging.error('s3 provider: create must be "yes" or "no"')
             return False
+        self.part_size = helper.parseSize(self.options.get('part size', '8M'))
+        if self.part_size is None or self.part_size < MIN_PART_SIZE:
+            logging.error('s3 provider: part size must be at least 5M')
+            return False
+        try:
+            self.part_threads = int(self.options.get('part threads', 10))
+            self.threads = int(self.options.get('threads', 1))
+        except ValueError:
+            self.part_threads = self.threads = 0
+        if self.part_threads < 1 or self.threads < 1:
+            logging.error('s3 provider: threads and part threads must be positive numbers')
+            return False
+        self.part_workers = min(self.threads * self.part_threads, MAX_PART_WORKERS)
         aws_config = aws.extract_aws_config(self.options)
-        client, err = aws.create_s3_client(aws_config)
+        client, err = aws.create_s3_client(
+            aws_config, max_pool_connections=self.part_workers)
         if err:
             logging.error('s3 provider: %s', err)
             return False
@@ -102,21 +178,198 @@ class S3Provider(BackupProvider):
         return f's3:{self.bucket}'
 
     def upload_files(self, files):
+        """
+        Uploads up to `threads` files at a time through the shared client.
+        The parts of all of them go through one pool, up to `part threads`
+        of each file at a time.
+        """
         if not self._ensure_bucket():
             return False
-        for f in files:
-            key = os.path.basename(f)
-            try:
-                kwargs = {}
-                if self.storage_class:
-                    kwargs['ExtraArgs'] = {'StorageClass': self.storage_class}
-                self.client.upload_file(f, self.bucket, key, **kwargs)
-            except Exception:
-                logging.exception('s3 upload failed for %s', f)
-                return False
+
+        progress = _UploadProgress(files)
+        logging.info("Uploading %d files (%s) to %s",
+                     len(files), helper.formatSize(progress.total), self.storage_id())
+        if self.state_dir:
+            self._resume = UploadState(
+                os.path.join(self.state_dir, 's3-uploads-%s.json' % self.bucket))
+            self._abort_stale_uploads(files)
+        transfer = aws.create_s3_transfer_config(self.part_size, self.part_threads)
+
+        ok = True
+        self._parts = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.part_workers, thread_name_prefix='iceshelf-s3-part')
+        with self._parts, concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.threads, thread_name_prefix='iceshelf-s3') as executor:
+            remaining = {executor.submit(self._upload_one, f, transfer, progress) for f in files}
+            while remaining:
+                done, remaining = concurrent.futures.wait(remaining, timeout=1)
+                if ok and any(not f.cancelled() and not f.result() for f in done):
+                    ok = False
+                    for f in remaining:
+                        f.cancel()
+                progress.show()
+        progress.finish()
+
+        if not ok:
+            return False
         logging.info('Stored %d file(s) successfully via %s', len(files), self.storage_id())
         return True
 
+    def _upload_one(self, filepath, transfer, progress):
+        key = os.path.basename(filepath)
+        if self.state_dir and os.path.getsize(filepath) > self.part_size:
+            if not self._upload_resumable(filepath, key, progress):
+                return False
+            progress.file_done()
+            return True
+
+        kwargs = {'Config': transfer, 'Callback': progress.add}
+        if self.storage_class:
+            kwargs['ExtraArgs'] = {'StorageClass': self.storage_class}
+        try:
+            self.client.upload_file(filepath, self.bucket, key, **kwargs)
+        except Exception:
+            logging.exception('s3 upload failed for %s', filepath)
+            return False
+        progress.file_done()
+        return True
+
+    # Resumable multipart uploads
+    #
+    # Large files are uploaded part by part, the upload id and the ETag of
+    # every finished part are kept in a sidecar in the data dir. When the
+    # same file is uploaded again (ie, a slice which failed to upload before)
+    # the parts S3 already has are skipped, provided the MD5 of the local
+    # part still matches its ETag.
+
+    def _forget_upload(self, key, abort):
+        entry = self._resume.pop(key)
+        if entry is None or not abort:
+            return
+        try:
+            self.client.abort_multipart_upload(
+                Bucket=self.bucket, Key=key, UploadId=entry['upload id'])
+            logging.info('s3 provider: aborted stale multipart upload of %s', key)
+        except Exception:
+            logging.exception('s3 provider: failed to abort multipart upload of %s', key)
+
+    def _abort_stale_uploads(self, files):
+        keep = {os.path.basename(f) for f in files}
+        for key in [k for k in self._resume.keys() if k not in keep]:
+            self._forget_upload(key, True)
+
+    def _list_parts(self, key, upload_id):
+        """Returns {part number: etag} of the parts S3 has, None if the upload is gone."""
+        parts = {}
+        kwargs = {'Bucket': self.bucket, 'Key': key, 'UploadId': upload_id}
+        while True:
+            try:
+                resp = self.client.list_parts(**kwargs)
+            except ClientError as exc:
+                if self._error_code(exc) == 'NoSuchUpload':
+                    return None
+                raise
+            for part in resp.get('Parts', []):
+                parts[part['PartNumber']] = part['ETag']
+            if not resp.get('IsTruncated'):
+                return parts
+            kwargs['PartNumberMarker'] = resp['NextPartNumberMarker']
+
+    def _part_size_for(self, size):
+        """The part size to use for size bytes, grown (in whole MiB) to stay within MAX_PARTS."""
+        mib = 1024 * 1024
+        needed = (size + MAX_PARTS - 1) // MAX_PARTS
+        return max(self.part_size, (needed + mib - 1) // mib * mib)
+
+    def _start_upload(self, key, size, mtime, part_size):
+        kwargs = {'Bucket': self.bucket, 'Key': key}
+        if self.storage_class:
+            kwargs['StorageClass'] = self.storage_class
+        upload_id = self.client.create_multipart_upload(**kwargs)['UploadId']
+        self._resume.start(key, {
+            'upload id': upload_id,
+            'size': size,
+            'mtime': mtime,
+            'part size': part_size,
+        })
+        return upload_id
+
+    def _upload_resumable(self, filepath, key, progress):
+        size = os.path.getsize(filepath)
+        mtime = os.path.getmtime(filepath)
+        part_size = self._part_size_for(size)
+        try:
+            entry = self._resume.get(key)
+            if entry is not None and \
+                    (entry['size'], entry['mtime'], entry['part size']) != (size, mtime, part_size):
+                # The file was rebuilt since, none of the parts can be trusted
+                self._forget_upload(key, True)
+                entry = None
+            if entry is not None:
+                existing = self._list_parts(key, entry['upload id'])
+                if existing is None:
+                    self._forget_upload(key, False)
+                    entry = None
+            if entry is None:
+                upload_id = self._start_upload(key, size, mtime, part_size)
+                existing = {}
+            else:
+                upload_id = entry['upload id']
+                logging.info('s3 provider: resuming upload of %s, S3 has %d part(s)', key, len(existing))
+        except Exception:
+            logging.exception('s3 provider: unable to start multipart upload of %s', key)
+            return False
+
+        # Keep at most `part threads` parts of this file in the shared pool
+        count = (size + part_size - 1) // part_size
+        etags = [None] * count
+        pending = {}
+        for number in range(1, count + 1):
+            if len(pending) == self.part_threads:
+                done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for f in done:
+                    etags[pending.pop(f) - 1] = f.result()
+            future = self._parts.submit(self._upload_part, filepath, key, upload_id,
+                                        number, part_size, existing.get(number), progress)
+            pending[future] = number
+        for f in concurrent.futures.as_completed(pending):
+            etags[pending[f] - 1] = f.result()
+        if None in etags:
+            logging.error('s3 provider: upload of %s is incomplete, it will be resumed next time', key)
+            return False
+
+        try:
+            self.client.complete_multipart_upload(
+                Bucket=self.bucket, Key=key, UploadId=upload_id,
+                MultipartUpload={'Parts': [
+                    {'ETag': etag, 'PartNumber': number}
+                    for number, etag in enumerate(etags, 1)]})
+        except Exception:
+            logging.exception('s3 provider: unable to complete upload of %s', key)
+            return False
+        self._forget_upload(key, False)
+        return True
+
+    def _upload_part(self, filepath, key, upload_id, number, part_size, etag, progress):
+        with open(filepath, 'rb') as fp:
+            fp.seek((number - 1) * part_size)
+            data = fp.read(part_size)
+        digest = hashlib.md5(data)
+        if etag is not None and etag.strip('"') == digest.hexdigest():
+            progress.add(len(data))
+            return etag
+
+        try:
+            resp = self.client.upload_part(
+                Bucket=self.bucket, Key=key, UploadId=upload_id,
+                PartNumber=number, Body=data,
+                ContentMD5=base64.b64encode(digest.digest()).decode('ascii'))
+        except Exception:
+            logging.exception('s3 provider: failed to upload part %d of %s', number, key)
+            return None
+        progress.add(len(data))
+        return resp['ETag']
+
     @staticmethod
     def _error_code(exc):
         response = getattr(exc, 'response', None) or {}
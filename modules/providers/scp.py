@@ -1,11 +1,18 @@
 import os
+import time
+import shutil
+import tempfile
 import subprocess
 import logging
+import concurrent.futures
 from . import BackupProvider, _which
 
+# Seconds to wait for the shared connection to come up
+MASTER_TIMEOUT = 30
+
 class SCPProvider(BackupProvider):
     name = 'scp'
-    allowed_options = {'type', 'user', 'host', 'dest', 'key', 'password'}
+    allowed_options = {'type', 'user', 'host', 'dest', 'key', 'password', 'streams'}
     def verify(self):
         self.user = self.options.get('user')
         self.host = self.options.get('host')
@@ -15,6 +22,13 @@ class SCPProvider(BackupProvider):
         if not self.user or not self.host:
             logging.error('scp provider requires "user" and "host"')
             return False
+        try:
+            self.streams = int(self.options.get('streams', 1))
+        except ValueError:
+            self.streams = 0
+        if self.streams < 1:
+            logging.error('scp provider: streams must be a positive number')
+            return False
         if self.key and not os.path.exists(self.key):
             logging.error('SSH key %s not found', self.key)
             return False
@@ -30,23 +44,116 @@ class SCPProvider(BackupProvider):
         return f'scp:{self.user}@{self.host}:{self.dest}'
 
     def upload_files(self, files):
-        base = []
-        if self.password:
-            base += ['sshpass', '-p', self.password]
-        scp_cmd = ['scp']
+        """
+        Sends the files with one scp invocation per stream, all of them
+        multiplexed over a single SSH connection so the handshake is only
+        paid once. If a batch fails, its files are sent again one by one
+        to find out which of them failed.
+        """
+        control = tempfile.mkdtemp(prefix='iceshelf-scp-')
+        options = ['-o', 'ControlPath=' + os.path.join(control, '%C')]
         if self.key:
-            scp_cmd += ['-i', self.key]
-        for f in files:
-            dest = f'{self.user}@{self.host}:{self.dest}/{os.path.basename(f)}'
-            cmd = base + scp_cmd + [f, dest]
-            try:
-                p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-                out, err = p.communicate()
-                if p.returncode != 0:
-                    logging.error('scp failed: %s', err)
-                    return False
-            except Exception:
-                logging.exception('scp failed for %s', f)
-                return False
+            options += ['-i', self.key]
+        self._master = None
+        try:
+            if not self._start_master(options):
+                logging.warning('scp: could not open a shared connection to %s, '
+                                'each batch will connect on its own', self.host)
+            with concurrent.futures.ThreadPoolExecutor(
+                    max_workers=self.streams, thread_name_prefix='iceshelf-scp') as executor:
+                results = list(executor.map(
+                    lambda batch: self._send_batch(options, batch), self._batches(files)))
+        finally:
+            self._run(['ssh'] + options + ['-O', 'exit', self._target()])
+            self._stop_master()
+            shutil.rmtree(control, ignore_errors=True)
+        if not all(results):
+            return False
         logging.info('Stored %d file(s) successfully via %s', len(files), self.storage_id())
         return True
+
+    def _target(self):
+        return f'{self.user}@{self.host}'
+
+    def _auth(self):
+        if self.password:
+            return ['sshpass', '-p', self.password]
+        return []
+
+    def _run(self, cmd):
+        """Runs cmd, returning its exit code (None if it couldn't be run) and stderr."""
+        try:
+            p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            out, err = p.communicate()
+            return p.returncode, err.decode(errors='replace').strip()
+        except Exception as e:
+            return None, str(e)
+
+    def _start_master(self, options):
+        """
+        Opens the connection shared by all transfers, it stays in the
+        background. It's not given pipes (the persisted master would keep
+        them open), whether it's up is asked with "ssh -O check".
+        """
+        cmd = self._auth() + ['ssh'] + options + [
+            '-o', 'ControlMaster=yes', '-o', 'ControlPersist=yes', '-N', self._target()]
+        try:
+            master = self._master = subprocess.Popen(
+                cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        except Exception as e:
+            logging.debug('scp: master connection failed: %s', e)
+            return False
+        deadline = time.monotonic() + MASTER_TIMEOUT
+        while True:
+            code, err = self._run(['ssh'] + options + ['-O', 'check', self._target()])
+            if code == 0:
+                return True
+            exited = master.poll()
+            if (exited is not None and exited != 0) or time.monotonic() > deadline:
+                break
+            time.sleep(0.1)
+        if master.poll() is None:
+            master.kill()
+            master.wait()
+        logging.debug('scp: master connection failed: %s', err)
+        return False
+
+    def _stop_master(self):
+        """Reaps the process started for the master, it has normally exited by now."""
+        if self._master is None:
+            return
+        try:
+            self._master.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            self._master.kill()
+            self._master.wait()
+
+    def _batches(self, files):
+        """Splits the files over the streams, spreading their sizes evenly."""
+        batches = [[] for _ in range(min(self.streams, len(files)))]
+        sizes = [0] * len(batches)
+        for f in sorted(files, key=os.path.getsize, reverse=True):
+            i = sizes.index(min(sizes))
+            batches[i].append(f)
+            sizes[i] += os.path.getsize(f)
+        return batches
+
+    def _scp(self, options, files):
+        cmd = self._auth() + ['scp', '-o', 'ControlMaster=no'] + options + \
+            files + [f'{self._target()}:{self.dest}/']
+        return self._run(cmd)
+
+    def _send_batch(self, options, files):
+        code, err = self._scp(options, files)
+        if code == 0:
+            return True
+        if len(files) == 1:
+            logging.error('scp failed for %s: %s', files[0], err)
+            return False
+        ok = True
+        for f in files:
+            code, err = self._scp(options, [f])
+            if code != 0:
+                logging.error('scp failed for %s: %s', f, err)
+                ok = False
+        return ok
@@ -3,12 +3,18 @@ import getpass
 import hashlib
 import logging
 import posixpath
+import threading
+import concurrent.futures
 
 import paramiko
 
 from . import BackupProvider
+from modules import digest
 
-UPLOAD_CHUNK = 64 * 1024
+UPLOAD_CHUNK = 1024 * 1024
+# Seconds between keepalives on the shared connection, so a dropped one is
+# noticed (and replaced) instead of hanging the next upload
+KEEPALIVE = 30
 _BOOL_TRUE = {'yes', 'true', '1'}
 
 
@@ -37,7 +43,8 @@ def _local_sha256(path, nbytes=None):
 
 class SFTPProvider(BackupProvider):
     name = 'sftp'
-    allowed_options = {'type', 'host', 'port', 'user', 'key', 'password', 'path', 'retries', 'resume', 'verify'}
+    allowed_options = {'type', 'host', 'port', 'user', 'key', 'password', 'path', 'retries', 'resume', 'verify',
+                       'threads'}
 
     def verify(self):
         self.host = self.options.get('host')
@@ -53,14 +60,24 @@ class SFTPProvider(BackupProvider):
         self.retries = int(self.options.get('retries', 3))
         self.resume = _parse_bool(self.options.get('resume'), default=True)
         self.do_verify = _parse_bool(self.options.get('verify'), default=True)
+        self.digests = ('sha256',) if self.do_verify else ()
+        try:
+            self.threads = int(self.options.get('threads', 1))
+        except ValueError:
+            self.threads = 0
+        if self.threads < 1:
+            logging.error('sftp provider: threads must be a positive number')
+            return False
 
         if self.key and not os.path.exists(self.key):
             logging.error('SSH key file %s not found', self.key)
             return False
 
+        # The connection is kept and shared by all uploads of this run
+        self._client = None
+        self._lock = threading.Lock()
         try:
-            client = self._connect()
-            client.close()
+            self._session()
         except paramiko.PasswordRequiredException:
             logging.error(
                 'sftp: key %s requires a passphrase and no agent key is loaded. '
@@ -82,25 +99,23 @@ class SFTPProvider(BackupProvider):
         return f'sftp://{self.user}@{self.host}:{self.port}{self.path}'
 
     def upload_files(self, files):
+        """
+        Uploads up to `threads` files at a time, each over its own SFTP
+        channel of the shared connection.
+        """
         try:
-            client = self._connect()
+            self._session()
         except Exception:
             logging.exception('sftp: connection failed')
             return False
 
-        try:
-            sftp = client.open_sftp()
-            for local_path in files:
-                remote_name = posixpath.join(self.path, os.path.basename(local_path))
-                if not self._upload_with_retries(client, sftp, local_path, remote_name):
-                    return False
-            logging.info('Stored %d file(s) successfully via %s', len(files), self.storage_id())
-            return True
-        except Exception:
-            logging.exception('sftp: upload session failed')
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.threads, thread_name_prefix='iceshelf-sftp') as executor:
+            results = list(executor.map(self._upload_with_retries, files))
+        if not all(results):
             return False
-        finally:
-            client.close()
+        logging.info('Stored %d file(s) successfully via %s', len(files), self.storage_id())
+        return True
 
     # ------------------------------------------------------------------
     # Connection
@@ -123,13 +138,34 @@ class SFTPProvider(BackupProvider):
             kwargs['password'] = self.password
 
         client.connect(**kwargs)
+        client.get_transport().set_keepalive(KEEPALIVE)
         return client
 
+    def _session(self):
+        """Returns the shared connection, reconnecting if it was lost."""
+        with self._lock:
+            transport = self._client.get_transport() if self._client else None
+            if transport is None or not transport.is_active():
+                if self._client is not None:
+                    logging.warning('sftp: connection to %s lost, reconnecting', self.host)
+                    try:
+                        self._client.close()
+                    except Exception:
+                        pass
+                    self._client = None
+                self._client = self._connect()
+            return self._client
+
+    def _open_sftp(self, client):
+        """Opens a new SFTP channel on the shared connection."""
+        return paramiko.SFTPClient.from_transport(client.get_transport())
+
     # ------------------------------------------------------------------
     # Upload with retry / resume
     # ------------------------------------------------------------------
 
-    def _upload_with_retries(self, client, sftp, local_path, remote_path):
+    def _upload_with_retries(self, local_path):
+        remote_path = posixpath.join(self.path, os.path.basename(local_path))
         local_size = os.path.getsize(local_path)
         last_err = None
 
@@ -137,16 +173,13 @@ class SFTPProvider(BackupProvider):
             if attempt > 0:
                 logging.warning('sftp: retry %d/%d for %s',
                                 attempt, self.retries, local_path)
-                try:
-                    client.close()
-                except Exception:
-                    pass
-                try:
-                    client = self._connect()
-                    sftp = client.open_sftp()
-                except Exception:
-                    logging.exception('sftp: reconnect failed on retry %d', attempt)
-                    continue
+            try:
+                client = self._session()
+                sftp = self._open_sftp(client)
+            except Exception as e:
+                logging.warning('sftp: cannot open channel for %s — %s', local_path, e)
+                last_err = e
+                continue
 
             try:
                 self._upload_one(client, sftp, local_path, remote_path, local_size)
@@ -161,6 +194,11 @@ class SFTPProvider(BackupProvider):
             except (IOError, OSError, paramiko.SSHException) as e:
                 logging.warning('sftp: upload error for %s — %s', local_path, e)
                 last_err = e
+            finally:
+                try:
+                    sftp.close()
+                except Exception:
+                    pass
 
         logging.error('sftp: giving up on %s after %d attempts (last error: %s)',
                       local_path, 1 + self.retries, last_err)
@@ -177,18 +215,17 @@ class SFTPProvider(BackupProvider):
         elif offset > 0:
             logging.info('sftp: resuming %s from offset %d / %d',
                          remote_path, offset, local_size)
-            self._append_from(sftp, local_path, remote_path, offset)
+            self._send(sftp, local_path, remote_path, offset)
         else:
-            if offset == 0:
-                try:
-                    sftp.remove(remote_path)
-                except IOError:
-                    pass
+            try:
+                sftp.remove(remote_path)
+            except IOError:
+                pass
             logging.info('sftp: uploading %s (%d bytes)', remote_path, local_size)
-            sftp.put(local_path, remote_path)
+            self._send(sftp, local_path, remote_path, 0)
 
         if self.do_verify:
-            if not self._verify_remote(client, local_path, remote_path, local_size):
+            if not self._verify_remote(client, sftp, local_path, remote_path, local_size):
                 raise _HashMismatch()
         else:
             remote_size = sftp.stat(remote_path).st_size
@@ -232,8 +269,14 @@ class SFTPProvider(BackupProvider):
             pass
         return 0
 
-    def _append_from(self, sftp, local_path, remote_path, offset):
-        with sftp.open(remote_path, 'ab') as remote_f:
+    def _send(self, sftp, local_path, remote_path, offset):
+        """
+        Writes local_path from offset on, appending to what the remote already
+        holds. Writes are pipelined: they don't wait for the server to
+        acknowledge each one, only for all of them when the file is closed.
+        """
+        with sftp.open(remote_path, 'ab' if offset else 'wb') as remote_f:
+            remote_f.set_pipelined(True)
             with open(local_path, 'rb') as local_f:
                 local_f.seek(offset)
                 while True:
@@ -246,18 +289,14 @@ class SFTPProvider(BackupProvider):
     # Verification helpers
     # ------------------------------------------------------------------
 
-    def _verify_remote(self, client, local_path, remote_path, local_size):
-        local_hash = _local_sha256(local_path)
+    def _verify_remote(self, client, sftp, local_path, remote_path, local_size):
+        local_hash = digest.get(local_path, 'sha256')
         remote_hash = self._remote_sha256(client, remote_path)
 
         if remote_hash is None:
             logging.warning('sftp: sha256sum not available on remote, falling back to size check')
             try:
-                ssh_client = client
-                sftp = ssh_client.open_sftp()
-                remote_size = sftp.stat(remote_path).st_size
-                sftp.close()
-                return remote_size == local_size
+                return sftp.stat(remote_path).st_size == local_size
             except Exception:
                 return False
 
@@ -14,9 +14,10 @@ from modules import fileutils
 
 MANIFEST_SUFFIXES = ('.json.gpg.asc', '.json.asc', '.json.gpg', '.json')
 # Prefer most-wrapped first so we never use left-over decrypted intermediates
-ARCHIVE_SUFFIXES = (
-    '.tar.bz2.gpg.sig', '.tar.bz2.gpg', '.tar.bz2.sig', '.tar.bz2',
-    '.tar.gpg.sig', '.tar.gpg', '.tar.sig', '.tar')
+ARCHIVE_SUFFIXES = tuple(
+    '.tar' + compression + wrapping
+    for compression in [c['suffix'] for c in fileutils.COMPRESSORS.values()] + ['']
+    for wrapping in ('.gpg.sig', '.gpg', '.sig', ''))
 FILELIST_SUFFIXES = ('.lst.asc', '.lst')
 ACTIVITY_LOG_SUFFIXES = (
     '.activity.log.bz2.gpg.asc',
@@ -46,6 +47,38 @@ def get_archive_file(basepath, basename):
     return None
 
 
+def archive_content_name(filename):
+    """Return archive filename without its .sig/.gpg layers (e.g. archive.tar.bz2.gpg.sig -> archive.tar.bz2)."""
+    while filename.endswith('.sig') or filename.endswith('.gpg'):
+        filename = filename[:-4]
+    return filename
+
+
+def get_archive_files(basepath, basename):
+    """Return paths of all archives for basename, the most wrapped one of each compression.
+    A split backup has both a compressed and a stored archive, see select_backup_archives()."""
+    results = []
+    seen = set()
+    for suffix in ARCHIVE_SUFFIXES:
+        content_suffix = archive_content_name(suffix)
+        if content_suffix in seen:
+            continue
+        path = os.path.join(basepath, basename + suffix)
+        if os.path.isfile(path):
+            results.append(path)
+            seen.add(content_suffix)
+    return results
+
+
+def select_backup_archives(archive_paths, manifest):
+    """Narrow archive_paths (from get_archive_files()) down to the ones making up the backup.
+    Split backups list their archives in the manifest, any other backup has a single archive."""
+    names = manifest.get('archives') if manifest else None
+    if not names:
+        return archive_paths[:1]
+    return [path for path in archive_paths if archive_content_name(os.path.basename(path)) in names]
+
+
 def get_filelist_file(basepath, basename):
     """Return path to filelist file if it exists; check only iceshelf filelist names in order."""
     for suffix in FILELIST_SUFFIXES:
@@ -93,8 +126,7 @@ def get_files_for_basename(basepath, basename):
     manifest_path = get_manifest_file(basepath, basename)
     if manifest_path:
         files.append(os.path.basename(manifest_path))
-    archive_path = get_archive_file(basepath, basename)
-    if archive_path:
+    for archive_path in get_archive_files(basepath, basename):
         files.append(os.path.basename(archive_path))
         for parity_path in get_parity_files(basepath, os.path.basename(archive_path)):
             files.append(os.path.basename(parity_path))
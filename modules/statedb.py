@@ -0,0 +1,424 @@
+"""
+Storage of the iceshelf state. Besides checksum.json there are two ways to
+avoid rewriting all of it after every backup: an SQLite database, or a
+journal of changes appended next to checksum.json and folded back into it
+now and then. The content is the same as described in DATABASE.md, load()
+gives it back in that exact form whichever way it was stored.
+"""
+import os
+import json
+import logging
+import sqlite3
+import itertools
+
+from . import dataset
+from . import jsonstream
+
+# Dataset entries written to checksum.json at a time
+WRITE_BATCH = 10000
+
+# Members of checksum.json read an entry at a time
+STREAMED = ("dataset", "backups", "moved")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS info (
+  key TEXT PRIMARY KEY,
+  value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS files (
+  path TEXT PRIMARY KEY,
+  checksum TEXT NOT NULL,
+  stat TEXT
+);
+CREATE INDEX IF NOT EXISTS files_checksum ON files (checksum);
+CREATE TABLE IF NOT EXISTS memberships (
+  path TEXT NOT NULL,
+  position INTEGER NOT NULL,
+  backup TEXT NOT NULL,
+  PRIMARY KEY (path, position)
+);
+CREATE INDEX IF NOT EXISTS memberships_backup ON memberships (backup);
+CREATE TABLE IF NOT EXISTS deletions (
+  path TEXT NOT NULL,
+  position INTEGER NOT NULL,
+  backup TEXT NOT NULL,
+  PRIMARY KEY (path, position)
+);
+CREATE INDEX IF NOT EXISTS deletions_backup ON deletions (backup);
+CREATE TABLE IF NOT EXISTS moves (
+  path TEXT PRIMARY KEY,
+  reference TEXT NOT NULL,
+  original TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS moves_original ON moves (original);
+CREATE TABLE IF NOT EXISTS backups (
+  name TEXT NOT NULL,
+  position INTEGER NOT NULL,
+  path TEXT NOT NULL,
+  PRIMARY KEY (name, position)
+);
+CREATE INDEX IF NOT EXISTS backups_path ON backups (path);
+"""
+
+# Top level entries of the state kept in the info table
+INFO_KEYS = ("version", "timestamp", "vault", "storage", "lastbackup")
+
+def isSqlite(filename):
+  """Tells if filename is an SQLite database rather than a JSON one."""
+  with open(filename, "rb") as fp:
+    return fp.read(16) == b"SQLite format 3\x00"
+
+def connect(filename):
+  """Opens (creating if needed) a state database."""
+  db = sqlite3.connect(filename)
+  db.executescript(SCHEMA)
+  return db
+
+def _read(db, compact):
+  data = {}
+  for key, value in db.execute("SELECT key, value FROM info"):
+    data[key] = json.loads(value)
+
+  files = {}
+  for path, checksum, stat in db.execute("SELECT path, checksum, stat FROM files"):
+    item = {"checksum": checksum, "memberof": [], "deleted": []}
+    if stat is not None:
+      item["stat"] = json.loads(stat)
+    files[path] = dataset.FileRecord(item) if compact else item
+  for path, backup in db.execute("SELECT path, backup FROM memberships ORDER BY path, position"):
+    files[path]["memberof"].append(backup)
+  for path, backup in db.execute("SELECT path, backup FROM deletions ORDER BY path, position"):
+    files[path]["deleted"].append(backup)
+  data["dataset"] = files
+
+  backups = {}
+  for name, path in db.execute("SELECT name, path FROM backups ORDER BY name, position"):
+    backups.setdefault(name, []).append(path)
+  data["backups"] = backups
+
+  data["moved"] = {}
+  for path, reference, original in db.execute("SELECT path, reference, original FROM moves"):
+    data["moved"][path] = {"reference": reference, "original": original}
+  return data
+
+def _grouped(rows):
+  for key, group in itertools.groupby(rows, key=lambda row: row[0]):
+    yield key, [value for _, value in group]
+
+def _lookup(groups):
+  """Gives the list of each path from groups sorted by path, asked for in that order."""
+  head = [next(groups, None)]
+  def get(path):
+    while head[0] is not None and head[0][0] < path:
+      head[0] = next(groups, None)
+    if head[0] is not None and head[0][0] == path:
+      return head[0][1]
+    return []
+  return get
+
+def _walk(db, compact):
+  """Like _read() but yielding the entries one by one, see iterate()."""
+  for key, value in db.execute("SELECT key, value FROM info"):
+    yield key, None, json.loads(value)
+
+  memberof = _lookup(_grouped(db.execute("SELECT path, backup FROM memberships ORDER BY path, position")))
+  deleted = _lookup(_grouped(db.execute("SELECT path, backup FROM deletions ORDER BY path, position")))
+  for path, checksum, stat in db.execute("SELECT path, checksum, stat FROM files ORDER BY path"):
+    item = {"checksum": checksum, "memberof": memberof(path), "deleted": deleted(path)}
+    if stat is not None:
+      item["stat"] = json.loads(stat)
+    yield "dataset", path, dataset.FileRecord(item) if compact else item
+
+  for name, paths in _grouped(db.execute("SELECT name, path FROM backups ORDER BY name, position")):
+    yield "backups", name, paths
+  for path, reference, original in db.execute("SELECT path, reference, original FROM moves"):
+    yield "moved", path, {"reference": reference, "original": original}
+
+def journalFile(filename):
+  """The journal kept next to a checksum.json."""
+  return os.path.splitext(filename)[0] + ".journal"
+
+def _records(journal, hook):
+  with open(journal, "rb") as fp:
+    lines = fp.read().splitlines()
+  for line in lines:
+    if not line:
+      continue
+    try:
+      record = json.loads(line, object_hook=hook)
+    except ValueError:
+      # Torn by a crash while it was written, that slice was never committed
+      logging.warning("Ignoring incomplete record in %s", journal)
+      continue
+    yield record["info"], (("dataset", record["files"]), ("moved", record["moves"]), ("backups", record["backups"]))
+
+def _replay(data, journal, hook):
+  for info, changes in _records(journal, hook):
+    data.update(info)
+    for key, changed in changes:
+      entries = data.setdefault(key, {})
+      for name, value in changed.items():
+        if value is None:
+          entries.pop(name, None)
+        else:
+          entries[name] = value
+
+def _journalChanges(filename, hook):
+  """What the journal of filename changes, removed entries as None."""
+  info = {}
+  changes = {key: {} for key in STREAMED}
+  if os.path.exists(journalFile(filename)):
+    for recordInfo, recordChanges in _records(journalFile(filename), hook):
+      info.update(recordInfo)
+      for key, entries in recordChanges:
+        changes[key].update(entries)
+  return info, changes
+
+def load(filename, compact=False):
+  """
+  Loads the state from filename, be it checksum.json (with what its journal
+  adds, if there is one) or an SQLite database. With compact, the dataset
+  entries are FileRecords (see modules.dataset) instead of dicts.
+  """
+  hook = dataset.objectHook if compact else None
+  if not isSqlite(filename):
+    with open(filename, "rb") as fp:
+      data = jsonstream.load(fp, STREAMED, hook)
+    if os.path.exists(journalFile(filename)):
+      _replay(data, journalFile(filename), hook)
+    return data
+  db = sqlite3.connect(filename)
+  try:
+    return _read(db, compact)
+  finally:
+    db.close()
+
+def iterate(filename, compact=False):
+  """
+  Walks the state in filename like load() reads it, but without holding it
+  in memory. Yields (key, None, value) for the top level entries and
+  (key, name, value) for each entry of "dataset", "backups" and "moved".
+  The changes in the journal are applied as the entries go by.
+  """
+  hook = dataset.objectHook if compact else None
+  if isSqlite(filename):
+    db = sqlite3.connect(filename)
+    try:
+      yield from _walk(db, compact)
+    finally:
+      db.close()
+    return
+
+  # The journal is small next to checksum.json, its changes win over it
+  info, changes = _journalChanges(filename, hook)
+  with open(filename, "rb") as fp:
+    for key, name, value in jsonstream.iterate(fp, STREAMED, hook):
+      if name is None:
+        if key not in STREAMED:
+          yield key, None, info.pop(key, value)
+      elif name not in changes.get(key, ()):
+        yield key, name, value
+  for key, value in info.items():
+    yield key, None, value
+  for key in STREAMED:
+    for name, value in changes[key].items():
+      if value is not None:
+        yield key, name, value
+
+def version(filename):
+  """The version of iceshelf which wrote the state in filename, as load() would give it."""
+  if isSqlite(filename):
+    db = sqlite3.connect(filename)
+    try:
+      row = db.execute("SELECT value FROM info WHERE key = 'version'").fetchone()
+    finally:
+      db.close()
+    return json.loads(row[0]) if row else None
+  info, _ = _journalChanges(filename, None)
+  if "version" in info:
+    return info["version"]
+  # Written first, so this is usually the end of it
+  with open(filename, "rb") as fp:
+    for key, name, value in jsonstream.iterate(fp, STREAMED):
+      if key == "version" and name is None:
+        return value
+  return None
+
+def _like(text):
+  return "%" + text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+
+def findFiles(filename, query):
+  """
+  Yields (path, memberof) for the files in the state whose path holds
+  query, ignoring case. An SQLite database does the search itself.
+  """
+  query = query.lower()
+  if not isSqlite(filename):
+    for key, name, value in iterate(filename):
+      if key == "dataset" and name is not None and query in name.lower():
+        yield name, list(value["memberof"])
+    return
+
+  db = sqlite3.connect(filename)
+  try:
+    # LIKE only folds ASCII, it narrows the search down but lower() decides
+    if query.isascii():
+      rows = db.execute("SELECT path FROM files WHERE path LIKE ? ESCAPE '\\'", (_like(query),))
+    else:
+      rows = db.execute("SELECT path FROM files")
+    for path in [path for path, in rows if query in path.lower()]:
+      memberof = db.execute("SELECT backup FROM memberships WHERE path = ? ORDER BY position", (path,))
+      yield path, [backup for backup, in memberof]
+  finally:
+    db.close()
+
+def backupMembers(filename, name):
+  """The files making up the backup name, None if there's no such backup."""
+  if isSqlite(filename):
+    db = sqlite3.connect(filename)
+    try:
+      members = [path for path, in db.execute("SELECT path FROM backups WHERE name = ? ORDER BY position", (name,))]
+    finally:
+      db.close()
+    return members or None
+  for key, backup, value in iterate(filename):
+    if key == "backups" and backup == name:
+      return value
+  return None
+
+def save(db, data, paths=None, moves=None, backups=None):
+  """
+  Stores data (as in checksum.json) in one transaction. Only the files,
+  moves and backups named by paths, moves and backups are written, None
+  meaning all of them. Entries named but no longer in data are removed.
+  """
+  files = data["dataset"]
+  moved = data.get("moved", {})
+  if paths is None:
+    paths = files.keys()
+  if moves is None:
+    moves = moved.keys()
+  if backups is None:
+    backups = data["backups"].keys()
+
+  with db:
+    db.executemany(
+      "INSERT INTO info (key, value) VALUES (?, ?) ON CONFLICT (key) DO UPDATE SET value = excluded.value",
+      [(k, json.dumps(data.get(k), ensure_ascii=False)) for k in INFO_KEYS])
+
+    for path in paths:
+      db.execute("DELETE FROM memberships WHERE path = ?", (path,))
+      db.execute("DELETE FROM deletions WHERE path = ?", (path,))
+      item = files.get(path)
+      if item is None:
+        db.execute("DELETE FROM files WHERE path = ?", (path,))
+        continue
+      stat = json.dumps(item["stat"]) if "stat" in item else None
+      db.execute(
+        "INSERT INTO files (path, checksum, stat) VALUES (?, ?, ?) "
+        "ON CONFLICT (path) DO UPDATE SET checksum = excluded.checksum, stat = excluded.stat",
+        (path, item["checksum"], stat))
+      db.executemany("INSERT INTO memberships (path, position, backup) VALUES (?, ?, ?)",
+                     [(path, i, b) for i, b in enumerate(item["memberof"])])
+      db.executemany("INSERT INTO deletions (path, position, backup) VALUES (?, ?, ?)",
+                     [(path, i, b) for i, b in enumerate(item.get("deleted", []))])
+
+    for path in moves:
+      move = moved.get(path)
+      if move is None:
+        db.execute("DELETE FROM moves WHERE path = ?", (path,))
+        continue
+      db.execute(
+        "INSERT INTO moves (path, reference, original) VALUES (?, ?, ?) "
+        "ON CONFLICT (path) DO UPDATE SET reference = excluded.reference, original = excluded.original",
+        (path, move["reference"], move["original"]))
+
+    for name in backups:
+      db.execute("DELETE FROM backups WHERE name = ?", (name,))
+      db.executemany("INSERT INTO backups (name, position, path) VALUES (?, ?, ?)",
+                     [(name, i, p) for i, p in enumerate(data["backups"].get(name, []))])
+
+def _dumps(value):
+  return json.dumps(value, ensure_ascii=False, default=dataset.plain)
+
+def _dump(fp, data):
+  """
+  Writes data just like json.dumps() would, but the dataset a batch at a
+  time so it never has to be held as one string.
+  """
+  fp.write("{")
+  for n, (key, value) in enumerate(data.items()):
+    if n:
+      fp.write(", ")
+    fp.write(_dumps(key) + ": ")
+    if key != "dataset" or not value:
+      fp.write(_dumps(value))
+      continue
+    fp.write("{")
+    entries = iter(value.items())
+    batch = dict(itertools.islice(entries, WRITE_BATCH))
+    while batch:
+      fp.write(_dumps(batch)[1:-1])
+      batch = dict(itertools.islice(entries, WRITE_BATCH))
+      if batch:
+        fp.write(", ")
+    fp.write("}")
+  fp.write("}")
+
+def writeJson(filename, data):
+  """
+  Writes data as checksum.json, replacing the old one only once the new one
+  is safely on disk. Its journal, now part of it, is removed.
+  """
+  with open(filename + "_tmp", "w", encoding="utf-8") as fp:
+    _dump(fp, data)
+    fp.flush()
+    os.fsync(fp.fileno())
+  os.replace(filename + "_tmp", filename)
+  if os.path.exists(journalFile(filename)):
+    os.remove(journalFile(filename))
+
+def appendJournal(filename, data, paths, moves, backups):
+  """
+  Appends the files, moves and backups named (as they are in data, or their
+  removal) to the journal of checksum.json filename. Returns the size of
+  the journal.
+  """
+  moved = data.get("moved", {})
+  record = {
+    "info": {k: data.get(k) for k in INFO_KEYS},
+    "files": {p: data["dataset"].get(p) for p in paths},
+    "moves": {p: moved.get(p) for p in moves},
+    "backups": {b: data["backups"].get(b) for b in backups},
+  }
+  line = _dumps(record).encode("utf-8") + b"\n"
+  journal = journalFile(filename)
+  with open(journal, "ab+") as fp:
+    # Don't glue the record to what's left of a torn one
+    if fp.tell() > 0:
+      fp.seek(-1, os.SEEK_END)
+      if fp.read(1) != b"\n":
+        line = b"\n" + line
+    fp.write(line)
+    fp.flush()
+    os.fsync(fp.fileno())
+    return fp.tell()
+
+def importJson(jsonfile, dbfile):
+  """Creates the SQLite database dbfile holding what the JSON jsonfile (and its journal) does."""
+  data = load(jsonfile)
+  if os.path.exists(dbfile + "_tmp"):
+    os.remove(dbfile + "_tmp")
+  db = connect(dbfile + "_tmp")
+  try:
+    save(db, data)
+  finally:
+    db.close()
+  os.replace(dbfile + "_tmp", dbfile)
+  return data
+
+def exportJson(dbfile, jsonfile):
+  """Writes the state held by dbfile as a checksum.json style file."""
+  data = load(dbfile)
+  writeJson(jsonfile, data)
+  return data
@@ -3,6 +3,7 @@
 import copy
 import logging
 import os
+import random
 import sys
 
 import pytest
@@ -300,6 +301,17 @@ loop slices = maybe
         assert parsed is None
         assert "loop slices has to be yes/no" in caplog.text
 
+    def test_pipeline_slices_invalid_value_fails(self, valid_layout, caplog):
+        caplog.set_level(logging.ERROR)
+
+        parsed = _parse(valid_layout, extra_sections="""
+[options]
+pipeline slices = maybe
+""", caplog=caplog)
+
+        assert parsed is None
+        assert "pipeline slices has to be yes/no" in caplog.text
+
     def test_ignore_unavailable_files_invalid_value_fails(self, valid_layout, caplog):
         caplog.set_level(logging.ERROR)
 
@@ -322,6 +334,117 @@ tolerate unreconcilable files = maybe
         assert parsed is None
         assert "tolerate unreconcilable files has to be yes/no" in caplog.text
 
+    def test_unknown_compressor_fails(self, valid_layout, caplog):
+        caplog.set_level(logging.ERROR)
+
+        parsed = _parse(valid_layout, extra_sections="""
+[options]
+compressor = gzip
+""", caplog=caplog)
+
+        assert parsed is None
+        assert "compressor has to be one of bzip2/zstd/xz/lz4" in caplog.text
+
+    def test_compress_level_outside_range_fails(self, valid_layout, caplog):
+        caplog.set_level(logging.ERROR)
+
+        parsed = _parse(valid_layout, extra_sections="""
+[options]
+compressor = lz4
+compress level = 13
+""", caplog=caplog)
+
+        assert parsed is None
+        assert "compress level for lz4 has to be a number from 1 to 12" in caplog.text
+
+    def test_compressor_and_level_are_parsed(self, valid_layout, caplog):
+        parsed = _parse(valid_layout, extra_sections="""
+[options]
+compressor = ZSTD
+compress level = 19
+""", caplog=caplog)
+
+        assert parsed["compressor"] == "zstd"
+        assert parsed["compress-level"] == 19
+
+    def test_compress_detection_invalid_value_fails(self, valid_layout, caplog):
+        caplog.set_level(logging.ERROR)
+
+        parsed = _parse(valid_layout, extra_sections="""
+[options]
+compress detection = magic
+""", caplog=caplog)
+
+        assert parsed is None
+        assert "compress detection has to be extension/sample" in caplog.text
+
+    def test_split_archives_invalid_value_fails(self, valid_layout, caplog):
+        caplog.set_level(logging.ERROR)
+
+        parsed = _parse(valid_layout, extra_sections="""
+[options]
+split archives = maybe
+""", caplog=caplog)
+
+        assert parsed is None
+        assert "split archives has to be yes/no" in caplog.text
+
+    def test_stream_hash_invalid_value_fails(self, valid_layout, caplog):
+        caplog.set_level(logging.ERROR)
+
+        parsed = _parse(valid_layout, extra_sections="""
+[options]
+stream hash = sometimes
+""", caplog=caplog)
+
+        assert parsed is None
+        assert "stream hash has to be yes/no" in caplog.text
+
+    def test_hash_workers_invalid_value_fails(self, valid_layout, caplog):
+        caplog.set_level(logging.ERROR)
+
+        parsed = _parse(valid_layout, extra_sections="""
+[options]
+hash workers = 0
+""", caplog=caplog)
+
+        assert parsed is None
+        assert "hash workers has to be a number, 1 or more" in caplog.text
+
+    def test_stat_cache_invalid_value_fails(self, valid_layout, caplog):
+        caplog.set_level(logging.ERROR)
+
+        parsed = _parse(valid_layout, extra_sections="""
+[options]
+stat cache = maybe
+""", caplog=caplog)
+
+        assert parsed is None
+        assert "stat cache has to be yes/no" in caplog.text
+
+    def test_state_database_invalid_value_fails(self, valid_layout, caplog):
+        caplog.set_level(logging.ERROR)
+
+        parsed = _parse(valid_layout, extra_sections="""
+[options]
+state database = postgres
+""", caplog=caplog)
+
+        assert parsed is None
+        assert "state database has to be json/sqlite/journal" in caplog.text
+
+    def test_stat_cache_verify_invalid_value_fails(self, valid_layout, caplog):
+        caplog.set_level(logging.ERROR)
+
+        parsed = _parse(valid_layout, extra_sections="""
+[options]
+stat cache = yes
+stat cache verify = 150%
+""", caplog=caplog)
+
+        assert parsed is None
+        assert "stat cache verify has to be a number of runs or a percentage" in caplog.text
+
     def test_upload_activity_log_invalid_value_fails(self, valid_layout, caplog):
         caplog.set_level(logging.ERROR)
 
@@ -371,6 +494,15 @@ loop slices = no
         assert parsed is not None
         assert parsed["loop-slices"] is False
 
+    def test_pipeline_slices_yes_parses_true(self, valid_layout):
+        parsed = _parse(valid_layout, extra_sections="""
+[options]
+pipeline slices = yes
+""")
+
+        assert parsed is not None
+        assert parsed["pipeline-slices"] is True
+
     def test_ignore_unavailable_files_yes_parses_true(self, valid_layout):
         parsed = _parse(valid_layout, extra_sections="""
 [options]
@@ -441,6 +573,71 @@ show delta = no
         assert parsed is not None
         assert parsed["show-delta"] is False
 
+    def test_hash_workers_and_buffer_parse(self, valid_layout):
+        parsed = _parse(valid_layout, extra_sections="""
+[options]
+hash workers = 8
+hash buffer = 64M
+""")
+
+        assert parsed is not None
+        assert parsed["hash-workers"] == 8
+        assert parsed["hash-buffer"] == 64 * 1048576
+
+    def test_state_database_defaults_to_json(self, valid_layout):
+        parsed = _parse(valid_layout)
+
+        assert parsed is not None
+        assert parsed["state-database"] == "json"
+
+    def test_state_database_journal_size(self, valid_layout):
+        parsed = _parse(valid_layout, extra_sections="""
+[options]
+state database = journal
+journal size = 2M
+""")
+
+        assert parsed is not None
+        assert parsed["state-database"] == "journal"
+        assert parsed["journal-size"] == 2 * 1048576
+
+    def test_state_database_accepts_sqlite(self, valid_layout):
+        parsed = _parse(valid_layout, extra_sections="""
+[options]
+state database = SQLite
+""")
+
+        assert parsed is not None
+        assert parsed["state-database"] == "sqlite"
+
+    def test_stat_cache_defaults_to_disabled(self, valid_layout):
+        parsed = _parse(valid_layout)
+
+        assert parsed is not None
+        assert parsed["stat-cache"] is False
+        assert parsed["stat-cache-verify"] == 0
+
+    def test_stat_cache_verify_accepts_number_of_runs(self, valid_layout):
+        parsed = _parse(valid_layout, extra_sections="""
+[options]
+stat cache = yes
+stat cache verify = 20
+""")
+
+        assert parsed is not None
+        assert parsed["stat-cache"] is True
+        assert parsed["stat-cache-verify"] == 0.05
+
+    def test_stat_cache_verify_accepts_percentage(self, valid_layout):
+        parsed = _parse(valid_layout, extra_sections="""
+[options]
+stat cache = yes
+stat cache verify = 10%
+""")
+
+        assert parsed is not None
+        assert parsed["stat-cache-verify"] == 0.1
+
     def test_upload_activity_log_yes_parses_true(self, valid_layout):
         parsed = _parse(valid_layout, extra_sections="""
 [options]
@@ -553,8 +750,146 @@ external file = |{exclude_rules}
         assert configuration.isExcluded(str(small)) is True
         assert configuration.isExcluded(str(big)) is True
 
+    def test_size_rules_reuse_provided_stat(self, tmp_path, monkeypatch):
+        small = tmp_path / "small.txt"
+        small.write_text("tiny")
+        info = os.stat(small)
+        with os.scandir(tmp_path) as it:
+            dirent = next(it)
+        dirent.stat()
+
+        def fail_stat(*args, **kwargs):
+            raise AssertionError("stat should not be called")
+
+        monkeypatch.setattr(configuration.os, "stat", fail_stat)
+        configuration.setting["exclude"] = [">10", "<5"]
+
+        assert configuration.isExcluded(str(small), info) is True
+        assert configuration.isExcluded(str(small), dirent) is True
+
     def test_invalid_size_rule_still_fails(self):
         configuration.setting["exclude"] = [">ten"]
 
         with pytest.raises(SystemExit):
             configuration.isExcluded("/tmp/example")
+
+    def test_invalid_size_rule_fails_at_parse(self, valid_layout, caplog):
+        caplog.set_level(logging.ERROR)
+
+        parsed = _parse(valid_layout, extra_sections="""
+[exclude]
+too big = >ten
+""", caplog=caplog)
+
+        assert parsed is None
+        assert "\"More than\" exclude rule can only have digits" in caplog.text
+
+    def test_rules_changed_after_parse_are_recompiled(self):
+        configuration.setting["exclude"] = ["*.tmp"]
+        assert configuration.isExcluded("/data/file.tmp") is True
+
+        configuration.setting["exclude"].append("*.log")
+        assert configuration.isExcluded("/data/file.log") is True
+
+        configuration.setting["exclude"] = ["*.log"]
+        assert configuration.isExcluded("/data/file.tmp") is False
+
+    def test_prefix_rule_prunes_directory(self):
+        configuration.setting["exclude"] = ["/data/cache*"]
+
+        assert configuration.canInclude("/data/cache") is False
+        assert configuration.canInclude("/data/cache/sub") is False
+        assert configuration.canInclude("/data/cached") is False
+        assert configuration.canInclude("/data/cach") is True
+        assert configuration.canInclude("/data") is True
+
+    def test_contains_rule_prunes_directory(self):
+        configuration.setting["exclude"] = ["?/node_modules/"]
+
+        assert configuration.canInclude("/src/app/node_modules") is False
+        assert configuration.canInclude("/src/app/node_modules/pkg") is False
+        assert configuration.canInclude("/src/app/modules") is True
+
+    def test_earlier_invert_rule_prevents_pruning(self):
+        configuration.setting["exclude"] = ["!*.doc", "/some/odd/dir/*"]
+
+        assert configuration.canInclude("/some/odd/dir") is True
+
+    def test_later_invert_rule_does_not_prevent_pruning(self):
+        configuration.setting["exclude"] = ["/some/odd/dir/*", "!*.doc"]
+
+        assert configuration.canInclude("/some/odd/dir") is False
+
+    def test_anchored_invert_rules_only_block_their_directories(self):
+        configuration.setting["exclude"] = ["!/data/cache/keep.txt", "!^/DATA/other/*", "/data/*"]
+
+        assert configuration.canInclude("/data/cache") is True
+        assert configuration.canInclude("/data/other/sub") is True
+        assert configuration.canInclude("/data/logs") is False
+
+    def test_pruning_is_consistent_with_file_matching(self):
+        random.seed(4321)
+        alphabet = "ab/."
+        prefixes = ["", "!", "^", "?", "*", "!^", "!?", "!*"]
+
+        def word():
+            return "".join(random.choice(alphabet) for _ in range(random.randint(0, 3)))
+
+        pruned = 0
+        for _ in range(300):
+            rules = []
+            for _ in range(random.randint(1, 6)):
+                rule = random.choice(prefixes) + "/" + word()
+                if random.random() < 0.5:
+                    rule += "*"
+                rules.append(rule)
+            configuration.setting["exclude"] = rules
+            for _ in range(10):
+                directory = "/" + word().strip("/")
+                if configuration.canInclude(directory):
+                    continue
+                pruned += 1
+                for _ in range(20):
+                    path = directory + "/" + word() + "x"
+                    assert configuration.isExcluded(path) is True, (rules, directory, path)
+        assert pruned > 0
+
+    def test_compiled_rules_match_rule_by_rule_evaluation(self):
+        random.seed(1234)
+        alphabet = "abAB/._"
+        prefixes = ["", "!", "^", "?", "*", "!^", "^?", "!*", "^*"]
+
+        def word():
+            return "".join(random.choice(alphabet) for _ in range(random.randint(0, 4)))
+
+        def reference(rules, path):
+            for raw in rules:
+                rule = configuration._parseExcludeRule(raw)
+                fv = path
+                rv = rule["value"]
+                if rule["ignorecase"]:
+                    fv = fv.casefold()
+                    rv = rv.casefold()
+                if rule["contain"]:
+                    match = rv in fv
+                elif rule["fromend"]:
+                    match = fv.endswith(rv)
+                elif rule["fromstart"]:
+                    match = fv.startswith(rv)
+                else:
+                    match = fv == rv
+                if match:
+                    return not rule["invert"]
+            return False
+
+        for _ in range(200):
+            rules = []
+            for _ in range(random.randint(1, 12)):
+                rule = random.choice(prefixes) + "/" + word()
+                if random.random() < 0.3:
+                    rule += "*"
+                rules.append(rule)
+            configuration.setting["exclude"] = rules
+            for _ in range(30):
+                path = "/" + word() + "/" + word()
+                assert configuration.isExcluded(path) == reference(rules, path), (rules, path)
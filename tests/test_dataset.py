@@ -0,0 +1,100 @@
+"""Unit tests for modules/dataset.py."""
+
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from modules import dataset
+
+
+ENTRY = {
+    "checksum": "a9993e364706816aba3e25717850c26c9cd0d89d:sha1",
+    "memberof": ["20240102-000000-00002", "20240101-000000-00001"],
+    "deleted": ["20240101-120000-00003"],
+    "stat": [3, 1700000000000000000, 1700000000000000000, 42, 2049],
+}
+
+
+def test_record_behaves_like_the_entry_it_holds():
+    record = dataset.compact(ENTRY)
+
+    assert record == ENTRY
+    assert dict(record) == ENTRY
+    assert json.loads(json.dumps(record, default=dataset.plain)) == ENTRY
+    assert record["stat"] == ENTRY["stat"]
+    assert sorted(record["memberof"]) == sorted(ENTRY["memberof"])
+
+
+@pytest.mark.parametrize("checksum", [
+    "",
+    "a9993e364706816aba3e25717850c26c9cd0d89d:sha1",
+    "ba7816bf8f01cfea414140de5dae2223b00361a396177a9cb410ff61f20015ad:sha256",
+    "a9993e364706816aba3e25717850c26c9cd0d89d",
+    "ABCDEF:sha1",
+    "abc:sha1",
+    "abcd:whirlpool",
+])
+def test_any_checksum_is_kept_as_it_was(checksum):
+    assert dataset.compact({"checksum": checksum, "memberof": []})["checksum"] == checksum
+
+
+def test_known_checksums_are_stored_as_raw_digests():
+    packed = dataset.packChecksum(ENTRY["checksum"])
+
+    assert len(packed) == 21
+    assert dataset.unpackChecksum(packed) == ENTRY["checksum"]
+
+
+def test_record_changes_like_commit_slice_makes_them():
+    record = dataset.compact({"checksum": "aa:sha1", "memberof": ["b2", "b1"], "deleted": []})
+
+    record["deleted"].append("b3")
+    record["checksum"] = ""
+    record.pop("stat", None)
+    assert record == {"checksum": "", "memberof": ["b2", "b1"], "deleted": ["b3"]}
+
+    record["memberof"].sort()
+    assert record["memberof"] == ["b1", "b2"]
+    assert record["memberof"][-1] == "b2"
+
+    merged = ["b4"]
+    merged += record["memberof"]
+    assert merged == ["b4", "b1", "b2"]
+
+    record["stat"] = [1, 2, 3, 4, 5]
+    assert "stat" in record and record.get("stat") == [1, 2, 3, 4, 5]
+    del record["deleted"]
+    assert "deleted" not in record
+
+
+def test_empty_lists_are_not_shared_between_records():
+    first = dataset.compact({"checksum": "", "memberof": [], "deleted": []})
+    second = dataset.compact({"checksum": "", "memberof": [], "deleted": []})
+
+    first["deleted"].append("b1")
+
+    assert first["deleted"] == ["b1"]
+    assert second["deleted"] == []
+
+
+def test_stat_out_of_range_is_kept():
+    stat = [1, -5, 2, 2 ** 70, 3]
+    assert dataset.compact({"checksum": "", "memberof": [], "stat": stat})["stat"] == stat
+
+
+def test_unknown_keys_are_kept():
+    entry = dict(ENTRY, future={"a": 1})
+    assert json.loads(json.dumps(dataset.compact(entry), default=dataset.plain)) == entry
+
+
+def test_object_hook_only_converts_dataset_entries():
+    text = json.dumps({"dataset": {"/a": ENTRY}, "moved": {"/b": {"reference": "x", "original": "/a"}}})
+
+    data = json.loads(text, object_hook=dataset.objectHook)
+
+    assert isinstance(data["dataset"]["/a"], dataset.FileRecord)
+    assert type(data["moved"]["/b"]) is dict
@@ -0,0 +1,156 @@
+"""Unit tests for modules/digest.py."""
+
+import concurrent.futures
+import hashlib
+import json
+import os
+import sys
+import threading
+import types
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+sys.modules.setdefault("boto3", types.SimpleNamespace(Session=object))
+botocore_exceptions = types.SimpleNamespace(
+    ClientError=Exception,
+    NoCredentialsError=Exception,
+    NoRegionError=Exception,
+)
+sys.modules.setdefault("botocore", types.SimpleNamespace(exceptions=botocore_exceptions))
+sys.modules.setdefault("botocore.exceptions", botocore_exceptions)
+
+from modules import aws  # noqa: E402
+from modules import digest  # noqa: E402
+
+MIB = 1024 * 1024
+
+
+@pytest.mark.parametrize("size, part_size", [
+    (0, MIB),
+    (100, MIB),
+    (MIB, MIB),
+    (3 * MIB + 17, MIB),
+    (5 * MIB, 2 * MIB),
+    (9 * MIB + 1, 4 * MIB),
+])
+def test_tree_hash_matches_reading_the_file(tmp_path, size, part_size):
+    data = os.urandom(size)
+    path = tmp_path / "archive"
+    path.write_bytes(data)
+
+    tree = digest.TreeHash()
+    # Odd sized writes, so leaves are assembled from several updates
+    for offset in range(0, size, 300007):
+        tree.update(data[offset:offset + 300007])
+
+    expected = aws.hashFile(str(path), part_size)
+    assert tree.final() == expected["final"].hexdigest()
+    assert tree.part_hashes(part_size) == [h.hexdigest() for h in expected["blocks"]]
+    assert tree.size == size
+
+
+@pytest.fixture(autouse=True)
+def reset_digests(monkeypatch):
+    monkeypatch.setattr(digest, "_required", set())
+    digest.configure(None)
+    yield
+    digest.configure(None)
+
+
+def _count_reads(monkeypatch):
+    reads = []
+    digester = digest.Digester
+
+    def counting_digester(kinds):
+        reads.append(sorted(kinds))
+        return digester(kinds)
+
+    monkeypatch.setattr(digest, "Digester", counting_digester)
+    return reads
+
+
+def test_all_required_digests_are_computed_in_one_pass(tmp_path, monkeypatch):
+    path = tmp_path / "archive"
+    path.write_bytes(b"data" * 1000)
+    digest.require("sha1", "sha256", "tree")
+    reads = _count_reads(monkeypatch)
+
+    assert digest.get(str(path), "sha1") == hashlib.sha1(b"data" * 1000).hexdigest()
+    assert digest.get(str(path), "sha256") == hashlib.sha256(b"data" * 1000).hexdigest()
+    assert digest.get(str(path), "tree").final() == hashlib.sha256(b"data" * 1000).hexdigest()
+    assert reads == [["sha1", "sha256", "tree"]]
+
+
+def test_recorded_digests_are_used_until_file_changes(tmp_path, monkeypatch):
+    path = tmp_path / "archive"
+    path.write_bytes(b"data")
+    digester = digest.Digester(["sha1"])
+    digester.update(b"data")
+    digest.record(str(path), digester)
+    reads = _count_reads(monkeypatch)
+
+    assert digest.get(str(path), "sha1") == hashlib.sha1(b"data").hexdigest()
+    assert reads == []
+
+    path.write_bytes(b"changed data")
+    assert digest.get(str(path), "sha1") == hashlib.sha1(b"changed data").hexdigest()
+    assert reads == [["sha1"]]
+
+
+def test_digests_are_kept_in_sidecar_between_runs(tmp_path, monkeypatch):
+    sidecar = tmp_path / "digests.json"
+    path = tmp_path / "archive"
+    path.write_bytes(os.urandom(3 * MIB))
+    gone = tmp_path / "gone"
+    gone.write_bytes(b"gone")
+    digest.require("sha256", "tree")
+    digest.configure(str(sidecar))
+    expected = digest.get(str(path), "tree").part_hashes(MIB)
+    digest.get(str(gone), "sha256")
+    gone.unlink()
+    digest.save()
+
+    digest.configure(str(sidecar))
+    reads = _count_reads(monkeypatch)
+
+    assert digest.get(str(path), "tree").part_hashes(MIB) == expected
+    assert reads == []
+    assert list(digest._cache) == [str(path)]
+    with open(sidecar, "r", encoding="utf-8") as fp:
+        assert str(path) in json.load(fp)
+
+
+def test_sidecar_is_only_written_when_saved(tmp_path):
+    sidecar = tmp_path / "digests.json"
+    digest.configure(str(sidecar))
+    for n in range(3):
+        path = tmp_path / ("archive%d" % n)
+        path.write_bytes(b"data")
+        digest.get(str(path), "sha1")
+    assert not sidecar.exists()
+
+    digest.save()
+    with open(sidecar, "r", encoding="utf-8") as fp:
+        assert len(json.load(fp)) == 3
+
+    sidecar.unlink()
+    digest.save()
+    assert not sidecar.exists()
+
+
+def test_file_asked_for_by_several_threads_is_read_once(tmp_path, monkeypatch):
+    path = tmp_path / "archive"
+    path.write_bytes(b"data" * 1000)
+    reads = _count_reads(monkeypatch)
+    barrier = threading.Barrier(4)
+
+    def ask():
+        barrier.wait()
+        return digest.get(str(path), "sha256")
+
+    with concurrent.futures.ThreadPoolExecutor(4) as executor:
+        results = list(executor.map(lambda _: ask(), range(4)))
+
+    assert results == [hashlib.sha256(b"data" * 1000).hexdigest()] * 4
+    assert reads == [["sha256"]]
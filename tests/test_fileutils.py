@@ -0,0 +1,119 @@
+"""Unit tests for modules/fileutils.py."""
+
+import hashlib
+import io
+import os
+import sys
+import tarfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from modules import fileutils  # noqa: E402
+
+
+def _build_tree(root):
+    (root / "a" / "b").mkdir(parents=True)
+    (root / "c").mkdir()
+    (root / "top.txt").write_text("top")
+    (root / "a" / "one.txt").write_text("one")
+    (root / "a" / "b" / "two.txt").write_text("two")
+    (root / "c" / "three.txt").write_text("three")
+    os.symlink("a", root / "linked-dir")
+    os.symlink("top.txt", root / "linked-file")
+    os.symlink("missing", root / "broken-link")
+
+
+def _normalize(walk):
+    result = []
+    for root, dirs, files in walk:
+        names = [f if isinstance(f, str) else f.name for f in files]
+        result.append((root, sorted(dirs), sorted(names)))
+    return result
+
+
+def test_walk_tree_matches_os_walk(tmp_path):
+    _build_tree(tmp_path)
+
+    expected = _normalize(os.walk(str(tmp_path)))
+    actual = _normalize(fileutils.walkTree(str(tmp_path)))
+
+    assert sorted(actual) == sorted(expected)
+
+
+def test_walk_tree_yields_dir_entries_with_paths(tmp_path):
+    _build_tree(tmp_path)
+
+    for root, _dirs, files in fileutils.walkTree(str(tmp_path)):
+        for entry in files:
+            assert entry.path == os.path.join(root, entry.name)
+
+
+def test_walk_tree_prunes_directories_in_place(tmp_path):
+    _build_tree(tmp_path)
+
+    visited = []
+    for root, dirs, _files in fileutils.walkTree(str(tmp_path)):
+        visited.append(root)
+        if "a" in dirs:
+            dirs.remove("a")
+
+    assert str(tmp_path / "a") not in visited
+    assert str(tmp_path / "a" / "b") not in visited
+    assert str(tmp_path / "c") in visited
+
+
+def test_walk_tree_ignores_missing_top(tmp_path):
+    assert list(fileutils.walkTree(str(tmp_path / "missing"))) == []
+
+
+def test_write_tar_stream_hashes_archived_bytes(tmp_path):
+    first = tmp_path / "first.bin"
+    first.write_bytes(os.urandom(3 * 1048576 + 17))
+    os.symlink("first.bin", tmp_path / "link")
+    out = io.BytesIO()
+
+    checksums, unavailable = fileutils.writeTarStream(
+        out, [str(first), str(tmp_path / "link"), str(tmp_path / "missing")], "sha256")
+
+    assert checksums[str(first)] == hashlib.sha256(first.read_bytes()).hexdigest() + ":sha256"
+    assert checksums[str(tmp_path / "link")] == checksums[str(first)]
+    assert unavailable == [{"path": str(tmp_path / "missing"), "reason": "No such file or directory"}]
+
+    out.seek(0)
+    with tarfile.open(fileobj=out) as tar:
+        members = tar.getmembers()
+        assert [m.name for m in members] == [str(first).lstrip("/"), str(tmp_path / "link").lstrip("/")]
+        assert all(m.isfile() for m in members)
+        assert tar.extractfile(members[1]).read() == first.read_bytes()
+
+
+def test_hashing_reader_pads_files_which_shrink():
+    reader = fileutils._HashingReader(io.BytesIO(b"abc"), "sha1", 5)
+
+    assert reader.read(10) == b"abc\0\0"
+    assert reader.missing == 2
+    assert reader.sha.hexdigest() == hashlib.sha1(b"abc").hexdigest()
+
+
+def test_compression_sampler_matches_reading_the_blocks_directly(tmp_path):
+    data = os.urandom(400000) + b"text " * 200000
+    path = tmp_path / "mixed"
+    path.write_bytes(data)
+    sampler = fileutils.CompressionSampler(len(data))
+
+    fileutils.hashFile(str(path), "sha1", sampler=sampler)
+
+    assert sampler.sampled == fileutils.SAMPLE_BLOCKS * fileutils.SAMPLE_BLOCK_SIZE
+    assert sampler.ratio() == fileutils.sampleFile(str(path), len(data))
+    assert 0.2 < sampler.ratio() < 0.8
+
+
+def test_compression_sampler_estimates_small_and_random_files(tmp_path):
+    text = tmp_path / "dump"
+    text.write_bytes(b"INSERT INTO t VALUES (1);\n" * 100)
+    noise = tmp_path / "blob.bin"
+    noise.write_bytes(os.urandom(200000))
+
+    assert fileutils.sampleFile(str(text), text.stat().st_size) < 0.1
+    assert fileutils.sampleFile(str(noise), noise.stat().st_size) == 1.0
+    assert fileutils.CompressionSampler(0).ratio() is None
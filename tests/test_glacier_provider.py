@@ -2,6 +2,8 @@
 
 import logging
 import os
+import threading
+import time
 import sys
 import types
 
@@ -16,7 +18,7 @@ botocore_exceptions = types.SimpleNamespace(
 sys.modules.setdefault("botocore", types.SimpleNamespace(exceptions=botocore_exceptions))
 sys.modules.setdefault("botocore.exceptions", botocore_exceptions)
 
-from modules.providers.glacier import GlacierProvider
+from modules.providers.glacier import GlacierProvider, _UploadEngine
 
 
 class DummyClient:
@@ -157,3 +159,255 @@ def test_upload_files_fails_when_vault_creation_fails(tmp_path, monkeypatch, cap
     assert provider.upload_files([str(archive)]) is False
     assert ("create_vault", "myvault") in client.calls
     assert "Failed to create vault myvault" in caplog.text
+
+
+class MultipartClient(DummyClient):
+    """Keeps multipart uploads around like Glacier does, optionally failing a part."""
+
+    def __init__(self, fail_offsets=()):
+        super().__init__()
+        self.fail_offsets = set(fail_offsets)
+        self.uploads = {}
+
+    def initiate_multipart_upload(self, vaultName, archiveDescription, partSize):
+        upload_id = "upload-%d" % (len(self.uploads) + 1)
+        self.uploads[upload_id] = {}
+        self.calls.append(("initiate_multipart_upload", archiveDescription))
+        return {"uploadId": upload_id}
+
+    def upload_multipart_part(self, vaultName, uploadId, body, range, checksum):
+        offset = int(range.split(" ")[1].split("-")[0])
+        self.calls.append(("upload_multipart_part", offset))
+        if offset in self.fail_offsets:
+            raise RuntimeError("connection reset")
+        self.uploads[uploadId][offset] = (len(body), checksum)
+        return {"checksum": checksum}
+
+    def list_parts(self, vaultName, uploadId, **kwargs):
+        if uploadId not in self.uploads:
+            raise FakeClientError("ResourceNotFoundException")
+        return {"Parts": [
+            {"RangeInBytes": "%d-%d" % (offset, offset + size - 1), "SHA256TreeHash": checksum}
+            for offset, (size, checksum) in sorted(self.uploads[uploadId].items())
+        ]}
+
+    def complete_multipart_upload(self, vaultName, uploadId, archiveSize, checksum):
+        self.calls.append(("complete_multipart_upload", uploadId))
+        self.uploads.pop(uploadId)
+        return {"archiveId": "archive"}
+
+    def abort_multipart_upload(self, vaultName, uploadId):
+        self.calls.append(("abort_multipart_upload", uploadId))
+        self.uploads.pop(uploadId, None)
+
+
+def _resumable_provider(monkeypatch, client, state_dir):
+    sleep = time.sleep
+    monkeypatch.setattr("modules.providers.glacier.time.sleep", lambda seconds: sleep(0.001))
+    monkeypatch.setattr(
+        "modules.providers.glacier.aws.create_glacier_client",
+        lambda aws_config: (client, None),
+    )
+    provider = GlacierProvider(state_dir=str(state_dir), vault="myvault", threads="1")
+    assert provider.verify() is True
+    return provider
+
+
+def _write_archive(path, megabytes):
+    with open(path, "wb") as fp:
+        for i in range(megabytes):
+            fp.write(bytes([i]) * (1024 * 1024))
+        fp.write(b"tail")
+    return str(path)
+
+
+def _uploaded_offsets(client):
+    return [offset for op, offset in client.calls if op == "upload_multipart_part"]
+
+
+def test_interrupted_upload_is_resumed(tmp_path, monkeypatch):
+    archive = _write_archive(tmp_path / "backup.tar", 3)
+    client = MultipartClient(fail_offsets={1024 * 1024})
+    provider = _resumable_provider(monkeypatch, client, tmp_path)
+
+    assert provider.upload_files([archive]) is False
+    assert (tmp_path / "glacier-uploads-myvault.json").exists()
+    assert list(client.uploads["upload-1"]) == [0]
+    assert ("abort_multipart_upload", "upload-1") not in client.calls
+
+    client.fail_offsets = set()
+    client.calls = []
+    provider = _resumable_provider(monkeypatch, client, tmp_path)
+
+    assert provider.upload_files([archive]) is True
+    assert _uploaded_offsets(client) == [1024 * 1024, 2 * 1024 * 1024, 3 * 1024 * 1024]
+    assert ("initiate_multipart_upload", "backup.tar") not in client.calls
+    assert ("complete_multipart_upload", "upload-1") in client.calls
+    assert not (tmp_path / "glacier-uploads-myvault.json").exists()
+
+
+def test_upload_starts_over_when_upload_expired(tmp_path, monkeypatch):
+    archive = _write_archive(tmp_path / "backup.tar", 1)
+    client = MultipartClient(fail_offsets={1024 * 1024})
+    provider = _resumable_provider(monkeypatch, client, tmp_path)
+
+    assert provider.upload_files([archive]) is False
+
+    client.uploads = {}
+    client.fail_offsets = set()
+    client.calls = []
+
+    assert provider.upload_files([archive]) is True
+    assert _uploaded_offsets(client) == [0, 1024 * 1024]
+    assert ("initiate_multipart_upload", "backup.tar") in client.calls
+
+
+def test_stale_uploads_are_aborted(tmp_path, monkeypatch):
+    old = _write_archive(tmp_path / "old.tar", 1)
+    client = MultipartClient(fail_offsets={1024 * 1024})
+    provider = _resumable_provider(monkeypatch, client, tmp_path)
+
+    assert provider.upload_files([old]) is False
+
+    new = tmp_path / "new.tar"
+    new.write_text("small")
+    assert provider.upload_files([str(new)]) is True
+    assert ("abort_multipart_upload", "upload-1") in client.calls
+    assert client.uploads == {}
+    assert not (tmp_path / "glacier-uploads-myvault.json").exists()
+
+
+def test_engine_keeps_parts_in_memory_within_budget(tmp_path):
+    path = tmp_path / "backup.tar"
+    path.write_bytes(b"x" * 1000)
+
+    class CountingClient:
+        def __init__(self):
+            self.lock = threading.Lock()
+            self.inflight = 0
+            self.peak = 0
+            self.offsets = []
+
+        def upload_multipart_part(self, vaultName, uploadId, body, range, checksum):
+            with self.lock:
+                self.inflight += len(body)
+                self.peak = max(self.peak, self.inflight)
+            time.sleep(0.01)
+            with self.lock:
+                self.inflight -= len(body)
+                self.offsets.append(int(range.split(" ")[1].split("-")[0]))
+            return {"checksum": checksum}
+
+    client = CountingClient()
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        engine = _UploadEngine(client, "myvault", "upload-1", fd, threads=4, budget=250)
+        engine.start([(offset, 100, "hash") for offset in range(0, 1000, 100)])
+        assert engine.wait(10) is True
+        assert engine.finish() is True
+    finally:
+        os.close(fd)
+
+    assert sorted(client.offsets) == list(range(0, 1000, 100))
+    assert client.peak <= 200
+    assert engine.get_sent() == 1000
+
+
+def test_engine_uploads_parts_larger_than_budget_one_at_a_time(tmp_path):
+    path = tmp_path / "backup.tar"
+    path.write_bytes(b"x" * 300)
+
+    class Client:
+        def __init__(self):
+            self.bodies = []
+
+        def upload_multipart_part(self, vaultName, uploadId, body, range, checksum):
+            self.bodies.append(body)
+            return {"checksum": checksum}
+
+    client = Client()
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        engine = _UploadEngine(client, "myvault", "upload-1", fd, threads=2, budget=10)
+        engine.start([(0, 200, "a"), (200, 100, "b")])
+        assert engine.finish() is True
+    finally:
+        os.close(fd)
+
+    assert sorted(len(b) for b in client.bodies) == [100, 200]
+
+
+def test_engine_reuses_part_buffers_and_rewinds_them_on_retry(tmp_path, monkeypatch):
+    data = os.urandom(1000)
+    path = tmp_path / "backup.tar"
+    path.write_bytes(data)
+    monkeypatch.setattr(time, "sleep", lambda seconds: None)
+
+    class Client:
+        def __init__(self):
+            self.parts = {}
+            self.failed = set()
+            self.buffers = set()
+
+        def upload_multipart_part(self, vaultName, uploadId, body, range, checksum):
+            offset = int(range.split(" ")[1].split("-")[0])
+            content = body.read()
+            self.buffers.add(id(body.view.obj))
+            if offset not in self.failed:
+                self.failed.add(offset)
+                raise IOError("connection reset")
+            self.parts[offset] = content
+            return {"checksum": checksum}
+
+    client = Client()
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        engine = _UploadEngine(client, "myvault", "upload-1", fd, threads=1, budget=100)
+        engine.start([(offset, min(100, 1000 - offset), "hash") for offset in range(0, 1000, 100)])
+        assert engine.finish() is True
+    finally:
+        os.close(fd)
+
+    assert b"".join(client.parts[offset] for offset in sorted(client.parts)) == data
+    assert len(client.buffers) == 1
+
+
+def test_engine_without_budget_uploads_a_part_per_thread(tmp_path):
+    path = tmp_path / "backup.tar"
+    path.write_bytes(b"x" * 400)
+    barrier = threading.Barrier(4, timeout=5)
+
+    class Client:
+        def upload_multipart_part(self, vaultName, uploadId, body, range, checksum):
+            barrier.wait()
+            return {"checksum": checksum}
+
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        engine = _UploadEngine(Client(), "myvault", "upload-1", fd, threads=4, budget=0)
+        engine.start([(offset, 100, "hash") for offset in range(0, 400, 100)])
+        assert engine.finish() is True
+    finally:
+        os.close(fd)
+
+
+def test_upload_uses_tree_hash_recorded_while_writing(tmp_path, monkeypatch):
+    from modules import digest
+
+    data = b"x" * (3 * 1024 * 1024)
+    path = tmp_path / "backup.tar"
+    path.write_bytes(data)
+    digest.configure(None)
+    digester = digest.Digester(["tree"])
+    digester.update(data)
+    digest.record(str(path), digester)
+
+    monkeypatch.setattr(
+        "modules.digest.Digester",
+        lambda *args: (_ for _ in ()).throw(AssertionError("file should not be read for hashing")),
+    )
+    client = MultipartClient()
+    provider = _resumable_provider(monkeypatch, client, tmp_path)
+
+    assert provider.upload_files([str(path)]) is True
+    assert _uploaded_offsets(client) == [0, 1024 * 1024, 2 * 1024 * 1024]
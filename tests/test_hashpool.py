@@ -0,0 +1,110 @@
+"""Unit tests for modules/hashpool.py."""
+
+import hashlib
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from modules import hashpool  # noqa: E402
+
+
+def _sha1(data):
+    return hashlib.sha1(data).hexdigest() + ":sha1"
+
+
+def _create_files(tmp_path, count):
+    files = []
+    for index in range(count):
+        path = tmp_path / ("file%03d" % index)
+        path.write_bytes(os.urandom(1000 + index))
+        files.append(path)
+    return files
+
+
+@pytest.mark.parametrize("workers", [1, 4])
+def test_results_follow_submission_order(tmp_path, workers):
+    files = _create_files(tmp_path, 50)
+    pool = hashpool.HashPool("sha1", workers=workers)
+    try:
+        for path in files:
+            pool.submit(str(path), filename=str(path), size=path.stat().st_size)
+        results = [(context, checksum()) for context, checksum in pool.results(wait=True)]
+    finally:
+        pool.close()
+
+    assert [context for context, _ in results] == [str(path) for path in files]
+    for path, (_, checksum) in zip(files, results):
+        assert checksum == _sha1(path.read_bytes())
+
+
+def test_precomputed_entries_keep_their_place(tmp_path):
+    files = _create_files(tmp_path, 3)
+    pool = hashpool.HashPool("sha1", workers=2)
+    try:
+        pool.submit("first", filename=str(files[0]), size=1000)
+        pool.submit("cached", checksum="abc:sha1")
+        pool.submit("skipped")
+        pool.submit("last", filename=str(files[2]), size=1002)
+        results = [(context, checksum()) for context, checksum in pool.results(wait=True)]
+    finally:
+        pool.close()
+
+    assert results == [
+        ("first", _sha1(files[0].read_bytes())),
+        ("cached", "abc:sha1"),
+        ("skipped", None),
+        ("last", _sha1(files[2].read_bytes())),
+    ]
+
+
+def test_serial_pool_only_hashes_on_demand(tmp_path, monkeypatch):
+    files = _create_files(tmp_path, 2)
+    calls = []
+    original = hashpool.fileutils.hashFile
+
+    def counting_hash(*args, **kwargs):
+        calls.append(args[0])
+        return original(*args, **kwargs)
+
+    monkeypatch.setattr(hashpool.fileutils, "hashFile", counting_hash)
+    pool = hashpool.HashPool("sha1", workers=1)
+    pool.submit("a", filename=str(files[0]), size=1000)
+    pool.submit("b", filename=str(files[1]), size=1001)
+    results = list(pool.results())
+    pool.close()
+
+    assert [context for context, _ in results] == ["a", "b"]
+    assert calls == []
+    assert results[1][1]() == _sha1(files[1].read_bytes())
+    assert calls == [str(files[1])]
+
+
+def test_errors_are_raised_when_result_is_requested(tmp_path):
+    files = _create_files(tmp_path, 1)
+    pool = hashpool.HashPool("sha1", workers=2)
+    try:
+        pool.submit("missing", filename=str(tmp_path / "missing"), size=10)
+        pool.submit("present", filename=str(files[0]), size=1000)
+        results = list(pool.results(wait=True))
+    finally:
+        pool.close()
+
+    with pytest.raises(FileNotFoundError):
+        results[0][1]()
+    assert results[1][1]() == _sha1(files[0].read_bytes())
+
+
+def test_budget_forces_oldest_entry_to_be_handed_back(tmp_path):
+    files = _create_files(tmp_path, 3)
+    pool = hashpool.HashPool("sha1", workers=2, budget=1500)
+    try:
+        pool.submit("a", filename=str(files[0]), size=1000)
+        pool.submit("b", filename=str(files[1]), size=1001)
+        retired = [context for context, _ in pool.results()]
+        assert retired[:1] == ["a"]
+        assert pool.inflight <= 1500
+    finally:
+        pool.close()
@@ -49,7 +49,8 @@ class NoRegionError(Exception):
 """.strip() + "\n")
 
 
-def _write_config(path, source_dir, *, max_size="", loop_slices=None):
+def _write_config(path, source_dir, *, max_size="", loop_slices=None, persuasive=None,
+                  pipeline_slices=None, hash_workers=None):
     option_lines = [
         f"max size = {max_size}",
         "compress = no",
@@ -57,6 +58,12 @@ def _write_config(path, source_dir, *, max_size="", loop_slices=None):
     ]
     if loop_slices is not None:
         option_lines.append(f"loop slices = {loop_slices}")
+    if persuasive is not None:
+        option_lines.append(f"persuasive = {persuasive}")
+    if pipeline_slices is not None:
+        option_lines.append(f"pipeline slices = {pipeline_slices}")
+    if hash_workers is not None:
+        option_lines.append(f"hash workers = {hash_workers}")
 
     path.write_text(f"""
 [sources]
@@ -122,6 +129,33 @@ def test_max_size_loops_through_all_slices_by_default(tmp_path):
     assert sorted(os.listdir(tmp_path / "done")) == backup_ids
 
 
+def test_pipelined_slices_are_committed_in_order(tmp_path):
+    source_dir = tmp_path / "source"
+    _create_source_files(source_dir)
+
+    config_path = tmp_path / "iceshelf.conf"
+    _write_config(config_path, source_dir, max_size="10", pipeline_slices="yes")
+
+    result = _run_iceshelf(config_path)
+
+    assert result.returncode == 0, result.stderr
+    data = _load_checksum(tmp_path)
+    backup_ids = sorted(data["backups"])
+
+    assert len(backup_ids) == 3
+    assert data["lastbackup"] == backup_ids[-1]
+    assert sorted(os.listdir(tmp_path / "done")) == backup_ids
+    assert sorted(f for files in data["backups"].values() for f in files if f.endswith(".tar")) == \
+        sorted(b + ".tar" for b in backup_ids)
+
+    previous = None
+    for backup_id in backup_ids:
+        with open(tmp_path / "done" / backup_id / (backup_id + ".json"), "r", encoding="utf-8") as fp:
+            manifest = json.load(fp)
+        assert manifest["previousbackup"] == previous
+        previous = backup_id
+
+
 def test_max_size_can_keep_legacy_rerun_behavior(tmp_path):
     source_dir = tmp_path / "source"
     _create_source_files(source_dir)
@@ -145,6 +179,23 @@ def test_max_size_can_keep_legacy_rerun_behavior(tmp_path):
     assert sorted(os.listdir(tmp_path / "done")) == backup_ids
 
 
+def test_hash_workers_leave_the_same_files_for_the_next_run(tmp_path):
+    source_dir = tmp_path / "source"
+    source_dir.mkdir()
+    for n in range(12):
+        (source_dir / ("file%02d.txt" % n)).write_text("123456")
+
+    config_path = tmp_path / "iceshelf.conf"
+    _write_config(config_path, source_dir, max_size="10", loop_slices="no", hash_workers="4")
+
+    results = [_run_iceshelf(config_path) for _ in range(12)]
+
+    assert [r.returncode for r in results] == [10] * 11 + [0]
+    data = _load_checksum(tmp_path)
+    assert sorted(data["dataset"]) == sorted(str(p) for p in source_dir.iterdir())
+    assert all(len(v["memberof"]) == 1 for v in data["dataset"].values())
+
+
 def test_unlimited_backup_stays_single_archive(tmp_path):
     source_dir = tmp_path / "source"
     _create_source_files(source_dir)
@@ -180,3 +231,78 @@ def test_overlimit_run_does_not_mark_existing_files_deleted(tmp_path):
     data = _load_checksum(tmp_path)
     assert data["dataset"][str(source_dir / "a.txt")]["checksum"] != ""
     assert len(data["backups"]) == 1
+
+
+def test_max_size_plans_all_slices_from_a_single_scan(tmp_path):
+    source_dir = tmp_path / "source"
+    _create_source_files(source_dir)
+
+    config_path = tmp_path / "iceshelf.conf"
+    _write_config(config_path, source_dir, max_size="10")
+
+    result = _run_iceshelf(config_path)
+
+    assert result.returncode == 0
+    assert "will be stored in 3 slices" in result.stdout
+    assert result.stdout.count("Checking sources for changes") == 1
+    data = _load_checksum(tmp_path)
+    assert sorted(len(files) for files in data["backups"].values()) == [2, 2, 2]
+    for name in ("a.txt", "b.txt", "c.txt"):
+        assert len(data["dataset"][str(source_dir / name)]["memberof"]) == 1
+
+
+def test_persuasive_slices_fill_up_with_smaller_files(tmp_path):
+    source_dir = tmp_path / "source"
+    source_dir.mkdir()
+    (source_dir / "big1.txt").write_text("12345678")
+    (source_dir / "big2.txt").write_text("12345678")
+    (source_dir / "small.txt").write_text("12")
+
+    config_path = tmp_path / "iceshelf.conf"
+    _write_config(config_path, source_dir, max_size="10", persuasive="yes")
+
+    result = _run_iceshelf(config_path)
+
+    assert result.returncode == 0
+    data = _load_checksum(tmp_path)
+    assert len(data["backups"]) == 2
+
+
+def test_deletions_are_recorded_in_first_slice(tmp_path):
+    source_dir = tmp_path / "source"
+    _create_source_files(source_dir)
+
+    initial_config = tmp_path / "initial.conf"
+    _write_config(initial_config, source_dir, max_size="")
+    assert _run_iceshelf(initial_config).returncode == 0
+
+    (source_dir / "a.txt").unlink()
+    (source_dir / "b.txt").write_text("abcdef")
+    (source_dir / "c.txt").write_text("ghijkl")
+
+    config_path = tmp_path / "iceshelf.conf"
+    _write_config(config_path, source_dir, max_size="10")
+    result = _run_iceshelf(config_path)
+
+    assert result.returncode == 0
+    data = _load_checksum(tmp_path)
+    slice_ids = sorted(backup_id for backup_id in data["backups"] if "-s" in backup_id)
+    assert len(slice_ids) == 2
+    assert data["dataset"][str(source_dir / "a.txt")]["deleted"] == [slice_ids[0]]
+    assert data["dataset"][str(source_dir / "a.txt")]["checksum"] == ""
+
+
+def test_too_big_file_is_reported_after_all_slices(tmp_path):
+    source_dir = tmp_path / "source"
+    _create_source_files(source_dir)
+    (source_dir / "huge.txt").write_text("x" * 20)
+
+    config_path = tmp_path / "iceshelf.conf"
+    _write_config(config_path, source_dir, max_size="10")
+
+    result = _run_iceshelf(config_path)
+
+    assert result.returncode == 3
+    data = _load_checksum(tmp_path)
+    assert len(data["backups"]) == 3
+    assert str(source_dir / "huge.txt") not in data["dataset"]
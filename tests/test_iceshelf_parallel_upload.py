@@ -0,0 +1,202 @@
+"""Behavior tests for uploading a slice to several providers at once."""
+
+import json
+import os
+import subprocess
+import sys
+
+
+REPO_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+ICESHELF_BIN = os.path.join(REPO_ROOT, "iceshelf")
+
+
+def _write_stub_modules(stub_root):
+    botocore_dir = stub_root / "botocore"
+    botocore_dir.mkdir(parents=True, exist_ok=True)
+    (stub_root / "paramiko.py").write_text("""
+class PasswordRequiredException(Exception):
+    pass
+
+
+class AuthenticationException(Exception):
+    pass
+
+
+class SSHClient:
+    pass
+
+
+class AutoAddPolicy:
+    pass
+""".strip() + "\n")
+    (stub_root / "boto3.py").write_text("""
+class Session:
+    def __init__(self, *args, **kwargs):
+        pass
+""".strip() + "\n")
+    (botocore_dir / "__init__.py").write_text("")
+    (botocore_dir / "exceptions.py").write_text("""
+class ClientError(Exception):
+    pass
+
+
+class NoCredentialsError(Exception):
+    pass
+
+
+class NoRegionError(Exception):
+    pass
+""".strip() + "\n")
+
+
+def _write_config(path, source_dir, destinations):
+    providers = "\n".join(f"""
+[provider-{name}]
+type = cp
+dest = {dest}
+create = yes
+""" for name, dest in destinations.items())
+
+    path.write_text(f"""
+[sources]
+source = {source_dir}
+
+[paths]
+prep dir = {path.parent / "prep"}
+data dir = {path.parent / "data"}
+done dir = {path.parent / "done"}
+create paths = yes
+
+[options]
+compress = no
+create filelist = no
+{providers}
+""".strip() + "\n")
+
+
+def _write_failing_copy(stub_root, dest):
+    # Makes the cp provider fail to store anything in dest
+    (stub_root / "sitecustomize.py").write_text(f"""
+import shutil
+
+_copy = shutil.copy
+
+
+def _failing_copy(src, dst, *args, **kwargs):
+    if str(dst).startswith({str(dest)!r}):
+        raise OSError("simulated upload failure")
+    return _copy(src, dst, *args, **kwargs)
+
+
+shutil.copy = _failing_copy
+""".strip() + "\n")
+
+
+def _run_iceshelf(config_path, failing_dest=None, args=()):
+    stub_root = config_path.parent / "stubs"
+    _write_stub_modules(stub_root)
+    if failing_dest is not None:
+        _write_failing_copy(stub_root, failing_dest)
+    elif (stub_root / "sitecustomize.py").exists():
+        (stub_root / "sitecustomize.py").unlink()
+
+    env = os.environ.copy()
+    existing_pythonpath = env.get("PYTHONPATH", "")
+    env["PYTHONPATH"] = str(stub_root) if not existing_pythonpath else str(stub_root) + os.pathsep + existing_pythonpath
+
+    return subprocess.run(
+        [sys.executable, ICESHELF_BIN, "--logfile", str(config_path.parent / "iceshelf.log")] + list(args) + [str(config_path)],
+        cwd=REPO_ROOT,
+        capture_output=True,
+        text=True,
+        env=env,
+    )
+
+
+def test_slice_is_stored_by_every_provider(tmp_path):
+    source_dir = tmp_path / "source"
+    source_dir.mkdir()
+    (source_dir / "a.txt").write_text("hello")
+
+    destinations = {"first": tmp_path / "first", "second": tmp_path / "second"}
+    config_path = tmp_path / "iceshelf.conf"
+    _write_config(config_path, source_dir, destinations)
+
+    result = _run_iceshelf(config_path)
+
+    assert result.returncode == 0, result.stderr
+    with open(tmp_path / "data" / "checksum.json", "r", encoding="utf-8") as fp:
+        data = json.load(fp)
+    assert len(data["backups"]) == 1
+    files = sorted(next(iter(data["backups"].values())))
+    for dest in destinations.values():
+        assert sorted(os.listdir(dest)) == files
+
+    log = (tmp_path / "iceshelf.log").read_text()
+    assert log.count("Backup provider cp stored") == 2
+
+
+def test_failed_upload_is_resumed_by_next_run(tmp_path):
+    source_dir = tmp_path / "source"
+    source_dir.mkdir()
+    (source_dir / "a.txt").write_text("hello")
+
+    destinations = {"first": tmp_path / "first", "second": tmp_path / "second"}
+    config_path = tmp_path / "iceshelf.conf"
+    _write_config(config_path, source_dir, destinations)
+
+    result = _run_iceshelf(config_path, failing_dest=destinations["second"])
+
+    assert result.returncode == 1
+    assert not (tmp_path / "data" / "checksum.json").exists()
+    with open(tmp_path / "data" / "pending.json", "r", encoding="utf-8") as fp:
+        pending = json.load(fp)
+
+    result = _run_iceshelf(config_path)
+
+    assert result.returncode == 0, result.stderr
+    assert not (tmp_path / "data" / "pending.json").exists()
+    with open(tmp_path / "data" / "checksum.json", "r", encoding="utf-8") as fp:
+        data = json.load(fp)
+    assert list(data["backups"]) == [pending["unique"]]
+    assert sorted(os.listdir(destinations["second"])) == sorted(pending["files"])
+    assert "Resuming upload of unfinished slice " + pending["unique"] in (tmp_path / "iceshelf.log").read_text()
+
+
+def test_slice_which_keeps_failing_can_be_discarded(tmp_path):
+    source_dir = tmp_path / "source"
+    source_dir.mkdir()
+    (source_dir / "a.txt").write_text("hello")
+
+    destinations = {"first": tmp_path / "first", "second": tmp_path / "second"}
+    config_path = tmp_path / "iceshelf.conf"
+    _write_config(config_path, source_dir, destinations)
+    pending_path = tmp_path / "data" / "pending.json"
+
+    assert _run_iceshelf(config_path, failing_dest=destinations["second"]).returncode == 1
+    with open(pending_path, "r", encoding="utf-8") as fp:
+        pending = json.load(fp)
+
+    result = _run_iceshelf(config_path, failing_dest=destinations["second"])
+
+    assert result.returncode == 1
+    assert 'Unable to upload the unfinished slice recorded in "%s"' % pending_path in (tmp_path / "iceshelf.log").read_text()
+    assert "--discard-pending" in (tmp_path / "iceshelf.log").read_text()
+
+    result = _run_iceshelf(config_path, failing_dest=destinations["second"], args=["--discard-pending"])
+
+    assert result.returncode == 1
+    assert "Discarding unfinished slice " + pending["unique"] in (tmp_path / "iceshelf.log").read_text()
+    with open(pending_path, "r", encoding="utf-8") as fp:
+        assert json.load(fp)["unique"] != pending["unique"]
+
+    del destinations["second"]
+    _write_config(config_path, source_dir, destinations)
+    result = _run_iceshelf(config_path, args=["--discard-pending"])
+
+    assert result.returncode == 0, result.stderr
+    assert not pending_path.exists()
+    with open(tmp_path / "data" / "checksum.json", "r", encoding="utf-8") as fp:
+        data = json.load(fp)
+    assert pending["unique"] not in data["backups"]
+    assert list(data["dataset"]) == [str(source_dir / "a.txt")]
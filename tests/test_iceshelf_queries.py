@@ -0,0 +1,158 @@
+"""Behavior tests for the read-only queries (--list, --modified, --show, --find) of the iceshelf CLI."""
+
+import os
+import stat
+import subprocess
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from modules import statedb
+
+
+REPO_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+ICESHELF_BIN = os.path.join(REPO_ROOT, "iceshelf")
+
+FIRST = "20240101-000000-00001"
+SECOND = "20240102-000000-00002"
+
+STATE = {
+    "version": [1, 1, 0],
+    "timestamp": 1700000000.5,
+    "dataset": {
+        "/src/100%_Done.txt": {"checksum": "aa:sha1", "memberof": [SECOND, FIRST], "deleted": []},
+        "/src/gone.txt": {"checksum": "", "memberof": [FIRST], "deleted": [SECOND]},
+        "/src/moved.txt": {"checksum": "cc:sha1", "memberof": [FIRST], "deleted": []},
+    },
+    "backups": {
+        FIRST: [FIRST + ".tar", FIRST + ".json"],
+        SECOND: [SECOND + ".tar", SECOND + ".json"],
+    },
+    "vault": None,
+    "storage": ["sftp:backup@example.com:/srv"],
+    "moved": {"/src/moved.txt": {"reference": SECOND, "original": "/src/old.txt"}},
+    "lastbackup": SECOND,
+}
+
+
+def _write_config(tmp_path, state_database):
+    path = tmp_path / "iceshelf.conf"
+    path.write_text(f"""
+[sources]
+source = {tmp_path / "source"}
+
+[paths]
+prep dir = {tmp_path / "prep"}
+data dir = {tmp_path / "data"}
+done dir = {tmp_path / "done"}
+create paths = yes
+
+[options]
+state database = {state_database}
+
+[security]
+encrypt = backup@example.com
+sign = backup@example.com
+
+[provider-remote]
+type = sftp
+user = backup
+host = example.com
+""".strip() + "\n")
+    return path
+
+
+@pytest.fixture
+def run_query(tmp_path):
+    """
+    Runs iceshelf with a config using an SFTP provider and GPG. Importing
+    paramiko or running gpg leaves a mark, neither should happen.
+    """
+    (tmp_path / "source").mkdir()
+    stub_root = tmp_path / "stubs"
+    stub_root.mkdir()
+    marks = tmp_path / "marks"
+    (stub_root / "paramiko.py").write_text(
+        "open(%r, 'a').write('paramiko\\n')\n" % str(marks))
+    gpg = stub_root / "gpg"
+    gpg.write_text("#!/bin/sh\necho gpg >> %s\nexit 1\n" % marks)
+    gpg.chmod(gpg.stat().st_mode | stat.S_IEXEC)
+
+    env = os.environ.copy()
+    env["PYTHONPATH"] = str(stub_root) + os.pathsep + env.get("PYTHONPATH", "")
+    env["PATH"] = str(stub_root) + os.pathsep + env.get("PATH", "")
+
+    def run(state_database, *args, returncode=0):
+        config_path = _write_config(tmp_path, state_database)
+        result = subprocess.run(
+            [sys.executable, ICESHELF_BIN, str(config_path)] + list(args),
+            cwd=REPO_ROOT,
+            capture_output=True,
+            text=True,
+            env=env,
+        )
+        output = result.stdout + result.stderr
+        assert result.returncode == returncode, output
+        assert not marks.exists(), marks.read_text()
+        return output
+
+    return run
+
+
+def _write_state(tmp_path, state_database):
+    data_dir = tmp_path / "data"
+    data_dir.mkdir()
+    statedb.writeJson(str(data_dir / "checksum.json"), STATE)
+    if state_database == "sqlite":
+        statedb.importJson(str(data_dir / "checksum.json"), str(data_dir / "checksum.db"))
+        os.remove(data_dir / "checksum.json")
+
+
+@pytest.mark.parametrize("state_database", ["json", "sqlite"])
+def test_queries_need_neither_providers_nor_gpg(tmp_path, run_query, state_database):
+    _write_state(tmp_path, state_database)
+
+    output = run_query(state_database, "--find", "%_d")
+    assert '"/src/100%%_Done.txt", exists in:\n    %s\n    %s\n' % (FIRST, SECOND) in output
+    assert "Found 1 instances" in output
+
+    output = run_query(state_database, "--find", "nothing", returncode=1)
+    assert "Found 0 instances" in output
+
+    output = run_query(state_database, "--show", SECOND)
+    assert 'Members of "%s":\n  %s.tar\n  %s.json\n' % (SECOND, SECOND, SECOND) in output
+
+    output = run_query(state_database, "--show", "20990101-000000-00000")
+    assert 'No such backup, "20990101-000000-00000"' in output
+
+    output = run_query(state_database, "--modified")
+    assert '"/src/100%_Done.txt" modified 2 times' in output
+    assert "Found 1 files (of 3) which have been modified" in output
+
+    output = run_query(state_database, "--list", "files")
+    assert '"/src/100%_Done.txt"\n"/src/moved.txt"\n' in output
+    assert "gone.txt" not in output
+
+    output = run_query(state_database, "--list", "members")
+    assert '%s "/src/100%%_Done.txt"\n%s "/src/old.txt" moved to "/src/moved.txt"\n' % (SECOND, SECOND) in output
+
+    output = run_query(state_database, "--list", "sets")
+    assert output.count(SECOND + "\n") == 1
+
+
+def test_queries_read_a_state_left_in_the_other_format(tmp_path, run_query):
+    _write_state(tmp_path, "sqlite")
+
+    output = run_query("json", "--find", "moved")
+
+    assert '"/src/moved.txt", exists in:' in output
+    assert not (tmp_path / "data" / "checksum.json").exists()
+    assert (tmp_path / "data" / "checksum.db").exists()
+
+
+def test_queries_on_a_first_run_find_nothing(tmp_path, run_query):
+    output = run_query("json", "--find", "txt", returncode=1)
+
+    assert "Found 0 instances" in output
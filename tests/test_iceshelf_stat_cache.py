@@ -0,0 +1,178 @@
+"""Behavior tests for metadata based change detection in the iceshelf CLI."""
+
+import json
+import os
+import subprocess
+import sys
+
+
+REPO_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+ICESHELF_BIN = os.path.join(REPO_ROOT, "iceshelf")
+
+
+def _write_stub_modules(stub_root):
+    botocore_dir = stub_root / "botocore"
+    botocore_dir.mkdir(parents=True, exist_ok=True)
+    (stub_root / "paramiko.py").write_text("""
+class PasswordRequiredException(Exception):
+    pass
+
+
+class AuthenticationException(Exception):
+    pass
+
+
+class SSHClient:
+    pass
+
+
+class AutoAddPolicy:
+    pass
+""".strip() + "\n")
+    (stub_root / "boto3.py").write_text("""
+class Session:
+    def __init__(self, *args, **kwargs):
+        pass
+""".strip() + "\n")
+    (botocore_dir / "__init__.py").write_text("")
+    (botocore_dir / "exceptions.py").write_text("""
+class ClientError(Exception):
+    pass
+
+
+class NoCredentialsError(Exception):
+    pass
+
+
+class NoRegionError(Exception):
+    pass
+""".strip() + "\n")
+
+
+def _write_config(path, source_dir, *, stat_cache="yes", verify="0"):
+    path.write_text(f"""
+[sources]
+source = {source_dir}
+
+[paths]
+prep dir = {path.parent / "prep"}
+data dir = {path.parent / "data"}
+done dir = {path.parent / "done"}
+create paths = yes
+
+[options]
+compress = no
+create filelist = no
+skip empty = yes
+stat cache = {stat_cache}
+stat cache verify = {verify}
+""".strip() + "\n")
+
+
+def _run_iceshelf(config_path):
+    stub_root = config_path.parent / "stubs"
+    _write_stub_modules(stub_root)
+
+    env = os.environ.copy()
+    existing_pythonpath = env.get("PYTHONPATH", "")
+    env["PYTHONPATH"] = str(stub_root) if not existing_pythonpath else str(stub_root) + os.pathsep + existing_pythonpath
+
+    return subprocess.run(
+        [sys.executable, ICESHELF_BIN, str(config_path)],
+        cwd=REPO_ROOT,
+        capture_output=True,
+        text=True,
+        env=env,
+    )
+
+
+def _checksum_path(tmp_path):
+    return tmp_path / "data" / "checksum.json"
+
+
+def _load_checksum(tmp_path):
+    with open(_checksum_path(tmp_path), "r", encoding="utf-8") as fp:
+        return json.load(fp)
+
+
+def _tamper_checksum(tmp_path, filename):
+    data = _load_checksum(tmp_path)
+    data["dataset"][filename]["checksum"] = "0" * 40 + ":sha1"
+    with open(_checksum_path(tmp_path), "w", encoding="utf-8") as fp:
+        json.dump(data, fp)
+
+
+def _create_source_files(source_dir):
+    source_dir.mkdir()
+    (source_dir / "a.txt").write_text("first\n")
+    (source_dir / "b.txt").write_text("second\n")
+
+
+def test_stat_cache_records_metadata_for_each_file(tmp_path):
+    source_dir = tmp_path / "source"
+    _create_source_files(source_dir)
+
+    config_path = tmp_path / "iceshelf.conf"
+    _write_config(config_path, source_dir)
+
+    result = _run_iceshelf(config_path)
+
+    assert result.returncode == 0, result.stdout + result.stderr
+    entry = _load_checksum(tmp_path)["dataset"][str(source_dir / "a.txt")]
+    info = os.stat(source_dir / "a.txt")
+    assert entry["stat"] == [info.st_size, info.st_mtime_ns, info.st_ctime_ns, info.st_ino, info.st_dev]
+
+
+def test_stat_cache_skips_hashing_unchanged_files(tmp_path):
+    source_dir = tmp_path / "source"
+    _create_source_files(source_dir)
+
+    config_path = tmp_path / "iceshelf.conf"
+    _write_config(config_path, source_dir)
+
+    assert _run_iceshelf(config_path).returncode == 0
+    _tamper_checksum(tmp_path, str(source_dir / "a.txt"))
+
+    result = _run_iceshelf(config_path)
+
+    assert result.returncode == 0, result.stdout + result.stderr
+    assert "No changes detected, skipping backup" in result.stdout
+    assert len(_load_checksum(tmp_path)["backups"]) == 1
+
+
+def test_stat_cache_verify_detects_silent_changes(tmp_path):
+    source_dir = tmp_path / "source"
+    _create_source_files(source_dir)
+
+    config_path = tmp_path / "iceshelf.conf"
+    _write_config(config_path, source_dir, verify="100%")
+
+    assert _run_iceshelf(config_path).returncode == 0
+    _tamper_checksum(tmp_path, str(source_dir / "a.txt"))
+
+    result = _run_iceshelf(config_path)
+
+    assert result.returncode == 0, result.stdout + result.stderr
+    assert "possible bit rot" in result.stdout
+    data = _load_checksum(tmp_path)
+    assert len(data["backups"]) == 2
+    assert len(data["dataset"][str(source_dir / "a.txt")]["memberof"]) == 2
+    assert len(data["dataset"][str(source_dir / "b.txt")]["memberof"]) == 1
+
+
+def test_changed_file_is_detected_with_stat_cache(tmp_path):
+    source_dir = tmp_path / "source"
+    _create_source_files(source_dir)
+
+    config_path = tmp_path / "iceshelf.conf"
+    _write_config(config_path, source_dir)
+
+    assert _run_iceshelf(config_path).returncode == 0
+    (source_dir / "b.txt").write_text("second, but longer\n")
+
+    result = _run_iceshelf(config_path)
+
+    assert result.returncode == 0, result.stdout + result.stderr
+    data = _load_checksum(tmp_path)
+    assert len(data["dataset"][str(source_dir / "b.txt")]["memberof"]) == 2
+    assert data["dataset"][str(source_dir / "b.txt")]["stat"][0] == len("second, but longer\n")
@@ -0,0 +1,222 @@
+"""Behavior tests for the state database option in the iceshelf CLI."""
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from modules import statedb
+
+
+REPO_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+ICESHELF_BIN = os.path.join(REPO_ROOT, "iceshelf")
+
+
+def _write_stub_modules(stub_root):
+    botocore_dir = stub_root / "botocore"
+    botocore_dir.mkdir(parents=True, exist_ok=True)
+    (stub_root / "paramiko.py").write_text("""
+class PasswordRequiredException(Exception):
+    pass
+
+
+class AuthenticationException(Exception):
+    pass
+
+
+class SSHClient:
+    pass
+
+
+class AutoAddPolicy:
+    pass
+""".strip() + "\n")
+    (stub_root / "boto3.py").write_text("""
+class Session:
+    def __init__(self, *args, **kwargs):
+        pass
+""".strip() + "\n")
+    (botocore_dir / "__init__.py").write_text("")
+    (botocore_dir / "exceptions.py").write_text("""
+class ClientError(Exception):
+    pass
+
+
+class NoCredentialsError(Exception):
+    pass
+
+
+class NoRegionError(Exception):
+    pass
+""".strip() + "\n")
+
+
+def _write_config(path, source_dir, state_database, journal_size):
+    path.write_text(f"""
+[sources]
+source = {source_dir}
+
+[paths]
+prep dir = {path.parent / "prep"}
+data dir = {path.parent / "data"}
+done dir = {path.parent / "done"}
+create paths = yes
+
+[options]
+compress = no
+create filelist = no
+skip empty = yes
+detect move = yes
+stat cache = yes
+state database = {state_database}
+journal size = {journal_size}
+""".strip() + "\n")
+
+
+def _run_iceshelf(tmp_path, state_database, journal_size="64M", args=(), returncode=0):
+    config_path = tmp_path / "iceshelf.conf"
+    _write_config(config_path, tmp_path / "source", state_database, journal_size)
+    stub_root = tmp_path / "stubs"
+    _write_stub_modules(stub_root)
+
+    env = os.environ.copy()
+    existing_pythonpath = env.get("PYTHONPATH", "")
+    env["PYTHONPATH"] = str(stub_root) if not existing_pythonpath else str(stub_root) + os.pathsep + existing_pythonpath
+
+    result = subprocess.run(
+        [sys.executable, ICESHELF_BIN, str(config_path)] + list(args),
+        cwd=REPO_ROOT,
+        capture_output=True,
+        text=True,
+        env=env,
+    )
+    assert result.returncode == returncode, result.stdout + result.stderr
+    return result
+
+
+def _normalized(root, data):
+    """
+    Replaces backup names with their order, the run's own directory with a
+    placeholder and stat signatures with whether one was kept.
+    """
+    done_dir = root / "done"
+    names = sorted(data["backups"], key=lambda name: os.stat(done_dir / name).st_mtime_ns)
+    text = json.dumps({k: data[k] for k in ("dataset", "backups", "moved", "lastbackup")}, sort_keys=True)
+    for i, name in enumerate(names):
+        text = text.replace(name, "backup%d" % i)
+    normalized = json.loads(text.replace(str(root), "ROOT"))
+    for item in normalized["dataset"].values():
+        if "stat" in item:
+            item["stat"] = True
+    return normalized
+
+
+def _backup_history(tmp_path, state_database, switch_to=None, journal_size="64M"):
+    """Three backups with new, changed, deleted and moved files in between."""
+    source_dir = tmp_path / "source"
+    source_dir.mkdir(parents=True)
+    (source_dir / "a.txt").write_text("first\n")
+    (source_dir / "b.txt").write_text("second\n")
+    (source_dir / "c.txt").write_text("third\n")
+    _run_iceshelf(tmp_path, state_database, journal_size)
+
+    (source_dir / "a.txt").write_text("first, changed\n")
+    (source_dir / "b.txt").unlink()
+    (source_dir / "c.txt").rename(source_dir / "moved.txt")
+    _run_iceshelf(tmp_path, state_database, journal_size)
+
+    (source_dir / "d.txt").write_text("fourth\n")
+    _run_iceshelf(tmp_path, switch_to or state_database, journal_size)
+
+
+def test_sqlite_state_matches_json_state(tmp_path):
+    _backup_history(tmp_path / "json", "json")
+    _backup_history(tmp_path / "sqlite", "sqlite")
+
+    json_state = statedb.load(str(tmp_path / "json" / "data" / "checksum.json"))
+    sqlite_path = tmp_path / "sqlite" / "data" / "checksum.db"
+    assert statedb.isSqlite(str(sqlite_path))
+    assert not (tmp_path / "sqlite" / "data" / "checksum.json").exists()
+    sqlite_state = statedb.load(str(sqlite_path))
+
+    assert _normalized(tmp_path / "sqlite", sqlite_state) == _normalized(tmp_path / "json", json_state)
+    assert len(sqlite_state["backups"]) == 3
+    assert sqlite_state["dataset"][str(tmp_path / "sqlite" / "source" / "d.txt")]["stat"]
+
+
+def test_switching_state_database_converts_the_state(tmp_path):
+    _backup_history(tmp_path / "json", "json")
+    _backup_history(tmp_path / "to-sqlite", "json", switch_to="sqlite")
+
+    data_dir = tmp_path / "to-sqlite" / "data"
+    assert (data_dir / "checksum.json.converted").exists()
+    assert _normalized(tmp_path / "to-sqlite", statedb.load(str(data_dir / "checksum.db"))) == \
+        _normalized(tmp_path / "json", statedb.load(str(tmp_path / "json" / "data" / "checksum.json")))
+
+    shutil.rmtree(tmp_path / "to-sqlite" / "source")
+    (tmp_path / "to-sqlite" / "source").mkdir()
+    result = _run_iceshelf(tmp_path / "to-sqlite", "json")
+
+    assert "Converting state" in result.stdout + result.stderr
+    assert (data_dir / "checksum.db.converted").exists()
+    state = statedb.load(str(data_dir / "checksum.json"))
+    assert len(state["backups"]) == 4
+    assert all(item["checksum"] == "" for item in state["dataset"].values())
+
+
+def test_journal_state_matches_json_state(tmp_path):
+    _backup_history(tmp_path / "json", "json")
+    _backup_history(tmp_path / "journal", "journal")
+
+    data_dir = tmp_path / "journal" / "data"
+    with open(data_dir / "checksum.journal", "rb") as fp:
+        assert len(fp.read().splitlines()) == 2
+    with open(data_dir / "checksum.json", "r", encoding="utf-8") as fp:
+        assert len(json.load(fp)["backups"]) == 1
+
+    assert _normalized(tmp_path / "journal", statedb.load(str(data_dir / "checksum.json"))) == \
+        _normalized(tmp_path / "json", statedb.load(str(tmp_path / "json" / "data" / "checksum.json")))
+
+
+def test_journal_is_folded_into_the_snapshot_once_too_large(tmp_path):
+    _backup_history(tmp_path, "journal", journal_size="1")
+
+    data_dir = tmp_path / "data"
+    assert not (data_dir / "checksum.journal").exists()
+    with open(data_dir / "checksum.json", "r", encoding="utf-8") as fp:
+        assert len(json.load(fp)["backups"]) == 3
+
+
+def test_json_mode_folds_a_leftover_journal(tmp_path):
+    _backup_history(tmp_path, "journal", switch_to="json")
+
+    data_dir = tmp_path / "data"
+    assert not (data_dir / "checksum.journal").exists()
+    with open(data_dir / "checksum.json", "r", encoding="utf-8") as fp:
+        assert len(json.load(fp)["backups"]) == 3
+
+
+def test_find_and_show_read_the_journal_too(tmp_path):
+    _backup_history(tmp_path, "journal")
+    state = statedb.load(str(tmp_path / "data" / "checksum.json"))
+    last = state["lastbackup"]
+
+    result = _run_iceshelf(tmp_path, "journal", args=["--find", "/D.TXT"])
+    output = result.stdout + result.stderr
+    assert '"%s", exists in:' % (tmp_path / "source" / "d.txt") in output
+    assert "    " + last in output
+    assert "Found 1 instances" in output
+
+    result = _run_iceshelf(tmp_path, "journal", args=["--find", "b.txt"])
+    assert "exists in:" in result.stdout + result.stderr
+
+    result = _run_iceshelf(tmp_path, "journal", args=["--find", "nothing"], returncode=1)
+    assert "Found 0 instances" in result.stdout + result.stderr
+
+    result = _run_iceshelf(tmp_path, "journal", args=["--show", last.upper()])
+    output = result.stdout + result.stderr
+    assert 'Members of "%s":' % last in output
+    assert "  %s.json" % last in output
@@ -3,9 +3,12 @@
 import bz2
 import json
 import os
+import shutil
 import subprocess
 import sys
 
+import pytest
+
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
 from modules import fileutils
 from modules import helper
@@ -71,7 +74,12 @@ def _write_config(path, source_dir, *, compress="no", encrypt=False, sign=False,
                   tolerate_unreconcilable_files="no",
                   show_delta="no",
                   detect_move="no",
-                  upload_activity_log="no"):
+                  upload_activity_log="no",
+                  stream_hash="no",
+                  compressor="bzip2",
+                  compress_level="",
+                  compress_detection="extension",
+                  split_archives="no"):
     key_file_path = path.parent / "combined_test.key"
     if use_key_file and (encrypt or sign):
         _write_key_file(key_file_path)
@@ -106,12 +114,17 @@ create paths = yes
 
 [options]
 compress = {compress}
+compressor = {compressor}
+compress level = {compress_level}
+compress detection = {compress_detection}
+split archives = {split_archives}
 create filelist = {create_filelist}
 ignore unavailable files = {ignore_unavailable_files}
 tolerate unreconcilable files = {tolerate_unreconcilable_files}
 show delta = {show_delta}
 detect move = {detect_move}
 upload activity log = {upload_activity_log}
+stream hash = {stream_hash}
 """.strip() + "\n" + ("\n" + "\n".join(security_lines) + "\n" if security_lines else ""))
 
 
@@ -300,6 +313,120 @@ def test_archive_filenames_cover_streamed_variants(tmp_path):
         assert archive_files == [backup_id + suffix]
 
 
+@pytest.mark.parametrize("detection,expected", [
+    ("extension", {"misnamed": ".tar.bz2", "mislabeled": ".tar"}),
+    ("sample", {"misnamed": ".tar", "mislabeled": ".tar.bz2"}),
+])
+def test_compress_detection_decides_per_slice(tmp_path, detection, expected):
+    for case, suffix in expected.items():
+        case_dir = tmp_path / case
+        source_dir = case_dir / "source"
+        source_dir.mkdir(parents=True)
+        if case == "misnamed":
+            (source_dir / "blob.txt").write_bytes(os.urandom(300000))
+        else:
+            (source_dir / "dump.jpg").write_text("INSERT INTO t VALUES (1);\n" * 20000)
+
+        config_path = case_dir / "iceshelf.conf"
+        _write_config(config_path, source_dir, compress="yes", compress_detection=detection)
+
+        result = _run_iceshelf(config_path)
+
+        assert result.returncode == 0, result.stdout + result.stderr
+        backup_id = _load_backup_id(case_dir)
+        files = _archive_files_for_backup(case_dir, backup_id)
+        assert [name for name in files if name.startswith(backup_id + ".tar")] == [backup_id + suffix]
+
+
+def test_split_archives_store_incompressible_files_uncompressed(tmp_path):
+    source_dir = tmp_path / "source"
+    _create_source_files(source_dir)
+    (source_dir / "photo.jpg").write_bytes(os.urandom(50000))
+
+    config_path = tmp_path / "iceshelf.conf"
+    _write_config(config_path, source_dir, compress="yes", encrypt=True, sign=True,
+                  split_archives="yes")
+    extra_env = _prepare_fake_tool_env(tmp_path)
+
+    result = _run_iceshelf(config_path, extra_env=extra_env)
+
+    assert result.returncode == 0, result.stdout + result.stderr
+    assert "partly compressed" in result.stdout
+    backup_id = _load_backup_id(tmp_path)
+    backup_dir = tmp_path / "done" / backup_id
+    files = _archive_files_for_backup(tmp_path, backup_id)
+    assert [name for name in files if ".tar" in name] == [
+        backup_id + ".tar.bz2.gpg.sig",
+        backup_id + ".tar.gpg.sig",
+    ]
+    with bz2.open(backup_dir / (backup_id + ".tar.bz2.gpg.sig")) as fp:
+        assert b"photo.jpg" not in fp.read()
+    manifest_path = backup_dir / (backup_id + ".json.gpg.asc")
+    assert _load_manifest(manifest_path)["archives"] == [backup_id + ".tar.bz2", backup_id + ".tar"]
+
+    restore_dir = tmp_path / "restore"
+    restore = _run_restore([
+        "--passphrase", "test",
+        "--restore", str(restore_dir),
+        str(manifest_path),
+    ], extra_env=extra_env)
+    assert restore.returncode == 0, restore.stdout + restore.stderr
+    restored = restore_dir / str(source_dir).lstrip(os.sep)
+    assert (restored / "a.txt").read_text() == "hello world\n"
+    assert (restored / "photo.jpg").read_bytes() == (source_dir / "photo.jpg").read_bytes()
+    assert "Left-over" not in restore.stdout + restore.stderr
+
+
+@pytest.mark.parametrize("compressor,suffix", [
+    ("zstd", ".tar.zst"),
+    ("xz", ".tar.xz"),
+    ("lz4", ".tar.lz4"),
+])
+def test_alternative_compressors_archive_and_restore(tmp_path, compressor, suffix):
+    if shutil.which(compressor) is None:
+        pytest.skip("%s is not installed" % compressor)
+    source_dir = tmp_path / "source"
+    _create_source_files(source_dir)
+
+    config_path = tmp_path / "iceshelf.conf"
+    _write_config(config_path, source_dir, compress="force", compressor=compressor,
+                  compress_level="1", create_filelist="yes")
+
+    result = _run_iceshelf(config_path)
+
+    assert result.returncode == 0, result.stdout + result.stderr
+    backup_id = _load_backup_id(tmp_path)
+    backup_dir = tmp_path / "done" / backup_id
+    files = _archive_files_for_backup(tmp_path, backup_id)
+    assert [name for name in files if name.startswith(backup_id + ".tar")] == [backup_id + suffix]
+
+    restore_dir = tmp_path / "restore"
+    restore = _run_restore([
+        "--restore", str(restore_dir),
+        str(backup_dir / (backup_id + ".json")),
+    ])
+    assert restore.returncode == 0, restore.stdout + restore.stderr
+    assert (restore_dir / str(source_dir).lstrip(os.sep) / "a.txt").read_text() == "hello world\n"
+    assert (restore_dir / str(source_dir).lstrip(os.sep) / "nested" / "b.txt").read_text() == "second file\n"
+
+
+def test_missing_alternative_compressor_is_reported(tmp_path):
+    source_dir = tmp_path / "source"
+    _create_source_files(source_dir)
+
+    config_path = tmp_path / "iceshelf.conf"
+    _write_config(config_path, source_dir, compress="force", compressor="zstd", done_dir=None)
+
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    os.symlink("/usr/bin/tar", bin_dir / "tar")
+
+    result = _run_iceshelf(config_path, extra_env={"PATH": str(bin_dir)})
+
+    assert result.returncode == 2
+    assert "Compression was requested, but zstd was not found" in result.stdout
+
+
 def test_activity_log_filenames_cover_security_variants(tmp_path):
     cases = [
         (False, False, ".activity.log.bz2"),
@@ -762,3 +889,67 @@ def test_select_bzip2_compressor_prefers_parallel_variants():
     assert fileutils.select_bzip2_compressor({"pbzip2": "/bin/pbzip2", "bzip2": "/bin/bzip2"}.get) == "/bin/pbzip2"
     assert fileutils.select_bzip2_compressor({"bzip2": "/bin/bzip2"}.get) == "/bin/bzip2"
     assert fileutils.select_bzip2_compressor({}.get) is None
+
+
+def test_select_compressor_builds_multithreaded_commands():
+    mapping = {"zstd": "/bin/zstd", "xz": "/bin/xz", "lz4": "/bin/lz4", "pbzip2": "/bin/pbzip2"}
+
+    assert fileutils.select_compressor("zstd", 9, mapping.get) == ["/bin/zstd", "-T0", "-q", "-9", "-c"]
+    assert fileutils.select_compressor("xz", None, mapping.get) == ["/bin/xz", "-T0", "-c"]
+    assert fileutils.select_compressor("lz4", None, mapping.get) == ["/bin/lz4", "-q", "-c"]
+    assert fileutils.select_compressor("bzip2", 1, mapping.get) == ["/bin/pbzip2", "-1", "-c"]
+    assert fileutils.select_compressor("zstd", None, {}.get) is None
+
+
+def test_compressor_for_archive_matches_suffixes():
+    assert fileutils.compressorForArchive("20240101-000000-00000.tar.zst") == "zstd"
+    assert fileutils.compressorForArchive("20240101-000000-00000.tar.xz") == "xz"
+    assert fileutils.compressorForArchive("20240101-000000-00000.tar.bz2") == "bzip2"
+    assert fileutils.compressorForArchive("20240101-000000-00000.tar") is None
+
+
+def test_stream_hash_records_checksums_of_archived_content(tmp_path):
+    source_dir = tmp_path / "source"
+    _create_source_files(source_dir)
+
+    config_path = tmp_path / "iceshelf.conf"
+    _write_config(config_path, source_dir, compress="force", encrypt=True, sign=True, stream_hash="yes")
+    extra_env = _prepare_fake_tool_env(tmp_path)
+    os.unlink(tmp_path / "bin" / "tar")
+
+    result = _run_iceshelf(config_path, extra_env=extra_env)
+
+    assert result.returncode == 0, result.stdout + result.stderr
+    backup_id = _load_backup_id(tmp_path)
+    backup_dir = tmp_path / "done" / backup_id
+    manifest_path = str(next(backup_dir.glob(backup_id + ".json*")))
+    dataset = _load_manifest(tmp_path / "data" / "checksum.json")["dataset"]
+    expected = fileutils.hashFile(str(source_dir / "a.txt"), "sha1", True)
+    assert dataset[str(source_dir / "a.txt")]["checksum"] == expected
+    assert _load_manifest(manifest_path)["modified"][str(source_dir / "a.txt")]["checksum"] == expected
+
+    restore_dir = tmp_path / "restore"
+    restore = _run_restore([
+        "--passphrase", "test",
+        "--restore", str(restore_dir),
+        manifest_path,
+    ], extra_env=extra_env)
+    assert restore.returncode == 0, restore.stdout + restore.stderr
+    assert (restore_dir / str(source_dir).lstrip(os.sep) / "a.txt").read_text() == "hello world\n"
+    assert (restore_dir / str(source_dir).lstrip(os.sep) / "nested" / "b.txt").read_text() == "second file\n"
+
+
+def test_stream_hash_detects_unchanged_files_on_next_run(tmp_path):
+    source_dir = tmp_path / "source"
+    _create_source_files(source_dir)
+
+    config_path = tmp_path / "iceshelf.conf"
+    _write_config(config_path, source_dir, stream_hash="yes")
+
+    assert _run_iceshelf(config_path).returncode == 0
+    (source_dir / "nested" / "b.txt").write_text("changed\n")
+    result = _run_iceshelf(config_path, extra_args=["--changes"])
+
+    assert result.returncode == 1
+    assert "\"%s\" changed" % (source_dir / "nested" / "b.txt") in result.stdout
+    assert str(source_dir / "a.txt") not in result.stdout
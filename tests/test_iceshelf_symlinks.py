@@ -9,7 +9,7 @@ REPO_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
 ICESHELF_BIN = os.path.join(REPO_ROOT, "iceshelf")
 
 
-def _write_config(path, source_dir, skip_broken_links="no"):
+def _write_config(path, source_dir, skip_broken_links="no", hash_workers="1"):
     path.write_text(f"""
 [sources]
 source = {source_dir}
@@ -22,6 +22,7 @@ create paths = yes
 
 [options]
 skip broken links = {skip_broken_links}
+hash workers = {hash_workers}
 """.strip() + "\n")
 
 
@@ -125,3 +126,39 @@ def test_valid_symlink_still_works(tmp_path):
     assert result.returncode == 1
     assert "Broken symbolic link" not in result.stdout
     assert "\"%s\" is new" % (source_dir / "valid-link") in result.stdout
+
+
+def test_broken_symlink_fails_cleanly_with_hash_workers(tmp_path):
+    source_dir = tmp_path / "source"
+    source_dir.mkdir()
+    for index in range(20):
+        (source_dir / ("file%02d.txt" % index)).write_text("data %d" % index)
+    os.symlink("missing-target", source_dir / "broken-link")
+
+    config_path = tmp_path / "iceshelf.conf"
+    _write_config(config_path, source_dir, skip_broken_links="no", hash_workers="4")
+
+    result = _run_iceshelf(config_path)
+
+    assert result.returncode == 1
+    assert "Broken symbolic link" in result.stdout
+    assert "Traceback" not in result.stdout
+    assert "Traceback" not in result.stderr
+
+
+def test_broken_symlink_can_be_skipped_with_hash_workers(tmp_path):
+    source_dir = tmp_path / "source"
+    source_dir.mkdir()
+    for index in range(20):
+        (source_dir / ("file%02d.txt" % index)).write_text("data %d" % index)
+    os.symlink("missing-target", source_dir / "broken-link")
+
+    config_path = tmp_path / "iceshelf.conf"
+    _write_config(config_path, source_dir, skip_broken_links="yes", hash_workers="4")
+
+    result = _run_iceshelf(config_path)
+
+    assert result.returncode == 1
+    assert "skipping" in result.stdout
+    for index in range(20):
+        assert "\"%s\" is new" % (source_dir / ("file%02d.txt" % index)) in result.stdout
@@ -0,0 +1,75 @@
+"""Unit tests for modules/jsonstream.py."""
+
+import io
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from modules import jsonstream
+
+
+DOCUMENT = {
+    "version": [1, 1, 0],
+    "timestamp": 1700000000.123456,
+    "dataset": {
+        "/src/åäö": {"checksum": "aa:sha1", "memberof": ["b1"], "deleted": []},
+        "/src/\"quoted\"": {"checksum": "", "memberof": ["b1", "b2"], "deleted": ["b2"], "stat": [123456789, -1, 0, 2 ** 63, 7]},
+        "/src/\U0001f600": {"checksum": "cc:sha1", "memberof": [], "deleted": []},
+    },
+    "backups": {},
+    "vault": None,
+    "moved": {"/src/new": {"reference": "b1", "original": "/src/old"}},
+    "lastbackup": "b2",
+}
+
+
+@pytest.mark.parametrize("chunk", [1, 2, 3, 7, 1 << 20])
+@pytest.mark.parametrize("indent", [None, 2])
+def test_load_matches_json_load_whatever_the_chunk_size(chunk, indent):
+    text = json.dumps(DOCUMENT, ensure_ascii=False, indent=indent)
+
+    for fp in (io.StringIO(text), io.BytesIO(text.encode("utf-8"))):
+        assert jsonstream.load(fp, ("dataset", "backups", "moved"), chunk=chunk) == DOCUMENT
+
+
+def test_streamed_members_come_one_entry_at_a_time():
+    fp = io.StringIO(json.dumps(DOCUMENT))
+
+    events = list(jsonstream.iterate(fp, ("dataset",), chunk=5))
+
+    assert events[:3] == [
+        ("version", None, [1, 1, 0]),
+        ("timestamp", None, 1700000000.123456),
+        ("dataset", None, {}),
+    ]
+    assert [(key, name) for key, name, _ in events[3:6]] == [("dataset", name) for name in DOCUMENT["dataset"]]
+    assert events[6] == ("backups", None, {})
+
+
+def test_object_hook_sees_the_entries():
+    seen = []
+
+    def hook(obj):
+        seen.append(obj)
+        return obj
+
+    jsonstream.load(io.StringIO(json.dumps(DOCUMENT)), ("dataset",), hook, chunk=4)
+
+    assert DOCUMENT["dataset"]["/src/\U0001f600"] in seen
+    assert DOCUMENT["dataset"] in seen
+
+
+@pytest.mark.parametrize("text", [
+    '{"dataset": {"a": 1,}}',
+    '{"dataset": {"a": 1}',
+    '{"a": 1} {}',
+    '["not", "an", "object"]',
+    '{"a": tru}',
+])
+def test_malformed_documents_are_rejected(text):
+    with pytest.raises(json.JSONDecodeError):
+        jsonstream.load(io.StringIO(text), ("dataset",), chunk=3)
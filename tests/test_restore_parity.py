@@ -177,6 +177,41 @@ def test_get_files_for_basename_supports_signed_archive_and_signed_parity(tmp_pa
     ]
 
 
+def test_get_files_for_basename_includes_both_archives_of_split_backup(tmp_path):
+    basename = "backup"
+    backup_dir = tmp_path
+    for name in (
+        "backup.json.asc",
+        "backup.tar.bz2.gpg.sig",
+        "backup.tar.bz2.gpg.sig.par2.sig",
+        "backup.tar.gpg.sig",
+        "backup.tar.gpg.sig.par2.sig",
+    ):
+        (backup_dir / name).write_text("x")
+
+    found = restoreutils.get_files_for_basename(str(backup_dir), basename)
+
+    assert found == [
+        "backup.json.asc",
+        "backup.tar.bz2.gpg.sig",
+        "backup.tar.bz2.gpg.sig.par2.sig",
+        "backup.tar.gpg.sig",
+        "backup.tar.gpg.sig.par2.sig",
+    ]
+
+
+def test_select_backup_archives_uses_manifest_listing(tmp_path):
+    for name in ("backup.tar.zst.gpg", "backup.tar.zst", "backup.tar.gpg", "backup.tar"):
+        (tmp_path / name).write_text("x")
+
+    found = restoreutils.get_archive_files(str(tmp_path), "backup")
+
+    assert found == [str(tmp_path / "backup.tar.zst.gpg"), str(tmp_path / "backup.tar.gpg")]
+    assert restoreutils.select_backup_archives(found, {"archives": ["backup.tar.zst", "backup.tar"]}) == found
+    # Backups which weren't split only ever have one archive, anything else is left-over
+    assert restoreutils.select_backup_archives(found, {"modified": {}}) == found[:1]
+
+
 def test_get_files_for_basename_includes_activity_log_sidecar(tmp_path):
     basename = "backup"
     backup_dir = tmp_path
@@ -1,10 +1,15 @@
 """Unit tests for modules/providers/s3.py."""
 
+import hashlib
+import json
 import logging
 import os
 import sys
+import threading
 import types
 
+import pytest
+
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
 sys.modules.setdefault("paramiko", types.SimpleNamespace())
 sys.modules.setdefault("boto3", types.SimpleNamespace(Session=object))
@@ -45,7 +50,7 @@ class DummyClient:
             raise self.create_error
         self.bucket_exists = True
 
-    def upload_file(self, filename, bucket, key, **kwargs):
+    def upload_file(self, filename, bucket, key, Config=None, Callback=None, **kwargs):
         self.calls.append({
             "op": "upload_file",
             "filename": filename,
@@ -53,6 +58,23 @@ class DummyClient:
             "key": key,
             "kwargs": kwargs,
         })
+        if Callback is not None:
+            Callback(os.path.getsize(filename))
+
+
+@pytest.fixture(autouse=True)
+def transfer_configs(monkeypatch):
+    created = []
+
+    def fake_transfer_config(part_size, part_threads):
+        created.append({"part_size": part_size, "part_threads": part_threads})
+        return created[-1]
+
+    monkeypatch.setattr(
+        "modules.providers.s3.aws.create_s3_transfer_config",
+        fake_transfer_config,
+    )
+    return created
 
 
 class FakeClientError(Exception):
@@ -68,7 +90,7 @@ def test_upload_files_without_storage_class_omits_extra_args(tmp_path, monkeypat
 
     monkeypatch.setattr(
         "modules.providers.s3.aws.create_s3_client",
-        lambda aws_config: (client, None),
+        lambda aws_config, **kwargs: (client, None),
     )
 
     provider = S3Provider(bucket="mybucket")
@@ -94,7 +116,7 @@ def test_upload_files_with_storage_class_passes_normalized_extra_args(tmp_path,
 
     monkeypatch.setattr(
         "modules.providers.s3.aws.create_s3_client",
-        lambda aws_config: (client, None),
+        lambda aws_config, **kwargs: (client, None),
     )
 
     provider = S3Provider(bucket="mybucket", **{"storage class": "deep-archive"})
@@ -124,7 +146,7 @@ def test_verify_fails_for_unsupported_storage_class(monkeypatch, caplog):
 
     monkeypatch.setattr(
         "modules.providers.s3.aws.create_s3_client",
-        lambda aws_config: (_ for _ in ()).throw(AssertionError("should not be called")),
+        lambda aws_config, **kwargs: (_ for _ in ()).throw(AssertionError("should not be called")),
     )
 
     provider = S3Provider(
@@ -144,7 +166,7 @@ def test_upload_files_logs_success(tmp_path, monkeypatch, caplog):
 
     monkeypatch.setattr(
         "modules.providers.s3.aws.create_s3_client",
-        lambda aws_config: (client, None),
+        lambda aws_config, **kwargs: (client, None),
     )
 
     provider = S3Provider(bucket="mybucket")
@@ -159,7 +181,7 @@ def test_verify_rejects_invalid_create_value(monkeypatch, caplog):
 
     monkeypatch.setattr(
         "modules.providers.s3.aws.create_s3_client",
-        lambda aws_config: (_ for _ in ()).throw(AssertionError("should not be called")),
+        lambda aws_config, **kwargs: (_ for _ in ()).throw(AssertionError("should not be called")),
     )
 
     provider = S3Provider(bucket="mybucket", create="true")
@@ -176,7 +198,7 @@ def test_upload_files_fails_when_bucket_missing_and_create_disabled(tmp_path, mo
 
     monkeypatch.setattr(
         "modules.providers.s3.aws.create_s3_client",
-        lambda aws_config: (client, None),
+        lambda aws_config, **kwargs: (client, None),
     )
 
     provider = S3Provider(bucket="mybucket", create="no")
@@ -197,7 +219,7 @@ def test_upload_files_creates_missing_bucket_when_enabled(tmp_path, monkeypatch)
 
     monkeypatch.setattr(
         "modules.providers.s3.aws.create_s3_client",
-        lambda aws_config: (client, None),
+        lambda aws_config, **kwargs: (client, None),
     )
 
     provider = S3Provider(bucket="mybucket", create="yes", region="us-west-2")
@@ -230,7 +252,7 @@ def test_upload_files_fails_when_bucket_creation_fails(tmp_path, monkeypatch, ca
 
     monkeypatch.setattr(
         "modules.providers.s3.aws.create_s3_client",
-        lambda aws_config: (client, None),
+        lambda aws_config, **kwargs: (client, None),
     )
 
     provider = S3Provider(bucket="mybucket", create="yes", region="us-east-1")
@@ -248,7 +270,7 @@ def test_upload_files_fails_for_unrelated_bucket_check_error(tmp_path, monkeypat
 
     monkeypatch.setattr(
         "modules.providers.s3.aws.create_s3_client",
-        lambda aws_config: (client, None),
+        lambda aws_config, **kwargs: (client, None),
     )
 
     provider = S3Provider(bucket="mybucket")
@@ -256,3 +278,263 @@ def test_upload_files_fails_for_unrelated_bucket_check_error(tmp_path, monkeypat
     assert provider.verify() is True
     assert provider.upload_files([str(archive)]) is False
     assert "unable to check bucket mybucket" in caplog.text
+
+
+def test_verify_applies_part_size_and_threads(monkeypatch, transfer_configs, tmp_path):
+    archive = tmp_path / "backup.tar"
+    archive.write_text("backup-data")
+    client = DummyClient()
+    pools = []
+
+    def fake_create_s3_client(aws_config, max_pool_connections=None):
+        pools.append(max_pool_connections)
+        return client, None
+
+    monkeypatch.setattr("modules.providers.s3.aws.create_s3_client", fake_create_s3_client)
+
+    provider = S3Provider(bucket="mybucket", **{"part size": "64M", "part threads": "4", "threads": "3"})
+
+    assert provider.verify() is True
+    assert pools == [12]
+    assert provider.upload_files([str(archive)]) is True
+    assert transfer_configs == [{"part_size": 64 * 1024 * 1024, "part_threads": 4}]
+
+
+@pytest.mark.parametrize("options, message", [
+    ({"part size": "1M"}, "part size must be at least 5M"),
+    ({"part size": "lots"}, "part size must be at least 5M"),
+    ({"threads": "0"}, "threads and part threads must be positive numbers"),
+    ({"part threads": "many"}, "threads and part threads must be positive numbers"),
+])
+def test_verify_rejects_invalid_transfer_options(monkeypatch, caplog, options, message):
+    caplog.set_level(logging.ERROR)
+
+    monkeypatch.setattr(
+        "modules.providers.s3.aws.create_s3_client",
+        lambda aws_config, **kwargs: (_ for _ in ()).throw(AssertionError("should not be called")),
+    )
+
+    provider = S3Provider(bucket="mybucket", **options)
+
+    assert provider.verify() is False
+    assert message in caplog.text
+
+
+def test_upload_files_uploads_several_files_at_once(tmp_path, monkeypatch):
+    files = []
+    for name in ("backup.tar", "backup.par2", "backup.vol0+1.par2"):
+        path = tmp_path / name
+        path.write_text(name)
+        files.append(str(path))
+
+    class BlockingClient(DummyClient):
+        def __init__(self):
+            super().__init__()
+            self.barrier = threading.Barrier(len(files), timeout=10)
+
+        def upload_file(self, filename, bucket, key, **kwargs):
+            self.barrier.wait()
+            super().upload_file(filename, bucket, key, **kwargs)
+
+    client = BlockingClient()
+    monkeypatch.setattr(
+        "modules.providers.s3.aws.create_s3_client",
+        lambda aws_config, **kwargs: (client, None),
+    )
+
+    provider = S3Provider(bucket="mybucket", threads="3")
+
+    assert provider.verify() is True
+    assert provider.upload_files(files) is True
+    assert sorted(c["key"] for c in client.calls if c["op"] == "upload_file") == \
+        sorted(os.path.basename(f) for f in files)
+
+
+def test_upload_files_fails_when_one_file_fails(tmp_path, monkeypatch, caplog):
+    caplog.set_level(logging.ERROR)
+    files = []
+    for name in ("backup.tar", "backup.par2"):
+        path = tmp_path / name
+        path.write_text(name)
+        files.append(str(path))
+
+    class FailingClient(DummyClient):
+        def upload_file(self, filename, bucket, key, **kwargs):
+            if key == "backup.par2":
+                raise RuntimeError("boom")
+            super().upload_file(filename, bucket, key, **kwargs)
+
+    client = FailingClient()
+    monkeypatch.setattr(
+        "modules.providers.s3.aws.create_s3_client",
+        lambda aws_config, **kwargs: (client, None),
+    )
+
+    provider = S3Provider(bucket="mybucket", threads="2")
+
+    assert provider.verify() is True
+    assert provider.upload_files(files) is False
+    assert "s3 upload failed for %s" % files[1] in caplog.text
+    assert "Stored" not in caplog.text
+
+
+class MultipartClient(DummyClient):
+    """Keeps multipart uploads around like S3 does, optionally failing a part."""
+
+    def __init__(self, fail_parts=()):
+        super().__init__()
+        self.fail_parts = set(fail_parts)
+        self.uploads = {}
+
+    def create_multipart_upload(self, Bucket, Key, **kwargs):
+        upload_id = "upload-%d" % (len(self.uploads) + 1)
+        self.uploads[upload_id] = {}
+        self.calls.append({"op": "create_multipart_upload", "key": Key})
+        return {"UploadId": upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body, ContentMD5):
+        self.calls.append({"op": "upload_part", "number": PartNumber})
+        if PartNumber in self.fail_parts:
+            raise RuntimeError("connection reset")
+        etag = '"%s"' % hashlib.md5(Body).hexdigest()
+        self.uploads[UploadId][PartNumber] = etag
+        return {"ETag": etag}
+
+    def list_parts(self, Bucket, Key, UploadId, **kwargs):
+        if UploadId not in self.uploads:
+            raise FakeClientError("NoSuchUpload")
+        return {"Parts": [{"PartNumber": n, "ETag": e} for n, e in sorted(self.uploads[UploadId].items())]}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        self.calls.append({"op": "complete_multipart_upload", "parts": MultipartUpload["Parts"]})
+        self.uploads.pop(UploadId)
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.calls.append({"op": "abort_multipart_upload", "key": Key})
+        self.uploads.pop(UploadId, None)
+
+
+def _resumable_provider(monkeypatch, client, state_dir):
+    monkeypatch.setattr(
+        "modules.providers.s3.aws.create_s3_client",
+        lambda aws_config, **kwargs: (client, None),
+    )
+    monkeypatch.setattr("modules.providers.s3.ClientError", FakeClientError)
+    provider = S3Provider(state_dir=str(state_dir), bucket="mybucket", **{"part size": "5M", "part threads": "1"})
+    assert provider.verify() is True
+    return provider
+
+
+def _write_archive(path, parts):
+    with open(path, "wb") as fp:
+        for i in range(parts):
+            fp.write(bytes([i]) * (5 * 1024 * 1024))
+        fp.write(b"tail")
+    return str(path)
+
+
+def test_interrupted_multipart_upload_is_resumed(tmp_path, monkeypatch):
+    archive = _write_archive(tmp_path / "backup.tar", 3)
+    client = MultipartClient(fail_parts={2})
+    provider = _resumable_provider(monkeypatch, client, tmp_path)
+
+    assert provider.upload_files([archive]) is False
+    with open(tmp_path / "s3-uploads-mybucket.json", "r", encoding="utf-8") as fp:
+        state = json.load(fp)
+    assert state["backup.tar"]["upload id"] == "upload-1"
+    assert [c["number"] for c in client.calls if c["op"] == "upload_part"] == [1, 2, 3, 4]
+
+    client.fail_parts = set()
+    client.calls = []
+    provider = _resumable_provider(monkeypatch, client, tmp_path)
+
+    assert provider.upload_files([archive]) is True
+    assert [c["number"] for c in client.calls if c["op"] == "upload_part"] == [2]
+    assert [p["PartNumber"] for p in client.calls[-1]["parts"]] == [1, 2, 3, 4]
+    assert not (tmp_path / "s3-uploads-mybucket.json").exists()
+
+
+def test_multipart_upload_restarts_when_file_changed(tmp_path, monkeypatch):
+    archive = _write_archive(tmp_path / "backup.tar", 2)
+    client = MultipartClient(fail_parts={1})
+    provider = _resumable_provider(monkeypatch, client, tmp_path)
+
+    assert provider.upload_files([archive]) is False
+
+    _write_archive(tmp_path / "backup.tar", 1)
+    client.fail_parts = set()
+    client.calls = []
+
+    assert provider.upload_files([archive]) is True
+    ops = [c["op"] for c in client.calls]
+    assert ops[:3] == ["head_bucket", "abort_multipart_upload", "create_multipart_upload"]
+    assert [c["number"] for c in client.calls if c["op"] == "upload_part"] == [1, 2]
+
+
+def test_stale_multipart_uploads_are_aborted(tmp_path, monkeypatch):
+    old = _write_archive(tmp_path / "old.tar", 1)
+    client = MultipartClient(fail_parts={2})
+    provider = _resumable_provider(monkeypatch, client, tmp_path)
+
+    assert provider.upload_files([old]) is False
+    assert len(client.uploads) == 1
+
+    new = tmp_path / "new.tar"
+    new.write_text("small")
+    assert provider.upload_files([str(new)]) is True
+    assert client.uploads == {}
+    assert {"op": "abort_multipart_upload", "key": "old.tar"} in client.calls
+    assert not (tmp_path / "s3-uploads-mybucket.json").exists()
+
+
+def test_part_size_grows_to_stay_within_the_part_limit(tmp_path, monkeypatch):
+    monkeypatch.setattr("modules.providers.s3.MAX_PARTS", 2)
+    archive = _write_archive(tmp_path / "backup.tar", 3)
+    client = MultipartClient(fail_parts={2})
+    provider = _resumable_provider(monkeypatch, client, tmp_path)
+
+    assert provider.upload_files([archive]) is False
+    with open(tmp_path / "s3-uploads-mybucket.json", "r", encoding="utf-8") as fp:
+        assert json.load(fp)["backup.tar"]["part size"] == 8 * 1024 * 1024
+
+    client.fail_parts = set()
+    client.calls = []
+    assert provider.upload_files([archive]) is True
+    assert [c["number"] for c in client.calls if c["op"] == "upload_part"] == [2]
+    assert [p["PartNumber"] for p in client.calls[-1]["parts"]] == [1, 2]
+
+
+def test_parts_of_all_files_share_one_pool(tmp_path, monkeypatch):
+    monkeypatch.setattr("modules.providers.s3.MAX_PART_WORKERS", 3)
+    files = [_write_archive(tmp_path / ("backup%d.tar" % i), 3) for i in range(2)]
+    lock = threading.Lock()
+    running = {}
+    peaks = {"total": 0}
+
+    class CountingClient(MultipartClient):
+        def upload_part(self, Bucket, Key, UploadId, PartNumber, Body, ContentMD5):
+            with lock:
+                running[Key] = running.get(Key, 0) + 1
+                peaks[Key] = max(peaks.get(Key, 0), running[Key])
+                peaks["total"] = max(peaks["total"], sum(running.values()))
+                peaks.setdefault("threads", set()).add(threading.current_thread().name.rsplit("_", 1)[0])
+            try:
+                threading.Event().wait(0.02)
+                return super().upload_part(Bucket, Key, UploadId, PartNumber, Body, ContentMD5)
+            finally:
+                with lock:
+                    running[Key] -= 1
+
+    client = CountingClient()
+    monkeypatch.setattr(
+        "modules.providers.s3.aws.create_s3_client",
+        lambda aws_config, **kwargs: (client, None),
+    )
+    provider = S3Provider(state_dir=str(tmp_path), bucket="mybucket",
+                          **{"part size": "5M", "part threads": "2", "threads": "2"})
+    assert provider.verify() is True
+
+    assert provider.upload_files(files) is True
+    assert peaks["backup0.tar"] <= 2 and peaks["backup1.tar"] <= 2
+    assert peaks["total"] == 3
+    assert peaks["threads"] == {"iceshelf-s3-part"}
@@ -0,0 +1,145 @@
+"""Unit tests for modules/providers/scp.py."""
+
+import os
+import sys
+import types
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+sys.modules.setdefault("paramiko", types.SimpleNamespace())
+sys.modules.setdefault("boto3", types.SimpleNamespace(Session=object))
+botocore_exceptions = types.SimpleNamespace(
+    ClientError=Exception,
+    NoCredentialsError=Exception,
+    NoRegionError=Exception,
+)
+sys.modules.setdefault("botocore", types.SimpleNamespace(exceptions=botocore_exceptions))
+sys.modules.setdefault("botocore.exceptions", botocore_exceptions)
+
+from modules.providers import scp as scp_module
+from modules.providers.scp import SCPProvider
+
+
+class Commands(list):
+    def __init__(self):
+        super().__init__()
+        self.failing = set()
+        self.master_up = True
+        self.streams = {}
+
+
+@pytest.fixture
+def commands(monkeypatch):
+    """Records the commands run, failing scp for any file named in `failing`."""
+    commands = Commands()
+
+    class FakePopen:
+        def __init__(self, cmd, **streams):
+            commands.append(cmd)
+            commands.streams[len(commands) - 1] = streams
+            self.cmd = cmd
+            self.returncode = 0
+            if cmd[0] == "scp" and commands.failing.intersection(cmd):
+                self.returncode = 1
+            if "check" in cmd and not commands.master_up:
+                self.returncode = 255
+
+        def communicate(self):
+            return b"", b"Permission denied" if self.returncode else b""
+
+        def poll(self):
+            return None if "ControlMaster=yes" in self.cmd else self.returncode
+
+        def kill(self):
+            self.returncode = -9
+
+        def wait(self, timeout=None):
+            return self.returncode
+
+    monkeypatch.setattr(scp_module.subprocess, "Popen", FakePopen)
+    monkeypatch.setattr(scp_module, "_which", lambda program: "/usr/bin/" + program)
+    return commands
+
+
+def make_provider(**options):
+    provider = SCPProvider(user="backup", host="example.com", dest="/srv", **options)
+    assert provider.verify()
+    return provider
+
+
+def make_files(tmp_path, sizes):
+    paths = []
+    for i, size in enumerate(sizes):
+        path = tmp_path / ("file%d" % i)
+        path.write_bytes(b"x" * size)
+        paths.append(str(path))
+    return paths
+
+
+def test_all_files_are_sent_in_one_scp_over_a_shared_connection(tmp_path, commands):
+    provider = make_provider()
+    files = make_files(tmp_path, [10, 20, 30])
+
+    assert provider.upload_files(files)
+
+    master, check, transfer, stop = commands
+    assert master[0] == "ssh" and "ControlMaster=yes" in master and "-N" in master
+    assert set(commands.streams[0].values()) == {scp_module.subprocess.DEVNULL}
+    assert check[0] == "ssh" and check[-3:-1] == ["-O", "check"]
+    assert transfer[0] == "scp" and "ControlMaster=no" in transfer
+    assert sorted(transfer[-4:-1]) == files
+    assert transfer[-1] == "backup@example.com:/srv/"
+    assert stop[0] == "ssh" and "-O" in stop and "exit" in stop
+    control = next(o for o in master if o.startswith("ControlPath="))
+    assert control in check and control in transfer and control in stop
+    assert not os.path.exists(os.path.dirname(control[len("ControlPath="):]))
+
+
+def test_streams_split_files_evenly(tmp_path, commands):
+    provider = make_provider(streams="2")
+    files = make_files(tmp_path, [100, 40, 30, 20])
+
+    assert provider.upload_files(files)
+
+    batches = [set(files).intersection(c) for c in commands if c[0] == "scp"]
+    assert sorted(batches, key=len) == [{files[0]}, {files[1], files[2], files[3]}]
+
+
+def test_failures_are_reported_per_file(tmp_path, commands, caplog):
+    provider = make_provider()
+    files = make_files(tmp_path, [10, 20, 30])
+    commands.failing.add(files[1])
+
+    assert not provider.upload_files(files)
+
+    singles = [c for c in commands if c[0] == "scp" and len(set(files).intersection(c)) == 1]
+    assert len(singles) == 3
+    assert "scp failed for %s" % files[1] in caplog.text
+    assert files[0] not in caplog.text
+
+
+def test_password_is_passed_through_sshpass(tmp_path, commands):
+    provider = make_provider(password="secret")
+
+    assert provider.upload_files(make_files(tmp_path, [10]))
+    assert commands[0][:3] == ["sshpass", "-p", "secret"]
+
+
+def test_invalid_streams_are_rejected(commands):
+    provider = SCPProvider(user="backup", host="example.com", streams="none")
+    assert not provider.verify()
+
+
+def test_master_that_never_comes_up_is_given_up_on(tmp_path, commands, monkeypatch, caplog):
+    monkeypatch.setattr(scp_module, "MASTER_TIMEOUT", 0.3)
+    monkeypatch.setattr(scp_module.time, "sleep", lambda seconds: None)
+    commands.master_up = False
+    provider = make_provider()
+    files = make_files(tmp_path, [10])
+
+    assert provider.upload_files(files)
+
+    assert any("check" in c for c in commands)
+    assert "could not open a shared connection" in caplog.text
+    assert [c for c in commands if c[0] == "scp"]
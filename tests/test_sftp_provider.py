@@ -0,0 +1,215 @@
+"""Unit tests for modules/providers/sftp.py."""
+
+import hashlib
+import os
+import shlex
+import sys
+import threading
+import types
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+sys.modules.setdefault("paramiko", types.SimpleNamespace())
+sys.modules.setdefault("boto3", types.SimpleNamespace(Session=object))
+botocore_exceptions = types.SimpleNamespace(
+    ClientError=Exception,
+    NoCredentialsError=Exception,
+    NoRegionError=Exception,
+)
+sys.modules.setdefault("botocore", types.SimpleNamespace(exceptions=botocore_exceptions))
+sys.modules.setdefault("botocore.exceptions", botocore_exceptions)
+
+from modules.providers import sftp as sftp_module
+from modules.providers.sftp import SFTPProvider
+
+
+class FakeServer:
+    """Remote file system and connection bookkeeping shared by the fakes."""
+
+    def __init__(self):
+        self.files = {}
+        self.connects = 0
+        self.channels = []
+        self.modes = []
+        self.lock = threading.Lock()
+        self.barrier = None
+
+
+class FakeRemoteFile:
+    def __init__(self, server, path, mode):
+        self.server = server
+        self.path = path
+        self.pipelined = False
+        if "w" in mode:
+            server.files[path] = b""
+        elif path not in server.files:
+            server.files[path] = b""
+
+    def set_pipelined(self, pipelined=True):
+        self.pipelined = pipelined
+
+    def write(self, data):
+        assert self.pipelined
+        with self.server.lock:
+            self.server.files[self.path] += bytes(data)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+class FakeSFTP:
+    def __init__(self, server):
+        self.server = server
+
+    def open(self, path, mode):
+        self.server.modes.append((path, mode))
+        if self.server.barrier is not None:
+            self.server.barrier.wait()
+        return FakeRemoteFile(self.server, path, mode)
+
+    def stat(self, path):
+        if path not in self.server.files:
+            raise IOError("no such file")
+        return types.SimpleNamespace(st_size=len(self.server.files[path]))
+
+    def remove(self, path):
+        if path not in self.server.files:
+            raise IOError("no such file")
+        del self.server.files[path]
+
+    def close(self):
+        pass
+
+
+class FakeTransport:
+    def __init__(self):
+        self.active = True
+        self.keepalive = None
+
+    def is_active(self):
+        return self.active
+
+    def set_keepalive(self, interval):
+        self.keepalive = interval
+
+
+class FakeSSHClient:
+    def __init__(self, server):
+        self.server = server
+        self.transport = None
+
+    def set_missing_host_key_policy(self, policy):
+        pass
+
+    def connect(self, **kwargs):
+        self.server.connects += 1
+        self.transport = FakeTransport()
+
+    def get_transport(self):
+        return self.transport
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.active = False
+
+    def exec_command(self, cmd):
+        args = shlex.split(cmd)
+        data = self.server.files.get(next(a for a in args if a.startswith("/")))
+        if "head" in args:
+            data = data[:int(args[2])]
+        stdout = types.SimpleNamespace(
+            channel=types.SimpleNamespace(recv_exit_status=lambda: 1 if data is None else 0),
+            read=lambda: ("%s  -\n" % hashlib.sha256(data or b"").hexdigest()).encode(),
+        )
+        return None, stdout, None
+
+
+@pytest.fixture
+def server(monkeypatch):
+    server = FakeServer()
+
+    def from_transport(transport):
+        assert transport.is_active()
+        channel = FakeSFTP(server)
+        server.channels.append(channel)
+        return channel
+
+    fake = types.SimpleNamespace(
+        SSHClient=lambda: FakeSSHClient(server),
+        AutoAddPolicy=lambda: None,
+        SFTPClient=types.SimpleNamespace(from_transport=from_transport),
+        SSHException=type("SSHException", (Exception,), {}),
+        PasswordRequiredException=type("PasswordRequiredException", (Exception,), {}),
+        AuthenticationException=type("AuthenticationException", (Exception,), {}),
+    )
+    monkeypatch.setattr(sftp_module, "paramiko", fake)
+    monkeypatch.setattr(sftp_module.digest, "_required", set())
+    sftp_module.digest.configure(None)
+    return server
+
+
+def make_files(tmp_path, count, size=3000):
+    paths = []
+    for i in range(count):
+        path = tmp_path / ("file%d" % i)
+        path.write_bytes(os.urandom(size))
+        paths.append(str(path))
+    return paths
+
+
+def test_uploads_reuse_the_connection_opened_by_verify(tmp_path, server):
+    provider = SFTPProvider(host="example.com", path="/srv", threads="2")
+    assert provider.verify()
+    files = make_files(tmp_path, 3)
+
+    assert provider.upload_files(files)
+    assert provider.upload_files(files[:1])
+
+    assert server.connects == 1
+    for path in files:
+        with open(path, "rb") as fp:
+            assert server.files["/srv/" + os.path.basename(path)] == fp.read()
+
+
+def test_files_are_sent_over_parallel_channels(tmp_path, server):
+    provider = SFTPProvider(host="example.com", path="/srv", threads="2")
+    assert provider.verify()
+    server.barrier = threading.Barrier(2, timeout=5)
+
+    assert provider.upload_files(make_files(tmp_path, 2))
+    assert len(server.channels) == 2
+
+
+def test_partial_remote_file_is_resumed(tmp_path, server):
+    provider = SFTPProvider(host="example.com", path="/srv")
+    assert provider.verify()
+    (path,) = make_files(tmp_path, 1)
+    with open(path, "rb") as fp:
+        data = fp.read()
+    server.files["/srv/file0"] = data[:1000]
+
+    assert provider.upload_files([path])
+    assert server.files["/srv/file0"] == data
+    assert server.modes == [("/srv/file0", "ab")]
+
+
+def test_lost_connection_is_reestablished(tmp_path, server):
+    provider = SFTPProvider(host="example.com", path="/srv")
+    assert provider.verify()
+    provider._client.transport.active = False
+
+    assert provider.upload_files(make_files(tmp_path, 1))
+    assert server.connects == 2
+
+
+@pytest.mark.parametrize("options", [
+    {"threads": "0"},
+    {"threads": "many"},
+])
+def test_invalid_tuning_options_are_rejected(server, options):
+    provider = SFTPProvider(host="example.com", **options)
+    assert not provider.verify()
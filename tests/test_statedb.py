@@ -0,0 +1,195 @@
+"""Unit tests for modules/statedb.py."""
+
+import json
+import os
+import sqlite3
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from modules import dataset
+from modules import jsonstream
+from modules import statedb
+
+
+STATE = {
+    "version": [1, 1, 0],
+    "timestamp": 1700000000.5,
+    "vault": None,
+    "storage": ["cp:/backups"],
+    "lastbackup": "20240102-000000-00002",
+    "dataset": {
+        "/src/a": {
+            "checksum": "aa:sha1",
+            "memberof": ["20240102-000000-00002", "20240101-000000-00001"],
+            "deleted": [],
+            "stat": [5, 1, 2, 3, 4],
+        },
+        "/src/b": {"checksum": "", "memberof": ["20240101-000000-00001"], "deleted": ["20240102-000000-00002"]},
+        "/src/c": {"checksum": "cc:sha1", "memberof": ["20240102-000000-00002"], "deleted": []},
+    },
+    "backups": {
+        "20240101-000000-00001": ["/src/a", "/src/b"],
+        "20240102-000000-00002": ["/src/c", "/src/a"],
+    },
+    "moved": {"/src/c": {"reference": "20240101-000000-00001", "original": "/src/b"}},
+}
+
+
+def test_json_state_survives_a_round_trip_through_sqlite(tmp_path):
+    with open(tmp_path / "checksum.json", "w", encoding="utf-8") as fp:
+        json.dump(STATE, fp)
+
+    statedb.importJson(str(tmp_path / "checksum.json"), str(tmp_path / "checksum.db"))
+    statedb.exportJson(str(tmp_path / "checksum.db"), str(tmp_path / "exported.json"))
+
+    assert statedb.isSqlite(str(tmp_path / "checksum.db"))
+    assert not statedb.isSqlite(str(tmp_path / "exported.json"))
+    assert statedb.load(str(tmp_path / "checksum.db")) == STATE
+    assert statedb.load(str(tmp_path / "exported.json")) == STATE
+
+
+def test_only_named_entries_are_written(tmp_path):
+    filename = str(tmp_path / "checksum.db")
+    db = statedb.connect(filename)
+    statedb.save(db, STATE)
+
+    data = json.loads(json.dumps(STATE))
+    data["dataset"]["/src/a"]["checksum"] = "changed:sha1"
+    data["dataset"]["/src/c"]["checksum"] = "ignored:sha1"
+    data["dataset"]["/src/d"] = {"checksum": "dd:sha1", "memberof": ["20240103-000000-00003"], "deleted": []}
+    del data["dataset"]["/src/b"]
+    del data["moved"]["/src/c"]
+    data["backups"]["20240103-000000-00003"] = ["/src/d"]
+    data["lastbackup"] = "20240103-000000-00003"
+    statedb.save(db, data, ["/src/a", "/src/b", "/src/d"], ["/src/c"], ["20240103-000000-00003"])
+    db.close()
+
+    loaded = statedb.load(filename)
+    assert loaded["dataset"]["/src/a"]["checksum"] == "changed:sha1"
+    assert loaded["dataset"]["/src/c"]["checksum"] == "cc:sha1"
+    assert "/src/b" not in loaded["dataset"]
+    assert loaded["dataset"]["/src/d"]["memberof"] == ["20240103-000000-00003"]
+    assert loaded["moved"] == {}
+    assert sorted(loaded["backups"]) == ["20240101-000000-00001", "20240102-000000-00002", "20240103-000000-00003"]
+    assert loaded["lastbackup"] == "20240103-000000-00003"
+
+    with sqlite3.connect(filename) as db:
+        assert db.execute("SELECT COUNT(*) FROM memberships WHERE path = '/src/b'").fetchone() == (0,)
+
+
+def _journal_change(data):
+    data["dataset"]["/src/a"]["checksum"] = "changed:sha1"
+    data["dataset"]["/src/d"] = {"checksum": "dd:sha1", "memberof": ["20240103-000000-00003"], "deleted": []}
+    del data["dataset"]["/src/b"]
+    del data["moved"]["/src/c"]
+    data["backups"]["20240103-000000-00003"] = ["/src/d"]
+    data["lastbackup"] = "20240103-000000-00003"
+
+
+def test_journal_is_replayed_on_top_of_the_snapshot(tmp_path):
+    filename = str(tmp_path / "checksum.json")
+    statedb.writeJson(filename, STATE)
+    data = json.loads(json.dumps(STATE))
+    _journal_change(data)
+
+    size = statedb.appendJournal(filename, data, ["/src/a", "/src/b", "/src/d"], ["/src/c"], ["20240103-000000-00003"])
+
+    assert size == os.path.getsize(tmp_path / "checksum.journal")
+    assert statedb.load(filename) == data
+    with open(filename, "r", encoding="utf-8") as fp:
+        assert json.load(fp) == STATE
+
+
+def test_torn_journal_record_is_skipped(tmp_path, caplog):
+    filename = str(tmp_path / "checksum.json")
+    statedb.writeJson(filename, STATE)
+    with open(tmp_path / "checksum.journal", "wb") as fp:
+        fp.write(b'{"info": {"lastbackup": "torn"')
+    data = json.loads(json.dumps(STATE))
+    _journal_change(data)
+
+    statedb.appendJournal(filename, data, ["/src/a", "/src/b", "/src/d"], ["/src/c"], ["20240103-000000-00003"])
+
+    assert statedb.load(filename) == data
+    assert "Ignoring incomplete record" in caplog.text
+
+
+def test_writing_the_snapshot_folds_the_journal(tmp_path):
+    filename = str(tmp_path / "checksum.json")
+    statedb.writeJson(filename, STATE)
+    data = json.loads(json.dumps(STATE))
+    _journal_change(data)
+    statedb.appendJournal(filename, data, ["/src/a"], [], [])
+
+    statedb.writeJson(filename, data)
+
+    assert not os.path.exists(tmp_path / "checksum.journal")
+    assert statedb.load(filename) == data
+
+
+def test_snapshot_is_written_exactly_like_json_dumps(tmp_path, monkeypatch):
+    monkeypatch.setattr(statedb, "WRITE_BATCH", 2)
+    filename = str(tmp_path / "checksum.json")
+
+    statedb.writeJson(filename, STATE)
+
+    with open(filename, "r", encoding="utf-8") as fp:
+        assert fp.read() == json.dumps(STATE, ensure_ascii=False)
+
+
+def test_compact_load_gives_records(tmp_path):
+    filename = str(tmp_path / "checksum.json")
+    statedb.writeJson(filename, STATE)
+    statedb.importJson(filename, str(tmp_path / "checksum.db"))
+
+    for name in ("checksum.json", "checksum.db"):
+        data = statedb.load(str(tmp_path / name), compact=True)
+        assert all(isinstance(item, dataset.FileRecord) for item in data["dataset"].values())
+        assert data == STATE
+        statedb.writeJson(str(tmp_path / "again.json"), data)
+        assert statedb.load(str(tmp_path / "again.json")) == STATE
+
+
+def _walked(filename):
+    data = {key: {} for key in statedb.STREAMED}
+    for key, name, value in statedb.iterate(filename):
+        if name is None:
+            data[key] = value
+        else:
+            data[key][name] = value
+    return data
+
+
+def test_iterate_gives_what_load_does(tmp_path, monkeypatch):
+    monkeypatch.setattr(jsonstream, "CHUNK", 16)
+    filename = str(tmp_path / "checksum.json")
+    statedb.writeJson(filename, STATE)
+    statedb.importJson(filename, str(tmp_path / "checksum.db"))
+    assert _walked(filename) == STATE
+    assert _walked(str(tmp_path / "checksum.db")) == STATE
+
+    data = json.loads(json.dumps(STATE))
+    _journal_change(data)
+    statedb.appendJournal(filename, data, ["/src/a", "/src/b", "/src/d"], ["/src/c"], ["20240103-000000-00003"])
+
+    assert statedb.load(filename) == data
+    assert _walked(filename) == data
+
+
+def test_queries_find_files_and_backups(tmp_path):
+    state = json.loads(json.dumps(STATE))
+    state["dataset"]["/src/Ärger_100%"] = {"checksum": "dd:sha1", "memberof": ["20240101-000000-00001"], "deleted": []}
+    filename = str(tmp_path / "checksum.json")
+    statedb.writeJson(filename, state)
+    statedb.importJson(filename, str(tmp_path / "checksum.db"))
+
+    for name in ("checksum.json", "checksum.db"):
+        filename = str(tmp_path / name)
+        assert statedb.version(filename) == [1, 1, 0]
+        assert sorted(statedb.findFiles(filename, "/SRC/A")) == [("/src/a", STATE["dataset"]["/src/a"]["memberof"])]
+        assert [path for path, _ in statedb.findFiles(filename, "r_100%")] == ["/src/Ärger_100%"]
+        assert [path for path, _ in statedb.findFiles(filename, "äR")] == ["/src/Ärger_100%"]
+        assert list(statedb.findFiles(filename, "a_")) == []
+        assert statedb.backupMembers(filename, "20240102-000000-00002") == ["/src/c", "/src/a"]
+        assert statedb.backupMembers(filename, "20990101-000000-00000") is None